@@ -0,0 +1,90 @@
+import math
+import time
+import threading
+
+# Защита сервера от «штормов переподключений»: после перезапуска сервера или сбоя Wi-Fi весь класс
+# одновременно регистрируется заново, перезапускает FFmpeg и досылает отложенные запросы.
+# Маршрут ограничивают две корзины токенов: своя у каждого клиента и общая на маршрут.
+# Отказ — 429 с Retry-After (целые секунды) и X-Retry-Jitter: клиент ждёт Retry-After плюс случайную
+# долю X-Retry-Jitter, поэтому повторы класса растягиваются во времени, а не приходят одной волной
+RETRY_AFTER_MIN = 1
+RETRY_JITTER_MIN = 1.0
+# Корзины клиентов, к которым давно не обращались, удаляются, чтобы таблица не росла бесконечно
+BUCKET_IDLE_TTL = 300
+BUCKET_SWEEP_INTERVAL = 60
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst подряд."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """0, если токен взят, иначе сколько секунд ждать следующего."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Корзины одного правила по ключу: client_id, адрес клиента или имя маршрута."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def take(self, key):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._swept_at > BUCKET_SWEEP_INTERVAL:
+                self._buckets = {name: bucket for name, bucket in self._buckets.items()
+                                 if now - bucket.updated < BUCKET_IDLE_TTL}
+                self._swept_at = now
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            return bucket.take(now)
+
+
+class AdmissionControl:
+    """Правила по эндпоинтам: {'client': (rate, burst), 'route': (rate, burst)}, любое можно не задавать.
+    Эндпоинты без правил пропускаются без проверки."""
+
+    def __init__(self, rules):
+        self.client_limits = {endpoint: RateLimiter(*rule['client']) for endpoint, rule in rules.items() if 'client' in rule}
+        self.route_limits = {endpoint: RateLimiter(*rule['route']) for endpoint, rule in rules.items() if 'route' in rule}
+
+    def check(self, endpoint, key):
+        """None — запрос пропущен, иначе (ожидание, разброс) в секундах для Retry-After."""
+        client_limit = self.client_limits.get(endpoint)
+        if client_limit:
+            wait = client_limit.take(key)
+            if wait:
+                # Частит один клиент: остальным повторы не мешают, разброс небольшой
+                return wait, max(RETRY_JITTER_MIN, wait)
+
+        route_limit = self.route_limits.get(endpoint)
+        if route_limit:
+            wait = route_limit.take(endpoint)
+            if wait:
+                # Маршрут перегружен всем классом: повторы размазываются по времени восстановления корзины
+                return wait, max(RETRY_JITTER_MIN, route_limit.burst / route_limit.rate)
+        return None
+
+
+def retry_headers(wait, jitter):
+    return {
+        'Retry-After': str(max(RETRY_AFTER_MIN, math.ceil(wait))),
+        'X-Retry-Jitter': f"{jitter:.1f}"
+    }
@@ -1,4 +1,6 @@
 import os
+import re
+import queue
 import uuid
 from datetime import datetime, timedelta
 from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_file, Response, flash
@@ -11,7 +13,22 @@ import subprocess
 import threading
 import time
 import glob
-from ctypes import windll
+import socket
+import json
+import hashlib
+import base64
+import shutil
+try:
+    from ctypes import windll
+except ImportError:
+    # Не Windows: приоритет процессов FFmpeg не меняется
+    windll = None
+from state import create_state_backend, process_key, COMMAND_ACTIVE_STATUSES
+import statistics
+import compression
+import admission
+import recording
+import mpegts
 
 logging.basicConfig(level=logging.DEBUG, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,30 +40,163 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", secrets.token_hex(16))
+app.wsgi_app = compression.RequestDecompressionMiddleware(app.wsgi_app)
 
 
 DB_PATH = 'teacher_student.db'
 
-clients = {}      
+# Клиенты, сессии, очереди команд и уведомления живут в общем хранилище,
+# чтобы любой воркер мог обслужить любой запрос (STATE_BACKEND=memory|sqlite)
+state = create_state_backend()
 teachers = {}     
-sessions = {}     
 
 TEACHER_USERNAME = "teacher"  
 TEACHER_PASSWORD = "password"  
 TOKEN_LENGTH = 32
 SESSION_EXPIRY = timedelta(hours=24)  
 CLIENT_EXPIRY = timedelta(minutes=5)  
+GROUP_EXPIRY = timedelta(hours=24)
+GROUP_STREAM_TIMEOUT = 300
+GROUP_STREAM_INTERVAL = 1
+# Страница трансляции ждёт выхода прокси в эфир через SSE, а не перебирает плейлист повторными запросами
+STREAM_STATUS_TIMEOUT = 60
+STREAM_STATUS_INTERVAL = 0.5
 
+# Интервалы опроса (секунды), которые сервер подсказывает клиенту в заголовке X-Poll-Intervals:
+# часто, пока учитель смотрит страницу ученика, и редко, когда никто не смотрит
+WATCH_TTL = 30
+POLL_INTERVALS_WATCHED = {'commands': 2, 'notifications': 2, 'heartbeat': 5, 'processes': 2}
+POLL_INTERVALS_IDLE = {'commands': 30, 'notifications': 30, 'heartbeat': 60, 'processes': 30}
+POLL_HINT_ENDPOINTS = {
+    'get_commands', 'ack_commands', 'report_command_state', 'check_notifications', 'heartbeat', 'update_screen_info',
+    'sync_client_state', 'replay_client_journal', 'command_result', 'upload_command_output', 'upload_process_snapshot', 'upload_thumbnail', 'register_stream'
+}
+
+# Допуск клиентских запросов (admission.py): корзина токенов (запросов в секунду, подряд) на каждого клиента
+# и общая на маршрут. Клиентский лимит с запасом покрывает обычный опрос и нужен против зациклившегося клиента,
+# лимит маршрута сглаживает волну повторов класса после перезапуска сервера. Регистрация клиента
+# ограничивается только по маршруту: компьютеры класса часто выходят в сеть с одного адреса
+ADMISSION_RULES = {
+    'register_client': {'route': (5, 20)},
+    'register_stream': {'client': (0.2, 3), 'route': (2, 10)},
+    'get_commands': {'client': (5, 20)},
+    'check_notifications': {'client': (5, 20)},
+    'heartbeat': {'client': (2, 10), 'route': (100, 200)},
+    'sync_client_state': {'client': (2, 10), 'route': (50, 100)},
+    'replay_client_journal': {'client': (2, 10), 'route': (20, 40)},
+    'upload_process_snapshot': {'client': (2, 10), 'route': (50, 100)},
+    'upload_thumbnail': {'client': (1, 5), 'route': (20, 40)}
+}
+admission_control = admission.AdmissionControl(ADMISSION_RULES)
+
+# Профиль кодировщика клиента (X-Encoder-Profile): thumbnail, пока стрим никто не смотрит,
+# detail для открытого стрима и normal, если HLS сегменты появляются медленнее, чем длятся.
+# Отставание проверяет супервизор прокси раз в PROXY_LEASE_RENEW_INTERVAL, подсказка в ответах только читает итог
+STREAM_LAG_THRESHOLD = 1.5
+ENCODER_DOWNGRADE_HOLD = 120
+
+# Поля записи клиента, которые синхронизируются через /api/client-state
+CLIENT_STATE_FIELDS = ('system_info', 'screen_info')
+
+# Локальные процессы FFmpeg этого воркера; общая информация о прокси хранится в state
 ffmpeg_processes = {}  
 
 PROXY_PORT_START = 8100  
-next_proxy_port = PROXY_PORT_START
+PROXY_LEASE_TTL = 15
+PROXY_LEASE_RENEW_INTERVAL = 5
+HLS_ROOT = os.environ.get('HLS_ROOT', os.path.join('static', 'streams'))
+# Длительность HLS сегмента прокси и число сегментов в живом плейлисте: от них зависит задержка
+# трансляции (замеряется latency_bench.py)
+HLS_SEGMENT_TIME = 0.2
+HLS_LIST_SIZE = 3
+# Запуск прокси занимает секунды (остановка старого FFmpeg, запуск нового), поэтому регистрация стрима
+# только ставит задачу фоновому менеджеру прокси и сразу отвечает. Повторные задачи клиента, пока его задача
+# ждёт в очереди, сливаются: менеджер запускает прокси по последнему proxy_request.
+# Очередь ограничена: при переполнении регистрация стрима отвечает 503 с Retry-After по оценке времени
+# разбора очереди, а не запускает прокси всего класса в одну секунду
+PROXY_QUEUE_SIZE = 20
+PROXY_START_CONCURRENCY = 2
+PROXY_START_ESTIMATE = 1.0
+proxy_jobs = queue.Queue(maxsize=PROXY_QUEUE_SIZE)
+_pending_proxy_jobs = set()
+_proxy_jobs_lock = threading.Lock()
+_proxy_start_locks = {}
+_proxy_start_seconds = PROXY_START_ESTIMATE
+# Прокси готов, когда FFmpeg впервые записал плейлист, то есть закончил первый сегмент
+PROXY_READY_PATTERN = re.compile(r"Opening '[^']*playlist\.m3u8(\.tmp)?' for writing")
+# Возможности FFmpeg (версия, кодировщики, форматы) проверяются один раз на процесс
+_ffmpeg_capabilities = None
+_ffmpeg_probe_lock = threading.Lock()
+
+# Запись стримов: прокси копирует видео без перекодирования ещё и в файлы RECORDING_ROOT/<client_id>/
+# по RECORDING_SEGMENT_TIME секунд. Учитель включает запись для ученика, RECORD_STREAMS=1 — для всех
+# по умолчанию. Архив всего класса ограничен RECORDING_MAX_BYTES и RECORDING_MAX_AGE секундами
+RECORDING_ROOT = os.environ.get('RECORDING_ROOT', 'recordings')
+RECORD_STREAMS = os.environ.get('RECORD_STREAMS', '0') == '1'
+RECORDING_SEGMENT_TIME = 60
+RECORDING_MAX_BYTES = int(os.environ.get('RECORDING_MAX_BYTES', 20 * 1024 ** 3))
+RECORDING_MAX_AGE = 7 * 24 * 3600
+RECORDING_MAINTENANCE_INTERVAL = 60
+
+# Вывод команд: небольшой вывод хранится в записи команды, большой переносится в файлы OUTPUT_ROOT.
+# Вывод, который приходит по частям, до завершения команды копится байтами в файле: клиент режет его
+# по байтам, и многобайтовый символ может оказаться в двух частях
+OUTPUT_ROOT = os.environ.get('OUTPUT_ROOT', 'command_output')
+OUTPUT_STREAMS = ('stdout', 'stderr')
+OUTPUT_SPOOL_MEMORY = 64 * 1024
+OUTPUT_MAX_CHUNK = 1024 * 1024
+OUTPUT_TAIL_LIMIT = 256 * 1024
+OUTPUT_PREVIEW_LIMIT = 1024 * 1024
+
+# Миниатюры экранов для сетки на панели: клиент присылает JPEG, только когда картинка заметно
+# изменилась, сервер хранит последнюю и отдаёт её с ETag. Панель перепроверяет их раз в THUMBNAIL_REFRESH секунд
+THUMBNAIL_MAX_BYTES = 256 * 1024
+THUMBNAIL_MIMETYPES = ('image/jpeg', 'image/png', 'image/webp')
+THUMBNAIL_REFRESH = 5
+
+# Команды выполняются на клиенте параллельно: high идут вне очереди, timeout — в секундах.
+# Статусы: pending (ждёт клиента) -> queued (в очереди клиента) -> running -> completed | cancelled
+COMMAND_PRIORITIES = {'kill_process': 'high', 'get_processes': 'normal', 'shell': 'normal'}
+COMMAND_TIMEOUTS = {'kill_process': 10, 'get_processes': 30, 'shell': 30}
+COMMAND_TIMEOUT_MAX = 3600
+
+# История команд отдаётся по курсору (ревизии команды) и без тел вывода
+COMMAND_HISTORY_PAGE = 100
+COMMAND_HISTORY_PAGE_MAX = 500
+COMMAND_METADATA_FIELDS = (
+    'id', 'command', 'type', 'status', 'priority', 'timeout', 'exit_code', 'timestamp',
+    'started_at', 'completed_at', 'cancel_requested', 'group_id', 'rev'
+)
+
+# Клиент без связи копит результаты, подтверждения и вывод команд в журнале и доставляет пакетами
+JOURNAL_BATCH_MAX = 200
+
+# Снимки процессов клиентов: сортировка и постраничная выдача делаются на сервере
+PROCESS_SORT_FIELDS = ('rss', 'cpu_percent', 'name', 'pid', 'create_time', 'username')
+PROCESS_PAGE_DEFAULT = 50
+PROCESS_PAGE_MAX = 500
+_output_locks = {}
+_output_locks_guard = threading.Lock()
+
+_worker_id = None
+_worker_pid = None
+_proxy_supervisor_started = False
+_external_proxy_supervisor = False
+_recordings_maintained_at = 0
+
+def get_worker_id():
+    global _worker_id, _worker_pid, _proxy_supervisor_started
+    if _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        _worker_id = f"{socket.gethostname()}:{_worker_pid}:{secrets.token_hex(4)}"
+        _proxy_supervisor_started = False
+    return _worker_id
+
+def proxy_lease_name(client_id):
+    return f"proxy:{client_id}"
 
 def get_next_proxy_port():
-    global next_proxy_port
-    port = next_proxy_port
-    next_proxy_port += 1
-    return port
+    return state.next_counter('proxy_port', PROXY_PORT_START)
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -111,25 +261,29 @@ def cleanup_data():
     now = datetime.now()
     
     inactive_clients = []
-    for client_id, client_data in clients.items():
+    for client_id, client_data in state.all_clients().items():
         last_seen = client_data.get("last_seen", datetime.min)
         if now - last_seen > CLIENT_EXPIRY:
             inactive_clients.append(client_id)
     
     for client_id in inactive_clients:
+        # Прокси другого воркера остановит его владелец, заметив удаление клиента
         stop_ffmpeg_proxy(client_id)
-        del clients[client_id]
+        state.delete_client(client_id)
+        shutil.rmtree(os.path.join(OUTPUT_ROOT, client_id), ignore_errors=True)
         logger.info(f"Удален неактивный клиент: {client_id}")
     
     expired_sessions = []
-    for session_token, session_data in sessions.items():
+    for session_token, session_data in state.all_sessions().items():
         expires = session_data.get("expires", datetime.min)
         if now > expires:
             expired_sessions.append(session_token)
     
     for session_token in expired_sessions:
-        del sessions[session_token]
+        state.delete_session(session_token)
         logger.info(f"Удалена истекшая сессия")
+    
+    state.delete_groups_before(now - GROUP_EXPIRY)
 
 def require_client_auth(f):
     @wraps(f)
@@ -140,14 +294,14 @@ def require_client_auth(f):
         if not client_id or not token:
             return jsonify({"error": "Missing client_id or token"}), 401
         
-        if client_id not in clients:
+        client = state.get_client(client_id)
+        if client is None:
             return jsonify({"error": "Unknown client_id"}), 401
             
-        client = clients[client_id]
         if client.get('token') != token:
             return jsonify({"error": "Invalid token"}), 401
             
-        client['last_seen'] = datetime.now()
+        state.touch_client(client_id)
         
         return f(*args, **kwargs)
     return decorated_function
@@ -157,25 +311,217 @@ def require_teacher_auth(f):
     def decorated_function(*args, **kwargs):
         session_token = request.cookies.get('session_token')
         
-        if not session_token or session_token not in sessions:
+        session_data = state.get_session(session_token) if session_token else None
+        if session_data is None:
             return redirect(url_for('login'))
             
-        session_data = sessions[session_token]
         now = datetime.now()
         
         if now > session_data.get('expires', datetime.min):
-            del sessions[session_token]
+            state.delete_session(session_token)
             return redirect(url_for('login'))
             
         session_data['expires'] = now + SESSION_EXPIRY
+        state.set_session(session_token, session_data)
         
         return f(*args, **kwargs)
     return decorated_function
 
 @app.before_request
 def before_request():
+    ensure_proxy_supervisor()
+    # Отказ отдаётся до работы маршрута: под волной повторов он должен стоить дёшево
+    client_key = admission_key(request.endpoint, (request.view_args or {}).get('client_id'),
+                               request.args.get('token'), request.remote_addr)
+    rejected = admission_control.check(request.endpoint, client_key)
+    if rejected:
+        logger.debug(f"Запрос {request.endpoint} от {client_key} отклонён, повтор через {rejected[0]:.1f} с")
+        return retry_later_response(429, 'Too many requests', *rejected)
     cleanup_data()
 
+def admission_key(endpoint, client_id, token, remote_addr):
+    """Ключ корзины допуска. Корзина клиента расходуется только запросами с его токеном, иначе
+    любой, кто знает client_id, мог бы её исчерпать; остальные запросы считаются по адресу."""
+    if client_id and token and endpoint in admission_control.client_limits:
+        client = state.get_client(client_id)
+        if client is not None and client.get('token') == token:
+            return client_id
+    return remote_addr
+
+def retry_later_response(status, error, wait, jitter):
+    headers = admission.retry_headers(wait, jitter)
+    response = jsonify({'error': error, 'retry_after': int(headers['Retry-After']), 'retry_jitter': jitter})
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+def mark_client_watched(client_id, streaming=False):
+    """Учитель открыл страницу ученика: клиент будет опрашивать сервер часто ещё WATCH_TTL секунд.
+    streaming=True — открыт сам стрим, сессия учителя считается его зрителем."""
+    now = time.time()
+    fields = {'watched_until': now + WATCH_TTL}
+    if streaming:
+        client = state.get_client(client_id) or {}
+        viewers = {key: expires for key, expires in (client.get('stream_viewers') or {}).items() if expires > now}
+        viewer = hashlib.sha256((request.cookies.get('session_token') or '').encode()).hexdigest()[:16]
+        viewers[viewer] = now + WATCH_TTL
+        fields['stream_viewers'] = viewers
+    state.update_client(client_id, **fields)
+
+def read_hls_playlist(hls_path):
+    """Сегменты живого плейлиста по порядку: name, path, duration (EXTINF), mtime и program_date_time,
+    если FFmpeg его пишет. Уже удалённые сегменты пропускаются."""
+    segments = []
+    with open(os.path.join(hls_path, 'playlist.m3u8'), 'r') as f:
+        duration = None
+        program_date_time = None
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[8:].split(',')[0])
+            elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+                program_date_time = datetime.fromisoformat(line[25:].replace('Z', '+00:00')).timestamp()
+            elif line and not line.startswith('#') and duration is not None:
+                path = os.path.join(hls_path, line)
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    mtime = None
+                if mtime is not None:
+                    segments.append({'name': line, 'path': path, 'duration': duration, 'mtime': mtime,
+                                     'program_date_time': program_date_time})
+                duration = None
+                program_date_time = None
+    return segments
+
+def stream_lag_ratio(client):
+    """Во сколько раз время появления последних HLS сегментов больше их длительности.
+    Больше 1 — кодировщик клиента или сеть не успевают; None, если сегментов мало."""
+    hls_path = (client.get('proxy') or {}).get('hls_path')
+    if not hls_path:
+        return None
+    
+    try:
+        segments = read_hls_playlist(hls_path)
+    except (OSError, ValueError):
+        return None
+    
+    if len(segments) < 2:
+        return None
+    # Время записи сегмента — момент его окончания, поэтому длительность первого не учитываем
+    media_duration = sum(segment['duration'] for segment in segments[1:])
+    if media_duration <= 0:
+        return None
+    return (segments[-1]['mtime'] - segments[0]['mtime']) / media_duration
+
+def stream_health(hls_path):
+    """Метрики стрима по TS сегментам живого плейлиста: fps, битрейт, GOP, разброс длительности сегментов,
+    ошибки continuity counter и задержка появления сегмента относительно времени захвата кадров.
+    Время захвата — EXT-X-PROGRAM-DATE-TIME сегмента: FFmpeg прокси отсчитывает его от первого принятого кадра."""
+    try:
+        segments = read_hls_playlist(hls_path)
+    except (OSError, ValueError) as e:
+        return {'error': f"Плейлист недоступен: {e}"}
+    if not segments:
+        return {'error': 'В плейлисте нет сегментов'}
+    
+    stats = mpegts.StreamStats()
+    details = []
+    for segment in segments:
+        try:
+            with open(segment['path'], 'rb') as f:
+                first_dts, last_dts, frames = stats.feed_stream(f)
+        except OSError:
+            continue
+        
+        lag = None
+        if segment['program_date_time'] is not None:
+            lag = segment['mtime'] - (segment['program_date_time'] + segment['duration'])
+        details.append({
+            'name': segment['name'],
+            'duration': segment['duration'],
+            'frames': frames,
+            'size': os.path.getsize(segment['path']) if os.path.exists(segment['path']) else None,
+            'available_at': datetime.fromtimestamp(segment['mtime']).isoformat(),
+            'lag_seconds': round(lag, 3) if lag is not None else None
+        })
+    
+    durations = [segment['duration'] for segment in segments]
+    lags = [segment['lag_seconds'] for segment in details if segment['lag_seconds'] is not None]
+    lag_ratio = stream_lag_ratio({'proxy': {'hls_path': hls_path}})
+    return {
+        **stats.summary(),
+        'segments': details,
+        'segment_duration_mean': round(statistics.mean(durations), 3),
+        'segment_duration_jitter': round(statistics.pstdev(durations), 3),
+        'lag_seconds': lags[-1] if lags else None,
+        'lag_ratio': round(lag_ratio, 2) if lag_ratio is not None else None
+    }
+
+def stream_viewer_count(client, now):
+    return sum(1 for expires in (client.get('stream_viewers') or {}).values() if expires > now)
+
+def choose_encoder_profile(client, watched):
+    now = time.time()
+    if stream_viewer_count(client, now) == 0:
+        return 'normal' if watched else 'thumbnail'
+    return 'normal' if (client.get('encoder_downgraded_until') or 0) > now else 'detail'
+
+def check_stream_lag(client_id, client):
+    """Вызывается супервизором для своих прокси: если стрим смотрят, а сегменты отстают,
+    профиль кодировщика снижается до normal на ENCODER_DOWNGRADE_HOLD секунд."""
+    now = time.time()
+    if stream_viewer_count(client, now) == 0:
+        return
+    lag = stream_lag_ratio(client)
+    if lag is None or lag <= STREAM_LAG_THRESHOLD:
+        return
+    if (client.get('encoder_downgraded_until') or 0) <= now:
+        logger.info(f"Стрим клиента {client_id} отстаёт (x{lag:.1f}), снижаем профиль кодировщика до normal")
+    state.update_client(client_id, encoder_downgraded_until=now + ENCODER_DOWNGRADE_HOLD)
+
+def client_hint_headers(client_id):
+    """Подсказки клиенту: интервалы опроса (X-Poll-Intervals) и профиль кодировщика (X-Encoder-Profile).
+    Пустой словарь, если клиент неизвестен."""
+    client = state.get_client(client_id)
+    if client is None:
+        return {}
+    watched = (client.get('watched_until') or 0) > time.time()
+    intervals = POLL_INTERVALS_WATCHED if watched else POLL_INTERVALS_IDLE
+    return {
+        'X-Poll-Intervals': ', '.join(f"{name}={seconds}" for name, seconds in intervals.items()),
+        'X-Encoder-Profile': choose_encoder_profile(client, watched)
+    }
+
+@app.after_request
+def add_client_hints(response):
+    if request.endpoint in POLL_HINT_ENDPOINTS and request.view_args:
+        response.headers.update(client_hint_headers(request.view_args.get('client_id')))
+    return response
+
+@app.after_request
+def compress_response(response):
+    # Сервер сообщает клиентам, какие сжатые тела запросов он принимает
+    response.headers['Accept-Encoding'] = ', '.join(compression.supported_encodings())
+
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if not compression.should_compress(response.mimetype, len(body)):
+        return response
+
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return response
+
+    response.set_data(compression.compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -184,10 +530,10 @@ def login():
         
         if username in teachers and teachers[username]['password'] == password:
             session_token = secrets.token_urlsafe(TOKEN_LENGTH)
-            sessions[session_token] = {
+            state.set_session(session_token, {
                 'username': username,
                 'expires': datetime.now() + SESSION_EXPIRY
-            }
+            })
             
             response = redirect(url_for('dashboard'))
             response.set_cookie('session_token', session_token, httponly=True, samesite='Lax')
@@ -200,8 +546,8 @@ def login():
 @app.route('/logout')
 def logout():
     session_token = request.cookies.get('session_token')
-    if session_token and session_token in sessions:
-        del sessions[session_token]
+    if session_token:
+        state.delete_session(session_token)
     
     response = redirect(url_for('login'))
     response.delete_cookie('session_token')
@@ -211,13 +557,13 @@ def logout():
 @require_teacher_auth
 def dashboard():
     active_clients = []
-    for client_id, client_data in clients.items():
+    for client_id, client_data in state.all_clients().items():
         last_seen = client_data.get('last_seen', datetime.min)
         if datetime.now() - last_seen <= CLIENT_EXPIRY:
             has_stream = bool(client_data.get('stream_info'))
             proxy_url = None
             
-            if client_id in ffmpeg_processes and ffmpeg_processes[client_id].get('proxy_port'):
+            if (client_data.get('proxy') or {}).get('proxy_port'):
                 proxy_url = f"/stream/{client_id}"
             
             active_clients.append({
@@ -229,18 +575,31 @@ def dashboard():
     
     active_clients.sort(key=lambda x: x['last_seen'], reverse=True)
     
-    return render_template('dashboard.html', clients=active_clients)
+    return render_template('dashboard.html', clients=active_clients, thumbnail_refresh=THUMBNAIL_REFRESH)
 
 @app.route('/view/<client_id>')
 @require_teacher_auth
 def view_client(client_id):
-    if client_id not in clients:
+    client_data = state.get_client(client_id)
+    if client_data is None:
         flash('Клиент не найден')
         return redirect(url_for('dashboard'))
     
-    client_data = clients.get(client_id, {})
+    commands = state.list_commands(client_id)
+    client_data['commands'] = [command_metadata(cmd) for cmd in commands]
+    history_cursor = max((cmd.get('rev', 0) for cmd in commands), default=0)
+    mark_client_watched(client_id)
+    
+    return render_template('view.html', client_id=client_id, client_data=client_data, history_cursor=history_cursor)
+
+@app.route('/api/watch/<client_id>', methods=['POST'])
+@require_teacher_auth
+def watch_client(client_id):
+    if state.get_client(client_id) is None:
+        return jsonify({'success': False, 'error': 'Client not found'}), 404
     
-    return render_template('view.html', client_id=client_id, client_data=client_data)
+    mark_client_watched(client_id, streaming=request.args.get('stream') == '1')
+    return jsonify({'success': True, 'ttl': WATCH_TTL})
 
 @app.route('/send-command/<client_id>', methods=['POST'])
 @require_teacher_auth
@@ -249,29 +608,195 @@ def send_command(client_id):
     if not command:
         return jsonify({'success': False, 'error': 'Missing command'})
     
-    if client_id not in clients:
+    try:
+        timeout = int(request.form['timeout']) if request.form.get('timeout') else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid timeout'}), 400
+    
+    if state.get_client(client_id) is None:
         return jsonify({'success': False, 'error': 'Client not found'})
     
-    command_id = str(uuid.uuid4())
+    command_data = build_command('shell', command, timeout=timeout)
+    state.add_command(client_id, command_data)
+    
+    return jsonify({'success': True, 'command_id': command_data['id']})
+
+def build_command(command_type, command_text=None, pid=None, timeout=None):
+    """Формирует запись команды для очереди клиента: shell, get_processes или kill_process."""
+    if command_type == 'get_processes':
+        command_text = "tasklist /FO CSV"
+    elif command_type == 'kill_process':
+        command_text = f"taskkill /F /PID {pid}"
+    
+    command = {
+        'id': str(uuid.uuid4()),
+        'command': command_text,
+        'timestamp': datetime.now().isoformat(),
+        'status': 'pending',
+        'priority': COMMAND_PRIORITIES[command_type],
+        'timeout': max(1, min(timeout or COMMAND_TIMEOUTS[command_type], COMMAND_TIMEOUT_MAX))
+    }
+    if command_type != 'shell':
+        command['type'] = command_type
+    return command
+
+@app.route('/api/group-command', methods=['POST'])
+@require_teacher_auth
+def group_command():
+    data = request.get_json(silent=True) or request.form
+    command_type = data.get('type') or 'shell'
+    command_text = data.get('command')
+    pid = None
+    
+    if command_type == 'shell' and not command_text:
+        return jsonify({'success': False, 'error': 'Missing command'}), 400
+    if command_type == 'kill_process':
+        try:
+            pid = int(data.get('pid'))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Invalid process ID'}), 400
+    if command_type not in ('shell', 'get_processes', 'kill_process'):
+        return jsonify({'success': False, 'error': 'Unknown command type'}), 400
+    
+    if request.is_json:
+        client_ids = data.get('client_ids') or []
+        send_to_all = bool(data.get('all'))
+    else:
+        client_ids = [cid for cid in data.get('client_ids', '').split(',') if cid]
+        send_to_all = data.get('all') in ('1', 'true', 'on')
+    
+    now = datetime.now()
+    all_clients = state.all_clients()
+    if send_to_all:
+        client_ids = [client_id for client_id, client_data in all_clients.items()
+                      if now - client_data.get('last_seen', datetime.min) <= CLIENT_EXPIRY]
+    else:
+        client_ids = [client_id for client_id in dict.fromkeys(client_ids) if client_id in all_clients]
+    
+    if not client_ids:
+        return jsonify({'success': False, 'error': 'No target clients'}), 400
+    
+    group_id = str(uuid.uuid4())
+    command_ids = {}
+    for client_id in client_ids:
+        command_data = build_command(command_type, command_text, pid)
+        command_data['group_id'] = group_id
+        state.add_command(client_id, command_data)
+        command_ids[client_id] = command_data['id']
+    
+    state.create_group(group_id, {
+        'id': group_id,
+        'command': command_data['command'],
+        'type': command_type,
+        'created_at': now.isoformat(),
+        'command_ids': command_ids
+    })
+    
+    logger.info(f"Групповая команда {group_id} отправлена {len(command_ids)} клиентам: {command_data['command']}")
+    
+    return jsonify({
+        'success': True,
+        'group_id': group_id,
+        'targets': len(command_ids),
+        'command_ids': command_ids
+    })
+
+def aggregate_group(group):
+    """Сводка по групповой команде: счётчики статусов и группы одинаковых выводов."""
+    counts = {'pending': 0, 'queued': 0, 'running': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'missing': 0}
+    targets = []
+    outputs = {}
+    
+    for client_id, command_id in group['command_ids'].items():
+        cmd = state.get_command(client_id, command_id)
+        target = {'client_id': client_id, 'command_id': command_id}
+        
+        if cmd is None:
+            status = 'missing'
+        elif cmd.get('status') == 'completed':
+            exit_code = cmd.get('exit_code', 0)
+            status = 'completed' if exit_code == 0 else 'failed'
+            # Отпечаток считается при сохранении результата, сводка только читает команды
+            digest = cmd.get('output_digest') or command_output_digest(cmd)
+            target.update({
+                'exit_code': exit_code,
+                'completed_at': cmd.get('completed_at'),
+                'output_digest': digest
+            })
+            if digest not in outputs:
+                preview = read_command_output(cmd, 'stdout', 0, 500).decode('utf-8', errors='replace')
+                outputs[digest] = {'digest': digest, 'client_ids': [], 'preview': preview}
+            output = outputs[digest]
+            output['client_ids'].append(client_id)
+        else:
+            status = cmd.get('status', 'pending')
+        
+        target['status'] = status
+        counts[status] = counts.get(status, 0) + 1
+        targets.append(target)
+    
+    output_groups = sorted(outputs.values(), key=lambda output: len(output['client_ids']), reverse=True)
+    for output in output_groups:
+        output['count'] = len(output['client_ids'])
+    
+    finished = counts['completed'] + counts['failed'] + counts['cancelled'] + counts['missing']
+    return {
+        'group_id': group['id'],
+        'command': group['command'],
+        'type': group['type'],
+        'created_at': group['created_at'],
+        'total': len(targets),
+        'counts': counts,
+        'done': finished == len(targets),
+        'outputs_match': len(output_groups) <= 1,
+        'output_groups': output_groups,
+        'targets': targets
+    }
+
+@app.route('/api/group-status/<group_id>')
+@require_teacher_auth
+def group_status(group_id):
+    group = state.get_group(group_id)
+    if group is None:
+        return jsonify({'success': False, 'error': 'Group not found'}), 404
     
-    if 'commands' not in clients[client_id]:
-        clients[client_id]['commands'] = []
+    return jsonify(aggregate_group(group))
+
+@app.route('/api/group-status/<group_id>/stream')
+@require_teacher_auth
+def group_status_stream(group_id):
+    """Server-Sent Events: новая сводка отправляется при каждом изменении, пока все цели не ответят."""
+    group = state.get_group(group_id)
+    if group is None:
+        return jsonify({'success': False, 'error': 'Group not found'}), 404
     
-    clients[client_id]['commands'].append({'id': command_id, 'command': command, 'status': 'pending'})
+    def generate():
+        last_payload = None
+        deadline = time.time() + GROUP_STREAM_TIMEOUT
+        while True:
+            summary = aggregate_group(group)
+            payload = json.dumps(summary)
+            if payload != last_payload:
+                last_payload = payload
+                yield f"data: {payload}\n\n"
+            if summary['done'] or time.time() >= deadline:
+                yield "event: end\ndata: {}\n\n"
+                return
+            time.sleep(GROUP_STREAM_INTERVAL)
     
-    return jsonify({'success': True, 'command_id': command_id})
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/register', methods=['POST'])
 def register_client():
     client_id = str(uuid.uuid4())
     token = secrets.token_urlsafe(TOKEN_LENGTH)
     
-    clients[client_id] = {
+    state.create_client(client_id, {
         'token': token,
         'last_seen': datetime.now(),
-        'commands': [],
         'stream_info': None
-    }
+    })
     
     logger.info(f"Зарегистрирован новый клиент: {client_id}")
     
@@ -294,55 +819,67 @@ def register_stream(client_id):
         if not stream_type or not stream_url:
             return jsonify({"error": "Invalid stream data"}), 400
         
-        clients[client_id]['stream_info'] = {
-            'type': stream_type,
-            'url': stream_url,
-            'registered_at': datetime.now().isoformat()
-        }
+        # Поколение не меняется, пока регистрация не принята: отклонённый клиент повторит её позже
+        backlog = proxy_jobs.qsize()
+        if client_id not in _pending_proxy_jobs and backlog >= PROXY_QUEUE_SIZE:
+            wait = proxy_backlog_wait(backlog)
+            logger.warning(f"Очередь запусков прокси заполнена ({backlog}), регистрация стрима {client_id} отложена")
+            return retry_later_response(503, 'Proxy start queue is full', wait, wait)
         
-        start_ffmpeg_proxy(client_id, stream_url)
+        state.update_client(
+            client_id,
+            stream_info={
+                'type': stream_type,
+                'url': stream_url,
+                'registered_at': datetime.now().isoformat()
+            },
+            proxy_request={
+                'url': stream_url,
+                'generation': state.next_counter(f"proxy_generation:{client_id}", 1)
+            }
+        )
+        
+        enqueue_proxy_job(client_id)
         
         logger.info(f"Клиент {client_id} зарегистрировал стрим: {stream_type}, {stream_url}")
         
-        return jsonify({"success": True, "message": "Stream registered successfully"})
+        return jsonify({
+            "success": True,
+            "message": "Stream registration accepted",
+            **stream_status(client_id, state.get_client(client_id))
+        }), 202
     except Exception as e:
         logger.error(f"Ошибка при регистрации стрима: {e}")
         return jsonify({"error": f"Error registering stream: {str(e)}"}), 500
 
-def start_ffmpeg_proxy(client_id, source_url):
-    stop_ffmpeg_proxy(client_id)
+def ensure_ffmpeg_proxy(client_id):
+    """Запускает прокси в этом воркере, если аренда свободна; иначе его перезапустит текущий владелец."""
+    worker_id = get_worker_id()
+    if state.acquire_lease(proxy_lease_name(client_id), worker_id, PROXY_LEASE_TTL):
+        client = state.get_client(client_id)
+        proxy_request = (client or {}).get('proxy_request')
+        local = ffmpeg_processes.get(client_id)
+        if local and proxy_request and local.get('generation') == proxy_request['generation'] \
+                and local['process'].poll() is None:
+            return worker_id
+        if proxy_request and not start_ffmpeg_proxy(client_id, proxy_request['url'], proxy_request['generation']):
+            mark_proxy_failed(client_id, proxy_request['generation'], 'FFmpeg прокси не запустился')
+        return worker_id
+    
+    owner = state.lease_owner(proxy_lease_name(client_id))
+    logger.info(f"FFmpeg прокси клиента {client_id} принадлежит воркеру {owner}, он подхватит новый запрос")
+    return owner
+
+def start_ffmpeg_proxy(client_id, source_url, generation=None):
+    stop_ffmpeg_proxy(client_id, release_lease=False)
+    
+    if not ffmpeg_ready_for_proxy():
+        return False
     
     try:
-        try:
-            ffmpeg_version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-            logger.info(f"FFmpeg версия: {ffmpeg_version.stdout.split('\\n')[0]}")
-        except Exception as e:
-            logger.error(f"FFmpeg не установлен или недоступен: {e}")
-            return False
-            
         proxy_port = get_next_proxy_port()
-        hls_path = os.path.join('static', 'streams', client_id)
-        
-        os.makedirs(hls_path, exist_ok=True)
-        logger.info(f"Создана директория для HLS: {hls_path}")
-        
-        abs_hls_path = os.path.abspath(hls_path)
-        logger.info(f"Абсолютный путь к директории HLS: {abs_hls_path}")
-        
-        cmd = [
-            'ffmpeg',
-            '-i', source_url,                
-            '-c:v', 'copy',                  
-            '-f', 'hls',                     
-            '-hls_time', '0.2',              
-            '-hls_list_size', '3',           
-            '-hls_flags', 'delete_segments+append_list+discont_start+omit_endlist+independent_segments', 
-            '-hls_segment_type', 'mpegts',   
-            '-hls_init_time', '0',           
-            '-hls_allow_cache', '0',         
-            '-hls_segment_filename', f"{hls_path}/segment_%03d.ts",  
-            f"{hls_path}/playlist.m3u8"      
-        ]
+        hls_path = prepare_hls_path(client_id)
+        cmd = build_ffmpeg_proxy_command(source_url, hls_path, prepare_recording_path(client_id))
         
         logger.info(f"Запуск FFmpeg прокси для клиента {client_id}: {' '.join(cmd)}")
         
@@ -360,67 +897,358 @@ def start_ffmpeg_proxy(client_id, source_url):
             except Exception as e:
                 logger.error(f"Не удалось установить приоритет процесса: {e}")
         
-        threading.Thread(target=read_ffmpeg_output, args=(process.stdout, client_id), daemon=True).start()
-        threading.Thread(target=read_ffmpeg_output, args=(process.stderr, client_id), daemon=True).start()
-        
+        start_time = datetime.now().isoformat()
         ffmpeg_processes[client_id] = {
             'process': process,
             'proxy_port': proxy_port,
             'hls_path': hls_path,
-            'start_time': datetime.now().isoformat()
+            'start_time': start_time,
+            'source_url': source_url,
+            'generation': generation
         }
         
-        clients[client_id]['stream_info']['proxy_url'] = f"/stream/{client_id}"
+        threading.Thread(target=read_ffmpeg_output, args=(process.stdout, client_id), daemon=True).start()
+        threading.Thread(target=read_ffmpeg_output, args=(process.stderr, client_id, generation, True), daemon=True).start()
         
-        threading.Thread(target=monitor_hls_files, args=(client_id, hls_path), daemon=True).start()
+        publish_proxy_info(client_id, proxy_port, hls_path, start_time, generation)
         
         return True
     except Exception as e:
         logger.error(f"Ошибка при запуске FFmpeg прокси: {e}", exc_info=True)
         return False
 
-def monitor_hls_files(client_id, hls_path):
-    logger.info(f"Запущен мониторинг HLS файлов для клиента {client_id} в пути {hls_path}")
+def prepare_hls_path(client_id):
+    hls_path = os.path.join(HLS_ROOT, client_id)
     
-    end_time = time.time() + 60
+    os.makedirs(hls_path, exist_ok=True)
+    logger.info(f"Создана директория для HLS: {hls_path}")
+    
+    abs_hls_path = os.path.abspath(hls_path)
+    logger.info(f"Абсолютный путь к директории HLS: {abs_hls_path}")
+    return hls_path
+
+def prepare_recording_path(client_id):
+    """Директория записи клиента или None, если запись для него выключена."""
+    if not recording_enabled(state.get_client(client_id)):
+        return None
+    record_path = os.path.join(RECORDING_ROOT, client_id)
+    os.makedirs(record_path, exist_ok=True)
+    return record_path
+
+def recording_enabled(client):
+    return bool((client or {}).get('recording', RECORD_STREAMS))
+
+def build_ffmpeg_proxy_command(source_url, hls_path, record_path=None):
+    cmd = [
+        'ffmpeg',
+        '-i', source_url,                
+        '-c:v', 'copy',                  
+        '-f', 'hls',                     
+        '-hls_time', str(HLS_SEGMENT_TIME),
+        '-hls_list_size', str(HLS_LIST_SIZE),
+        '-hls_flags', 'delete_segments+append_list+discont_start+omit_endlist+independent_segments+program_date_time', 
+        '-hls_segment_type', 'mpegts',   
+        '-hls_init_time', '0',           
+        '-hls_allow_cache', '0',         
+        '-hls_segment_filename', f"{hls_path}/segment_%03d.ts",  
+        f"{hls_path}/playlist.m3u8"      
+    ]
+    if record_path:
+        # Второй выход того же процесса: видео копируется в файлы по минутам, границы — на ключевых кадрах
+        cmd += [
+            '-map', '0:v',
+            '-c:v', 'copy',
+            '-f', 'segment',
+            '-segment_time', str(RECORDING_SEGMENT_TIME),
+            '-segment_atclocktime', '1',
+            '-segment_format', 'mpegts',
+            '-reset_timestamps', '0',
+            '-strftime', '1',
+            os.path.join(record_path, f"{recording.RECORDING_FILE_FORMAT}{recording.RECORDING_EXTENSION}")
+        ]
+    return cmd
+
+def publish_proxy_info(client_id, proxy_port, hls_path, start_time, generation):
+    """Публикует информацию о прокси в общем состоянии, чтобы её видели все воркеры."""
+    client = state.get_client(client_id)
+    if client is None:
+        return
+    stream_info = client.get('stream_info') or {}
+    stream_info['proxy_url'] = f"/stream/{client_id}"
+    state.update_client(
+        client_id,
+        stream_info=stream_info,
+        proxy={
+            'owner': get_worker_id(),
+            'proxy_port': proxy_port,
+            'hls_path': hls_path,
+            'start_time': start_time,
+            'generation': generation
+        }
+    )
+
+def clear_proxy_info(client_id):
+    """Убирает информацию о прокси из общего состояния, если прокси принадлежал этому воркеру."""
+    client = state.get_client(client_id)
+    if client is not None and (client.get('proxy') or {}).get('owner') == get_worker_id():
+        stream_info = client.get('stream_info')
+        if stream_info:
+            stream_info.pop('proxy_url', None)
+        state.update_client(client_id, stream_info=stream_info, proxy=None)
+
+def remove_hls_files(hls_path):
+    if hls_path and os.path.exists(hls_path):
+        for file in os.listdir(hls_path):
+            try:
+                os.remove(os.path.join(hls_path, file))
+            except:
+                pass
+        try:
+            os.rmdir(hls_path)
+        except:
+            pass
+
+def use_external_proxy_supervisor():
+    """Отключает потоковый супервизор: прокси этого процесса ведёт другой менеджер (asgi.py)."""
+    global _external_proxy_supervisor
+    _external_proxy_supervisor = True
+
+def ensure_proxy_supervisor():
+    global _proxy_supervisor_started
+    get_worker_id()
+    if _external_proxy_supervisor:
+        return
+    if not _proxy_supervisor_started:
+        _proxy_supervisor_started = True
+        for _ in range(PROXY_START_CONCURRENCY):
+            threading.Thread(target=proxy_manager_loop, daemon=True).start()
+        threading.Thread(target=proxy_supervisor_loop, daemon=True).start()
+
+def enqueue_proxy_job(client_id):
+    """Ставит запуск или перезапуск прокси клиента в очередь менеджера.
+    False — очередь заполнена, задачу поставит супервизор на следующем круге."""
+    with _proxy_jobs_lock:
+        if client_id in _pending_proxy_jobs:
+            return True
+        try:
+            proxy_jobs.put_nowait(client_id)
+        except queue.Full:
+            return False
+        _pending_proxy_jobs.add(client_id)
+    return True
+
+def proxy_backlog_wait(backlog):
+    """Через сколько секунд менеджер прокси разберёт backlog задач при текущем среднем времени запуска."""
+    return backlog * _proxy_start_seconds / PROXY_START_CONCURRENCY
+
+def proxy_start_lock(client_id):
+    with _proxy_jobs_lock:
+        if client_id not in _proxy_start_locks:
+            _proxy_start_locks[client_id] = threading.Lock()
+        return _proxy_start_locks[client_id]
+
+def record_proxy_start_time(seconds):
+    global _proxy_start_seconds
+    # Скользящее среднее: оценка для Retry-After следует за нагрузкой, но не скачет от одного запуска
+    _proxy_start_seconds += (seconds - _proxy_start_seconds) * 0.2
+
+def proxy_manager_loop():
+    """Менеджер прокси: выполняет задачи из очереди, запуски прокси не идут внутри запросов.
+    Потоков PROXY_START_CONCURRENCY, задачи одного клиента выполняются по очереди."""
+    while True:
+        client_id = proxy_jobs.get()
+        with _proxy_jobs_lock:
+            _pending_proxy_jobs.discard(client_id)
+        started = time.monotonic()
+        try:
+            with proxy_start_lock(client_id):
+                ensure_ffmpeg_proxy(client_id)
+        except Exception as e:
+            logger.error(f"Ошибка при запуске FFmpeg прокси клиента {client_id}: {e}", exc_info=True)
+        record_proxy_start_time(time.monotonic() - started)
+
+def proxy_supervisor_loop():
+    """Продлевает аренды своих прокси и подхватывает прокси упавших воркеров."""
+    worker_id = get_worker_id()
+    logger.info(f"Запущен супервизор FFmpeg прокси воркера {worker_id}")
     
-    while time.time() < end_time:
+    while True:
         try:
-            playlist_file = os.path.join(hls_path, "playlist.m3u8")
-            segment_files = glob.glob(os.path.join(hls_path, "segment_*.ts"))
-            
-            logger.info(f"Состояние HLS для {client_id}: playlist существует: {os.path.exists(playlist_file)}, сегментов: {len(segment_files)}")
-            
-            if os.path.exists(playlist_file):
-                with open(playlist_file, 'r') as f:
-                    content = f.read()
-                    logger.debug(f"Содержимое playlist.m3u8 для {client_id}:\n{content}")
+            for client_id in list(ffmpeg_processes.keys()):
+                client = state.get_client(client_id)
+                if client is None:
+                    logger.info(f"Клиент {client_id} удален, останавливаем его FFmpeg прокси")
+                    stop_ffmpeg_proxy(client_id)
+                    continue
+                
+                if not state.acquire_lease(proxy_lease_name(client_id), worker_id, PROXY_LEASE_TTL):
+                    logger.warning(f"Аренда FFmpeg прокси клиента {client_id} потеряна, останавливаем локальный процесс")
+                    stop_ffmpeg_proxy(client_id, release_lease=False)
+                    continue
+                
+                proxy_request = client.get('proxy_request') or {}
+                if proxy_request.get('generation') != ffmpeg_processes[client_id].get('generation'):
+                    logger.info(f"Клиент {client_id} перерегистрировал стрим, перезапускаем FFmpeg прокси")
+                    enqueue_proxy_job(client_id)
+                elif proxy_request and ffmpeg_processes[client_id]['process'].poll() is not None:
+                    # Клиент перезапускает кодировщик при смене профиля, не регистрируя стрим заново
+                    logger.info(f"FFmpeg прокси клиента {client_id} завершился, переподключаемся к стриму")
+                    enqueue_proxy_job(client_id)
+                else:
+                    check_stream_lag(client_id, client)
             
-            time.sleep(5)
+            for client_id, client in state.all_clients().items():
+                if client_id in ffmpeg_processes or not client.get('proxy_request'):
+                    continue
+                if state.lease_owner(proxy_lease_name(client_id)) is None:
+                    logger.info(f"FFmpeg прокси клиента {client_id} без владельца, забираем его себе")
+                    enqueue_proxy_job(client_id)
             
-            if client_id not in ffmpeg_processes or ffmpeg_processes[client_id].get('process').poll() is not None:
-                logger.warning(f"FFmpeg процесс для клиента {client_id} завершился, мониторинг остановлен")
-                break
-                
+            maintain_recordings()
         except Exception as e:
-            logger.error(f"Ошибка при мониторинге HLS файлов: {e}")
-            time.sleep(5)
+            logger.error(f"Ошибка в супервизоре FFmpeg прокси: {e}")
+        
+        time.sleep(PROXY_LEASE_RENEW_INTERVAL)
+
+def maintain_recordings():
+    """Раз в RECORDING_MAINTENANCE_INTERVAL индексирует законченные файлы записи и применяет ограничения архива."""
+    global _recordings_maintained_at
+    if time.time() - _recordings_maintained_at < RECORDING_MAINTENANCE_INTERVAL or not os.path.isdir(RECORDING_ROOT):
+        return
+    _recordings_maintained_at = time.time()
+    
+    recording.enforce_retention(RECORDING_ROOT, RECORDING_MAX_BYTES, RECORDING_MAX_AGE, RECORDING_SEGMENT_TIME)
+    for client_id in os.listdir(RECORDING_ROOT):
+        recording.index_finished(os.path.join(RECORDING_ROOT, client_id), RECORDING_SEGMENT_TIME)
+
+def parse_ffmpeg_list(output):
+    """Имена из вывода ffmpeg -encoders / -muxers: строки после разделителя, имя — второе поле."""
+    names = set()
+    started = False
+    for line in output.splitlines():
+        if line.strip().startswith('--'):
+            started = True
+            continue
+        parts = line.split()
+        if started and len(parts) >= 2:
+            names.update(parts[1].split(','))
+    return names
+
+def ffmpeg_capabilities():
+    """Версия FFmpeg, кодировщики и форматы вывода. Проверяются один раз, а не при каждом запуске прокси;
+    None — FFmpeg не найден (проверка повторится при следующем запуске)."""
+    global _ffmpeg_capabilities
+    with _ffmpeg_probe_lock:
+        if _ffmpeg_capabilities is None:
+            try:
+                version = subprocess.run(['ffmpeg', '-hide_banner', '-version'], capture_output=True, text=True).stdout
+                encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True).stdout
+                muxers = subprocess.run(['ffmpeg', '-hide_banner', '-muxers'], capture_output=True, text=True).stdout
+            except OSError as e:
+                logger.error(f"FFmpeg не установлен или недоступен: {e}")
+                return None
+            _ffmpeg_capabilities = {
+                'version': version.splitlines()[0] if version else 'unknown',
+                'encoders': parse_ffmpeg_list(encoders),
+                'muxers': parse_ffmpeg_list(muxers)
+            }
+            logger.info(f"FFmpeg версия: {_ffmpeg_capabilities['version']}")
+        return _ffmpeg_capabilities
+
+def ffmpeg_ready_for_proxy():
+    capabilities = ffmpeg_capabilities()
+    if capabilities is None:
+        return False
+    missing = {'hls', 'mpegts'} - capabilities['muxers']
+    if missing:
+        logger.error(f"FFmpeg собран без форматов {', '.join(sorted(missing))}: {capabilities['version']}")
+        return False
+    return True
+
+def mark_proxy_ready(client_id, generation):
+    """FFmpeg прокси записал первый плейлист: трансляция доступна зрителям."""
+    client = state.get_client(client_id)
+    proxy = (client or {}).get('proxy')
+    if not proxy or proxy.get('generation') != generation or proxy.get('ready_at'):
+        return
+    now = datetime.now()
+    state.update_client(client_id, proxy=dict(proxy, ready_at=now.isoformat()), proxy_error=None)
+    started = (now - datetime.fromisoformat(proxy['start_time'])).total_seconds()
+    logger.info(f"HLS трансляция клиента {client_id} готова через {started:.2f} с после запуска прокси")
+
+def mark_proxy_failed(client_id, generation, error):
+    """Прокси этого поколения не запустился или завершился, не выдав ни одного сегмента."""
+    state.update_client(client_id, proxy_error={
+        'generation': generation,
+        'error': error,
+        'at': datetime.now().isoformat()
+    })
+    logger.warning(f"FFmpeg прокси клиента {client_id} не вышел в эфир: {error}")
+
+def stream_status(client_id, client):
+    """Состояние трансляции клиента для статуса регистрации:
+    none — стрим не зарегистрирован, pending — прокси ждёт запуска, starting — FFmpeg прокси запущен,
+    но ещё не записал первый сегмент, live — HLS доступен, failed — прокси не вышел в эфир (супервизор повторит запуск)."""
+    proxy_request = (client or {}).get('proxy_request')
+    if not proxy_request:
+        return {'status': 'none'}
+    
+    generation = proxy_request.get('generation')
+    proxy = client.get('proxy') or {}
+    proxy_error = client.get('proxy_error') or {}
+    result = {
+        'generation': generation,
+        'owner': proxy.get('owner'),
+        'started_at': None,
+        'ready_at': None,
+        'hls_url': None
+    }
+    if proxy.get('generation') == generation:
+        result['started_at'] = proxy.get('start_time')
+        result['ready_at'] = proxy.get('ready_at')
+    
+    if result['ready_at']:
+        result['status'] = 'live'
+        result['hls_url'] = f"/hls/{client_id}/playlist.m3u8"
+    elif proxy_error.get('generation') == generation:
+        result['status'] = 'failed'
+        result['error'] = proxy_error.get('error')
+    elif result['started_at']:
+        result['status'] = 'starting'
+    else:
+        result['status'] = 'pending'
+    return result
 
-def read_ffmpeg_output(pipe, client_id):
+def read_ffmpeg_output(pipe, client_id, generation=None, watch_ready=False):
+    """Логирует вывод FFmpeg прокси. С watch_ready (поток stderr) отмечает момент готовности HLS,
+    а если FFmpeg завершился раньше — ошибку поколения с последней строкой об ошибке."""
+    ready = not watch_ready
+    last_error = None
     for line in iter(pipe.readline, b''):
         try:
             line_text = line.decode('utf-8').strip()
             if line_text:
+                if not ready and PROXY_READY_PATTERN.search(line_text):
+                    ready = True
+                    mark_proxy_ready(client_id, generation)
                 if "error" in line_text.lower() or "failed" in line_text.lower():
+                    last_error = line_text
                     logger.error(f"FFmpeg [{client_id}]: {line_text}")
                 else:
                     logger.debug(f"FFmpeg [{client_id}]: {line_text}")
         except Exception as e:
             logger.error(f"Ошибка при чтении вывода FFmpeg: {e}")
+    
+    # Вывод прокси, который уже заменён или остановлен, не меняет статус трансляции
+    local = ffmpeg_processes.get(client_id)
+    if not ready and local and local['process'].stderr is pipe and not local.get('stopping'):
+        mark_proxy_failed(client_id, generation, last_error or 'FFmpeg прокси завершился до первого сегмента')
 
-def stop_ffmpeg_proxy(client_id):
+def stop_ffmpeg_proxy(client_id, release_lease=True):
     if client_id in ffmpeg_processes:
         try:
+            # Остановленный нами прокси — не ошибка запуска
+            ffmpeg_processes[client_id]['stopping'] = True
             process = ffmpeg_processes[client_id].get('process')
             if process and process.poll() is None:
                 process.terminate()
@@ -431,22 +1259,14 @@ def stop_ffmpeg_proxy(client_id):
                 
                 logger.info(f"FFmpeg прокси для клиента {client_id} остановлен")
             
-            hls_path = ffmpeg_processes[client_id].get('hls_path')
-            if hls_path and os.path.exists(hls_path):
-                for file in os.listdir(hls_path):
-                    try:
-                        os.remove(os.path.join(hls_path, file))
-                    except:
-                        pass
-                try:
-                    os.rmdir(hls_path)
-                except:
-                    pass
+            remove_hls_files(ffmpeg_processes[client_id].get('hls_path'))
             
             del ffmpeg_processes[client_id]
             
-            if client_id in clients and clients[client_id].get('stream_info'):
-                clients[client_id]['stream_info'].pop('proxy_url', None)
+            clear_proxy_info(client_id)
+            
+            if release_lease:
+                state.release_lease(proxy_lease_name(client_id), get_worker_id())
             
             return True
         except Exception as e:
@@ -454,108 +1274,389 @@ def stop_ffmpeg_proxy(client_id):
             return False
     return False
 
+def commands_for_client(commands):
+    """Ответ на опрос команд: новые команды и id команд, которые клиент должен отменить."""
+    return {
+        'commands': [cmd for cmd in commands if cmd.get('status') == 'pending'],
+        'cancel': [cmd['id'] for cmd in commands
+                   if cmd.get('cancel_requested') and cmd.get('status') in ('queued', 'running')]
+    }
+
 @app.route('/api/commands/<client_id>', methods=['GET'])
 @require_client_auth
 def get_commands(client_id):
-    client = clients[client_id]
+    return jsonify(commands_for_client(state.list_active_commands(client_id)))
+
+@app.route('/api/commands/<client_id>/state', methods=['POST'])
+@require_client_auth
+def report_command_state(client_id):
+    """Клиент сообщает, что команда встала в его очередь (queued) или начала выполняться (running)."""
+    data = request.get_json(silent=True) or {}
+    command_id = data.get('command_id')
+    status = data.get('status')
+    if not command_id or status not in ('queued', 'running'):
+        return jsonify({'success': False, 'error': 'Missing command_id or invalid status'}), 400
     
-    pending_commands = [cmd for cmd in client.get('commands', []) if cmd.get('status') == 'pending']
+    fields = {'status': status}
+    if status == 'running':
+        fields['started_at'] = datetime.now().isoformat()
+    allowed = ('pending',) if status == 'queued' else ('pending', 'queued')
+    if state.update_command(client_id, command_id, only_status=allowed, **fields):
+        return jsonify({'success': True})
     
-    return jsonify({'commands': pending_commands})
+    cmd = state.get_command(client_id, command_id)
+    if cmd is None:
+        return jsonify({'success': False, 'error': 'Command not found'}), 404
+    # Например, команду отменили, пока она шла к клиенту: клиент её не выполняет
+    return jsonify({'success': False, 'error': 'Invalid command status', 'status': cmd.get('status')}), 409
+
+@app.route('/api/cancel-command/<client_id>/<command_id>', methods=['POST'])
+@require_teacher_auth
+def cancel_command(client_id, command_id):
+    """Отмена команды: ещё не полученная клиентом отменяется сразу, остальные — клиентом с завершением дерева процессов."""
+    if state.update_command(client_id, command_id, only_status='pending',
+                            status='cancelled', completed_at=datetime.now().isoformat()):
+        return jsonify({'success': True, 'status': 'cancelled'})
+    
+    if state.update_command(client_id, command_id, only_status=('queued', 'running'), cancel_requested=True):
+        return jsonify({'success': True, 'status': 'cancelling'})
+    
+    cmd = state.get_command(client_id, command_id)
+    if cmd is None:
+        return jsonify({'success': False, 'error': 'Command not found'}), 404
+    return jsonify({'success': False, 'error': 'Command already finished', 'status': cmd.get('status')}), 409
 
 @app.route('/api/commands/<client_id>/ack', methods=['POST'])
 @require_client_auth
 def ack_commands(client_id):
-    client = clients[client_id]
     data = request.json
     
-    command_ids = data.get('command_ids', [])
-    
+    ack_client_commands(client_id, data.get('command_ids', []))
+    return jsonify({'success': True})
+
+def ack_client_commands(client_id, command_ids):
     if not command_ids:
-        for cmd in client.get('commands', []):
-            if cmd.get('status') == 'pending':
-                cmd['status'] = 'completed'
-                cmd['completed_at'] = datetime.now().isoformat()
+        state.update_commands_by_status(client_id, 'pending', status='completed', completed_at=datetime.now().isoformat())
     else:
-        for cmd in client.get('commands', []):
-            if cmd.get('id') in command_ids and cmd.get('status') == 'pending':
-                cmd['status'] = 'completed'
-                cmd['completed_at'] = datetime.now().isoformat()
-    
-    return jsonify({'success': True})
+        for command_id in command_ids:
+            state.update_command(client_id, command_id, only_status=COMMAND_ACTIVE_STATUSES,
+                                 status='completed', completed_at=datetime.now().isoformat())
 
 @app.route('/api/command-result/<client_id>', methods=['POST'])
 @require_client_auth
 def command_result(client_id):
-    client = clients[client_id]
     data = request.json
     
-    command_id = data.get('command_id')
-    if not command_id:
+    if not data.get('command_id'):
         return jsonify({"error": "Missing command_id"}), 400
-        
-    stdout = data.get('stdout', '')
-    stderr = data.get('stderr', '')
-    exit_code = data.get('exit_code', -1)
-    
-    for cmd in client.get('commands', []):
-        if cmd.get('id') == command_id:
-            cmd['stdout'] = stdout
-            cmd['stderr'] = stderr
-            cmd['exit_code'] = exit_code
-            cmd['status'] = 'completed'
-            cmd['completed_at'] = datetime.now().isoformat()
-            
-            logger.info(f"Получен результат выполнения команды {command_id} от клиента {client_id}")
-            break
-    else:
-        logger.warning(f"Команда {command_id} не найдена для клиента {client_id}")
     
+    if not record_command_result(client_id, data):
+        return jsonify({'success': False, 'error': 'Command not found'}), 404
     return jsonify({'success': True})
 
+def record_command_result(client_id, data):
+    """Сохраняет результат команды. Возвращает False, если команда не найдена.
+    Результат уже завершённой или отменённой команды (повтор, запоздавший ответ) пропускается."""
+    command_id = data['command_id']
+    fields = {
+        'exit_code': data.get('exit_code', -1),
+        'status': 'cancelled' if data.get('cancelled') else 'completed',
+        'completed_at': datetime.now().isoformat()
+    }
+    # Под блокировкой вывода: запоздавшая часть вывода не допишется в уже перенесённый файл
+    try:
+        with _output_lock(command_id):
+            cmd = state.get_command(client_id, command_id)
+            if cmd is None:
+                logger.warning(f"Команда {command_id} не найдена для клиента {client_id}")
+                return False
+            if cmd.get('status') not in COMMAND_ACTIVE_STATUSES:
+                logger.info(f"Результат команды {command_id} пропущен: команда уже в статусе {cmd.get('status')}")
+                return True
+            
+            for stream in OUTPUT_STREAMS:
+                # Если вывод уже пришёл через /api/command-output, в результате его нет
+                if data.get('streamed'):
+                    fields.update(finish_streamed_output(client_id, command_id, cmd, stream))
+                else:
+                    fields.update(store_command_output(client_id, command_id, stream, data.get(stream, '')))
+            
+            # Для групповой команды сразу считается отпечаток вывода: по нему сводка группирует одинаковые выводы
+            if cmd.get('group_id'):
+                fields['output_digest'] = command_output_digest(dict(cmd, **fields))
+            
+            updated = state.update_command(client_id, command_id, only_status=COMMAND_ACTIVE_STATUSES, **fields)
+    finally:
+        with _output_locks_guard:
+            _output_locks.pop(command_id, None)
+    
+    if updated:
+        logger.info(f"Получен результат выполнения команды {command_id} от клиента {client_id}")
+    else:
+        logger.info(f"Результат команды {command_id} пропущен: команда завершилась раньше")
+    return True
+
 @app.route('/api/command-status/<client_id>')
 @require_teacher_auth
 def command_status(client_id):
-    if client_id not in clients:
+    if state.get_client(client_id) is None:
         return jsonify({"error": "Клиент не найден"}), 404
         
-    client = clients[client_id]
-    commands = client.get('commands', [])
+    commands = state.list_commands(client_id)
+    
+    return jsonify({
+        'client_id': client_id,
+        'commands': [command_metadata(cmd) for cmd in commands]
+    })
+
+def command_metadata(cmd):
+    """Запись команды без тел вывода: только размеры stdout/stderr."""
+    metadata = {field: cmd[field] for field in COMMAND_METADATA_FIELDS if field in cmd}
+    for stream in OUTPUT_STREAMS:
+        metadata[f"{stream}_size"] = command_output_size(cmd, stream)
+    return metadata
+
+@app.route('/api/command-history/<client_id>')
+@require_teacher_auth
+def command_history(client_id):
+    """Команды, изменившиеся после курсора since. Ответ содержит новый курсор; has_more — есть ещё страницы."""
+    if state.get_client(client_id) is None:
+        return jsonify({"error": "Клиент не найден"}), 404
+    
+    try:
+        since = int(request.args.get('since', 0))
+        limit = max(1, min(int(request.args.get('limit', COMMAND_HISTORY_PAGE)), COMMAND_HISTORY_PAGE_MAX))
+    except ValueError:
+        return jsonify({"error": "Invalid since or limit"}), 400
+    
+    changes = state.list_command_changes(client_id, since, limit + 1)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
     
     return jsonify({
         'client_id': client_id,
-        'commands': commands
+        'commands': [command_metadata(cmd) for cmd in changes],
+        'cursor': changes[-1]['rev'] if changes else since,
+        'has_more': has_more
     })
 
 @app.route('/api/command-details/<client_id>/<command_id>')
 @require_teacher_auth
 def command_details(client_id, command_id):
-    if client_id not in clients:
+    if state.get_client(client_id) is None:
         return jsonify({"error": "Клиент не найден"}), 404
         
-    client = clients[client_id]
-    for cmd in client.get('commands', []):
-        if cmd.get('id') == command_id:
-            return jsonify({
-                'command': cmd
-            })
+    cmd = state.get_command(client_id, command_id)
+    if cmd is not None:
+        for stream in OUTPUT_STREAMS:
+            if cmd.get(f"{stream}_file"):
+                size = cmd.get(f"{stream}_size", 0)
+                preview = read_command_output(cmd, stream, 0, OUTPUT_PREVIEW_LIMIT)
+                cmd[stream] = preview.decode('utf-8', errors='replace')
+                cmd[f"{stream}_truncated"] = size > len(preview)
+                del cmd[f"{stream}_file"]
+        return jsonify({
+            'command': cmd
+        })
     
     return jsonify({"error": "Команда не найдена"}), 404
 
+def command_output_digest(cmd):
+    digest = hashlib.sha1()
+    offset = 0
+    while True:
+        chunk = read_command_output(cmd, 'stdout', offset, OUTPUT_TAIL_LIMIT)
+        if not chunk:
+            break
+        digest.update(chunk)
+        offset += len(chunk)
+    return digest.hexdigest()[:12]
+
+class OutputOffsetMismatch(Exception):
+    def __init__(self, size):
+        super().__init__(f"Ожидалось смещение {size}")
+        self.size = size
+
+def _output_lock(command_id):
+    with _output_locks_guard:
+        if command_id not in _output_locks:
+            _output_locks[command_id] = threading.Lock()
+        return _output_locks[command_id]
+
+def output_file_path(client_id, command_id, stream):
+    return os.path.join(OUTPUT_ROOT, client_id, f"{command_id}.{stream}")
+
+def append_command_output(client_id, command_id, stream, offset, chunk):
+    """Дописывает кусок вывода команды. Возвращает новый размер в байтах или None, если команды нет."""
+    with _output_lock(command_id):
+        cmd = state.get_command(client_id, command_id)
+        if cmd is None:
+            return None
+        
+        size = cmd.get(f"{stream}_size", 0)
+        if offset + len(chunk) <= size:
+            # Повторная отправка уже принятого куска
+            return size
+        if offset != size:
+            raise OutputOffsetMismatch(size)
+        
+        new_size = size + len(chunk)
+        fields = {f"{stream}_size": new_size}
+        file_path = cmd.get(f"{stream}_file")
+        
+        # Смещения — байты файла, текст записи строится только по завершении команды
+        if not file_path:
+            file_path = output_file_path(client_id, command_id, stream)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            fields[stream] = ''
+            fields[f"{stream}_file"] = file_path
+        with open(file_path, 'ab' if size else 'wb') as f:
+            f.write(chunk)
+        
+        if cmd.get('status') in ('pending', 'queued'):
+            fields['status'] = 'running'
+            fields['started_at'] = datetime.now().isoformat()
+        
+        state.update_command(client_id, command_id, **fields)
+        return new_size
+
+def store_command_output(client_id, command_id, stream, text):
+    """Поля записи команды для вывода, пришедшего целиком. Большой вывод сразу пишется в файл."""
+    body = (text or '').encode('utf-8')
+    if len(body) <= OUTPUT_SPOOL_MEMORY:
+        return {stream: text or '', f"{stream}_size": len(body), f"{stream}_file": None}
+    
+    file_path = output_file_path(client_id, command_id, stream)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(body)
+    return {stream: '', f"{stream}_size": len(body), f"{stream}_file": file_path}
+
+def finish_streamed_output(client_id, command_id, cmd, stream):
+    """Поля записи для вывода, полностью пришедшего по частям: небольшой вывод переносится из файла
+    в запись команды, большой остаётся в файле."""
+    file_path = cmd.get(f"{stream}_file")
+    if not file_path or cmd.get(f"{stream}_size", 0) > OUTPUT_SPOOL_MEMORY:
+        return {}
+    try:
+        with open(file_path, 'rb') as f:
+            text = f.read().decode('utf-8', errors='replace')
+    except FileNotFoundError:
+        text = ''
+    fields = store_command_output(client_id, command_id, stream, text)
+    if fields[f"{stream}_file"] is None:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+    return fields
+
+def command_output_size(cmd, stream):
+    if f"{stream}_size" in cmd:
+        return cmd[f"{stream}_size"]
+    return len((cmd.get(stream) or '').encode('utf-8'))
+
+def read_command_output(cmd, stream, offset, limit):
+    file_path = cmd.get(f"{stream}_file")
+    if file_path:
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(limit)
+        except FileNotFoundError:
+            return b''
+    return (cmd.get(stream) or '').encode('utf-8')[offset:offset + limit]
+
+@app.route('/api/command-output/<client_id>', methods=['POST'])
+@require_client_auth
+def upload_command_output(client_id):
+    command_id = request.args.get('command_id')
+    stream = request.args.get('stream', 'stdout')
+    if not command_id or stream not in OUTPUT_STREAMS:
+        return jsonify({'success': False, 'error': 'Missing command_id or invalid stream'}), 400
+    
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid offset'}), 400
+    
+    if (request.content_length or 0) > OUTPUT_MAX_CHUNK:
+        return jsonify({'success': False, 'error': 'Chunk too large'}), 413
+    
+    chunk = request.get_data()
+    try:
+        size = append_command_output(client_id, command_id, stream, offset, chunk)
+    except OutputOffsetMismatch as e:
+        return jsonify({'success': False, 'error': 'Offset mismatch', 'size': e.size}), 409
+    
+    if size is None:
+        return jsonify({'success': False, 'error': 'Command not found'}), 404
+    
+    return jsonify({'success': True, 'size': size})
+
+@app.route('/api/command-output/<client_id>/<command_id>')
+@require_teacher_auth
+def tail_command_output(client_id, command_id):
+    """Отдаёт вывод команды начиная с байтового смещения; отрицательное смещение считается от конца.
+    Поддерживает заголовок Range (bytes=...), тогда ответ 206 с Content-Range."""
+    cmd = state.get_command(client_id, command_id)
+    if cmd is None:
+        return jsonify({"error": "Команда не найдена"}), 404
+    
+    stream = request.args.get('stream', 'stdout')
+    if stream not in OUTPUT_STREAMS:
+        return jsonify({"error": "Invalid stream"}), 400
+    
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = max(0, min(int(request.args.get('limit', OUTPUT_TAIL_LIMIT)), OUTPUT_PREVIEW_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Invalid offset or limit"}), 400
+    
+    size = command_output_size(cmd, stream)
+    if request.range:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        offset, stop = byte_range
+        limit = min(stop - offset, OUTPUT_PREVIEW_LIMIT)
+    elif offset < 0:
+        offset = max(0, size + offset)
+    
+    data = read_command_output(cmd, stream, offset, limit)
+    
+    response = Response(data, content_type='text/plain; charset=utf-8')
+    response.headers['Accept-Ranges'] = 'bytes'
+    if request.range:
+        response.status_code = 206
+        response.headers['Content-Range'] = f"bytes {offset}-{offset + len(data) - 1}/{size}"
+    response.headers['X-Output-Offset'] = str(offset)
+    response.headers['X-Next-Offset'] = str(offset + len(data))
+    response.headers['X-Output-Size'] = str(size)
+    response.headers['X-Command-Status'] = cmd.get('status', '')
+    if cmd.get('exit_code') is not None:
+        response.headers['X-Exit-Code'] = str(cmd['exit_code'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/stream/<client_id>')
 @require_teacher_auth
 def stream_client(client_id):
-    if client_id not in clients:
+    client = state.get_client(client_id)
+    if client is None:
         flash('Клиент не найден')
         logger.warning(f"Попытка доступа к несуществующему клиенту {client_id}")
         return redirect(url_for('dashboard'))
     
-    if client_id not in ffmpeg_processes:
+    proxy_info = client.get('proxy')
+    if not proxy_info:
         flash('Стрим не настроен')
         logger.warning(f"Стрим не настроен для клиента {client_id}")
         return redirect(url_for('dashboard'))
     
-    hls_path = ffmpeg_processes[client_id].get('hls_path', '')
+    hls_path = proxy_info.get('hls_path', '')
     if not hls_path:
         flash('Стрим не настроен')
         logger.warning(f"Путь к HLS не указан для клиента {client_id}")
@@ -574,13 +1675,15 @@ def stream_client(client_id):
     
     diagnostic_info = {
         'client_id': client_id,
-        'stream_url': clients[client_id].get('stream_info', {}).get('url', 'Не указан'),
+        'stream_url': (client.get('stream_info') or {}).get('url', 'Не указан'),
         'playlist_exists': os.path.exists(playlist_file),
         'segment_count': len(segment_files),
-        'proxy_start_time': ffmpeg_processes[client_id].get('start_time', 'Не указано'),
+        'proxy_start_time': proxy_info.get('start_time', 'Не указано'),
         'playlist_url': playlist_url
     }
     
+    mark_client_watched(client_id, streaming=True)
+    
     return render_template('stream.html', 
                            client_id=client_id, 
                            playlist_url=playlist_url, 
@@ -589,26 +1692,36 @@ def stream_client(client_id):
 @app.route('/diagnostic/<client_id>')
 @require_teacher_auth
 def diagnostic(client_id):
-    if client_id not in clients:
+    client = state.get_client(client_id)
+    if client is None:
         return jsonify({'error': 'Client not found'}), 404
     
     result = {
         'client': {
             'id': client_id,
-            'last_seen': clients[client_id].get('last_seen', datetime.min).isoformat(),
-            'stream_info': clients[client_id].get('stream_info')
+            'last_seen': client.get('last_seen', datetime.min).isoformat(),
+            'stream_info': client.get('stream_info')
         },
+        'stream_status': stream_status(client_id, client),
         'ffmpeg': {}
     }
     
-    if client_id in ffmpeg_processes:
-        process_info = ffmpeg_processes[client_id]
+    process_info = client.get('proxy')
+    if process_info:
         hls_path = process_info.get('hls_path', '')
+        owner = state.lease_owner(proxy_lease_name(client_id))
+        if client_id in ffmpeg_processes:
+            process_running = ffmpeg_processes[client_id]['process'].poll() is None
+        else:
+            # Процесс принадлежит другому воркеру: он жив, пока продлевается аренда
+            process_running = owner is not None and owner == process_info.get('owner')
         result['ffmpeg'] = {
             'proxy_port': process_info.get('proxy_port'),
             'hls_path': hls_path,
             'start_time': process_info.get('start_time'),
-            'process_running': process_info.get('process').poll() is None
+            'ready_at': process_info.get('ready_at'),
+            'owner': owner,
+            'process_running': process_running
         }
         
         if hls_path:
@@ -633,14 +1746,65 @@ def diagnostic(client_id):
                     'size': os.path.getsize(segment),
                     'mtime': datetime.fromtimestamp(os.path.getmtime(segment)).isoformat()
                 })
+            
+            if result['hls']['playlist_exists']:
+                result['health'] = stream_health(hls_path)
     
     return jsonify(result)
 
-os.makedirs(os.path.join('static', 'streams'), exist_ok=True)
+@app.route('/api/stream-health/<client_id>')
+@require_teacher_auth
+def get_stream_health(client_id):
+    client = state.get_client(client_id)
+    if client is None:
+        return jsonify({'error': 'Client not found'}), 404
+    
+    hls_path = (client.get('proxy') or {}).get('hls_path')
+    if not hls_path:
+        return jsonify({'error': 'Стрим не запущен'}), 404
+    
+    health = stream_health(hls_path)
+    if 'error' in health:
+        return jsonify(health), 404
+    # Подробности по сегментам нужны только в диагностике
+    health.pop('segments')
+    return jsonify(health)
+
+@app.route('/api/stream-status/<client_id>')
+@require_client_auth
+def get_stream_status(client_id):
+    return jsonify(stream_status(client_id, state.get_client(client_id)))
+
+@app.route('/api/stream-status/<client_id>/stream')
+@require_teacher_auth
+def stream_status_stream(client_id):
+    """Server-Sent Events: статус трансляции при каждом изменении, пока прокси не выйдет в эфир или не упадёт."""
+    if state.get_client(client_id) is None:
+        return jsonify({'error': 'Client not found'}), 404
+    
+    def generate():
+        last_payload = None
+        deadline = time.time() + STREAM_STATUS_TIMEOUT
+        while True:
+            status = stream_status(client_id, state.get_client(client_id))
+            payload = json.dumps(status)
+            if payload != last_payload:
+                last_payload = payload
+                yield f"data: {payload}\n\n"
+            if status['status'] in ('live', 'failed') or time.time() >= deadline:
+                yield "event: end\ndata: {}\n\n"
+                return
+            time.sleep(STREAM_STATUS_INTERVAL)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+os.makedirs(HLS_ROOT, exist_ok=True)
 
 @app.route('/hls/<client_id>/<path:filename>')
 def serve_hls(client_id, filename):
-    file_path = os.path.join('static', 'streams', client_id, filename)
+    # HLS_ROOT общий для всех воркеров, поэтому сегменты отдаёт любой из них
+    file_path = os.path.join(HLS_ROOT, client_id, filename)
     
     if not os.path.exists(file_path):
         logger.warning(f"Запрошенный HLS файл не найден: {file_path}")
@@ -648,40 +1812,122 @@ def serve_hls(client_id, filename):
         
     logger.debug(f"Отправка HLS файла: {file_path}, размер: {os.path.getsize(file_path)}")
     
+    mimetype = hls_mimetype(filename)
     if filename.endswith('.m3u8'):
-        mimetype = 'application/vnd.apple.mpegurl'
-        
         with open(file_path, 'r') as f:
             content = f.read()
-            
-        modified_content = content
-        for line in content.split('\n'):
-            if line.endswith('.ts') and not line.startswith('http') and not line.startswith('/'):
-                segment_name = line.strip()
-                modified_content = modified_content.replace(
-                    segment_name, 
-                    f"/hls/{client_id}/{segment_name}"
-                )
-        
-        response = Response(modified_content, mimetype=mimetype)
-    elif filename.endswith('.ts'):
-        mimetype = 'video/mp2t'
-        response = send_file(file_path, mimetype=mimetype)
+        
+        response = Response(rewrite_hls_playlist(content, client_id), mimetype=mimetype)
     else:
-        mimetype = 'application/octet-stream'
-        response = send_file(file_path, mimetype=mimetype)
+        # send_file считает относительные пути от корня приложения, а HLS_ROOT — от рабочей директории
+        response = send_file(os.path.abspath(file_path), mimetype=mimetype)
     
-    response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers.update(hls_headers(filename))
+        
+    return response
+
+def hls_mimetype(filename):
+    if filename.endswith('.m3u8'):
+        return 'application/vnd.apple.mpegurl'
+    if filename.endswith('.ts'):
+        return 'video/mp2t'
+    return 'application/octet-stream'
+
+def rewrite_hls_playlist(content, client_id):
+    """Делает пути к сегментам в плейлисте абсолютными (/hls/<client_id>/...)."""
+    modified_content = content
+    for line in content.split('\n'):
+        if line.endswith('.ts') and not line.startswith('http') and not line.startswith('/'):
+            segment_name = line.strip()
+            modified_content = modified_content.replace(
+                segment_name, 
+                f"/hls/{client_id}/{segment_name}"
+            )
+    return modified_content
+
+def hls_headers(filename):
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type'
+    }
     
     if filename.endswith('.m3u8'):
-        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+        headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     else:
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        
+        headers['Cache-Control'] = 'public, max-age=3600'
+    return headers
+
+@app.route('/api/recording/<client_id>', methods=['POST'])
+@require_teacher_auth
+def set_recording(client_id):
+    """Включает или выключает запись стрима. Прокси перезапускает его владелец, как при перерегистрации стрима."""
+    client = state.get_client(client_id)
+    if client is None:
+        return jsonify({'success': False, 'error': 'Client not found'}), 404
+    
+    data = request.get_json(silent=True) or request.form
+    enabled = str(data.get('enabled', '')).lower() in ('1', 'true', 'on')
+    fields = {'recording': enabled}
+    proxy_request = client.get('proxy_request')
+    if proxy_request and enabled != recording_enabled(client):
+        fields['proxy_request'] = dict(proxy_request, generation=state.next_counter(f"proxy_generation:{client_id}", 1))
+    state.update_client(client_id, **fields)
+    
+    logger.info(f"Запись стрима клиента {client_id} {'включена' if enabled else 'выключена'}")
+    return jsonify({'success': True, 'recording': enabled})
+
+@app.route('/api/recordings/<client_id>')
+@require_teacher_auth
+def list_recordings(client_id):
+    client = state.get_client(client_id)
+    spans = recording.recording_spans(os.path.join(RECORDING_ROOT, secure_filename(client_id)), RECORDING_SEGMENT_TIME)
+    if client is None and not spans:
+        return jsonify({'error': 'Client not found'}), 404
+    
+    return jsonify({
+        'client_id': client_id,
+        'recording': recording_enabled(client),
+        'bytes': sum(span['size'] for span in spans),
+        'files': [{
+            'file': span['file'],
+            'start': span['start'].isoformat(),
+            'end': (span['start'] + timedelta(seconds=span['duration'])).isoformat(),
+            'size': span['size'],
+            'keyframes': span['keyframes']
+        } for span in spans]
+    })
+
+@app.route('/recordings/<client_id>/vod.m3u8')
+@require_teacher_auth
+def recording_playlist(client_id):
+    """VOD плейлист записи за интервал ?start=...&end=... (ISO время); без параметров — весь архив."""
+    try:
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid start or end'}), 400
+    
+    playlist = recording.vod_playlist(os.path.join(RECORDING_ROOT, secure_filename(client_id)), RECORDING_SEGMENT_TIME,
+                                      f"/recordings/{client_id}", start, end)
+    if playlist is None:
+        return jsonify({'error': 'Нет записи за этот интервал'}), 404
+    
+    response = Response(playlist, mimetype=hls_mimetype('vod.m3u8'))
+    response.headers['Cache-Control'] = 'no-cache'
     return response
 
+@app.route('/recordings/<client_id>/<filename>')
+@require_teacher_auth
+def serve_recording(client_id, filename):
+    """Файл записи; плеер запрашивает куски между ключевыми кадрами через Range."""
+    if recording.recording_file_start(filename) is None:
+        return "File not found", 404
+    file_path = os.path.join(RECORDING_ROOT, secure_filename(client_id), secure_filename(filename))
+    if not os.path.exists(file_path):
+        return "File not found", 404
+    return send_file(os.path.abspath(file_path), mimetype=hls_mimetype(filename), conditional=True)
+
 @app.route('/api/send-notification/<client_id>', methods=['POST'])
 @require_teacher_auth
 def send_notification(client_id):
@@ -692,13 +1938,10 @@ def send_notification(client_id):
         if not message:
             return jsonify({'success': False, 'error': 'Missing message'})
         
-        if client_id not in clients:
+        if state.get_client(client_id) is None:
             return jsonify({'success': False, 'error': 'Client not found'})
         
-        if 'notifications' not in clients[client_id]:
-            clients[client_id]['notifications'] = []
-        
-        clients[client_id]['notifications'].append({
+        state.add_notification(client_id, {
             'id': str(uuid.uuid4()),
             'message': message,
             'timestamp': datetime.now().isoformat()
@@ -712,55 +1955,36 @@ def send_notification(client_id):
 def check_notifications(client_id):
     try:
         token = request.args.get('token')
-        if not token or client_id not in clients or clients[client_id].get('token') != token:
+        client = state.get_client(client_id)
+        if not token or client is None or client.get('token') != token:
             return jsonify({'success': False, 'error': 'Invalid token'}), 401
             
-        since_str = request.args.get('since', None)
-        
-        if not since_str:
-            since_time = datetime.min
-        else:
-            try:
-                since_time = datetime.fromisoformat(since_str)
-            except ValueError:
-                since_time = datetime.now() - timedelta(minutes=5)
-        
-        notifications = clients[client_id].get('notifications', [])
-        
-        new_notifications = []
-        for notification in notifications:
-            try:
-                notification_time = datetime.fromisoformat(notification['timestamp'])
-                if notification_time > since_time:
-                    new_notifications.append(notification)
-            except (ValueError, KeyError):
-                pass
+        since_time = parse_notifications_since(request.args.get('since', None))
         
-        if new_notifications:
-            clients[client_id]['notifications'] = [
-                n for n in clients[client_id].get('notifications', []) 
-                if n not in new_notifications
-            ]
+        new_notifications = state.take_notifications(client_id, since_time)
             
         return jsonify({'success': True, 'notifications': new_notifications})
     except Exception as e:
         logger.error(f"Ошибка при получении уведомлений: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def parse_notifications_since(since_str):
+    if not since_str:
+        return datetime.min
+    try:
+        return datetime.fromisoformat(since_str)
+    except ValueError:
+        return datetime.now() - timedelta(minutes=5)
+
 @app.route('/api/heartbeat/<client_id>', methods=['POST'])
 def heartbeat(client_id):
     try:
-        if client_id not in clients:
+        if not state.touch_client(client_id):
             return jsonify({'success': False, 'error': 'Client not found'}), 404
         
-        clients[client_id]['last_seen'] = datetime.now()
-        
         system_info = request.json
         if system_info:
-            if 'system_info' not in clients[client_id]:
-                clients[client_id]['system_info'] = {}
-            
-            clients[client_id]['system_info'].update(system_info)
+            state.merge_client_field(client_id, 'system_info', system_info)
         
         return jsonify({'success': True})
     except Exception as e:
@@ -770,41 +1994,109 @@ def heartbeat(client_id):
 @app.route('/api/update-screen-info/<client_id>', methods=['POST'])
 def update_screen_info(client_id):
     try:
-        if client_id not in clients:
+        if state.get_client(client_id) is None:
             return jsonify({'success': False, 'error': 'Client not found'}), 404
         
         screen_info = request.json
         if screen_info:
-            if 'screen_info' not in clients[client_id]:
-                clients[client_id]['screen_info'] = {}
-            
-            clients[client_id]['screen_info'].update(screen_info)
+            state.merge_client_field(client_id, 'screen_info', screen_info)
         
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Ошибка при обновлении информации об экране: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/client-state/<client_id>', methods=['POST'])
+@require_client_auth
+def sync_client_state(client_id):
+    """Версионированная синхронизация system_info/screen_info: клиент присылает только изменения."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Invalid state data'}), 400
+    
+    try:
+        result, current = apply_client_state_update(client_id, data)
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Missing or invalid epoch/seq'}), 400
+    
+    if result == 'missing':
+        return jsonify({'success': False, 'error': 'Client not found'}), 404
+    if result == 'stale':
+        return jsonify({'success': False, 'error': 'Stale state version', 'version': current}), 409
+    if result == 'keyframe_required':
+        return jsonify({'success': False, 'error': 'Keyframe required', 'keyframe_required': True}), 409
+    
+    return jsonify({'success': True, 'version': current})
+
+def apply_client_state_update(client_id, data):
+    version = [int(data['epoch']), int(data['seq'])]
+    fields = {field: data[field] for field in CLIENT_STATE_FIELDS if isinstance(data.get(field), dict)}
+    return state.apply_client_state(client_id, version, fields, bool(data.get('keyframe')))
+
+@app.route('/api/client-journal/<client_id>', methods=['POST'])
+@require_client_auth
+def replay_client_journal(client_id):
+    """Пакетная доставка сообщений, накопленных клиентом без связи с сервером.
+    Для каждой записи возвращает ok, rejected (повторять бессмысленно) или retry."""
+    data = request.get_json(silent=True) or {}
+    entries = data.get('entries')
+    if not isinstance(entries, list) or len(entries) > JOURNAL_BATCH_MAX:
+        return jsonify({'success': False, 'error': 'Invalid entries'}), 400
+    
+    results = {}
+    for entry in entries:
+        try:
+            results[str(entry['seq'])] = apply_journal_entry(client_id, entry['kind'], entry.get('payload') or {})
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Некорректная запись журнала клиента {client_id}: {e}")
+            results[str(entry.get('seq') if isinstance(entry, dict) else None)] = 'rejected'
+        except Exception as e:
+            logger.error(f"Ошибка применения записи журнала клиента {client_id}: {e}")
+            results[str(entry['seq'])] = 'retry'
+    
+    logger.info(f"Клиент {client_id} доставил {len(entries)} записей журнала")
+    return jsonify({'success': True, 'results': results})
+
+def apply_journal_entry(client_id, kind, payload):
+    if kind == 'result':
+        return 'ok' if record_command_result(client_id, payload) else 'rejected'
+    
+    if kind == 'ack':
+        ack_client_commands(client_id, payload.get('command_ids') or [])
+        return 'ok'
+    
+    if kind == 'output':
+        if payload['stream'] not in OUTPUT_STREAMS:
+            return 'rejected'
+        offset = int(payload['offset'])
+        chunk = base64.b64decode(payload['data'])
+        try:
+            size = append_command_output(client_id, payload['command_id'], payload['stream'], offset, chunk)
+        except OutputOffsetMismatch as e:
+            if e.size < offset:
+                # Предыдущий кусок потерян, дописать этот без разрыва нельзя
+                return 'rejected'
+            size = append_command_output(client_id, payload['command_id'], payload['stream'],
+                                         e.size, chunk[e.size - offset:])
+        return 'ok' if size is not None else 'rejected'
+    
+    if kind == 'state':
+        result, _ = apply_client_state_update(client_id, payload)
+        # Устаревшее состояние уже перекрыто более новым — доставлять его не нужно
+        return 'ok' if result == 'applied' else 'rejected'
+    
+    return 'rejected'
+
 @app.route('/api/get-processes/<client_id>', methods=['GET'])
 @require_teacher_auth
 def get_processes(client_id):
-    if client_id not in clients:
+    if state.get_client(client_id) is None:
         return jsonify({'success': False, 'error': 'Client not found'}), 404
     
-    command_id = str(uuid.uuid4())
-    
-    if 'commands' not in clients[client_id]:
-        clients[client_id]['commands'] = []
-    
-    command = {
-        'id': command_id,
-        'command': "tasklist /FO CSV",  
-        'timestamp': datetime.now().isoformat(),
-        'status': 'pending',
-        'type': 'get_processes'  
-    }
+    command = build_command('get_processes')
+    command_id = command['id']
     
-    clients[client_id]['commands'].append(command)
+    state.add_command(client_id, command)
     
     return jsonify({
         'success': True, 
@@ -815,7 +2107,7 @@ def get_processes(client_id):
 @app.route('/api/kill-process/<client_id>/<process_id>', methods=['POST'])
 @require_teacher_auth
 def kill_process(client_id, process_id):
-    if client_id not in clients:
+    if state.get_client(client_id) is None:
         return jsonify({'success': False, 'error': 'Client not found'}), 404
     
     try:
@@ -823,20 +2115,10 @@ def kill_process(client_id, process_id):
     except ValueError:
         return jsonify({'success': False, 'error': 'Invalid process ID'}), 400
     
-    command_id = str(uuid.uuid4())
-    
-    if 'commands' not in clients[client_id]:
-        clients[client_id]['commands'] = []
-    
-    command = {
-        'id': command_id,
-        'command': f"taskkill /F /PID {pid}",  
-        'timestamp': datetime.now().isoformat(),
-        'status': 'pending',
-        'type': 'kill_process'  
-    }
+    command = build_command('kill_process', pid=pid)
+    command_id = command['id']
     
-    clients[client_id]['commands'].append(command)
+    state.add_command(client_id, command)
     
     return jsonify({
         'success': True, 
@@ -844,5 +2126,125 @@ def kill_process(client_id, process_id):
         'message': f'Команда завершения процесса {pid} отправлена'
     })
 
+def normalize_process_record(record):
+    """Приводит запись процесса от клиента к фиксированным типам полей."""
+    return {
+        'pid': int(record['pid']),
+        'create_time': float(record.get('create_time') or 0),
+        'name': str(record.get('name') or ''),
+        'username': str(record['username']) if record.get('username') else None,
+        'rss': int(record.get('rss') or 0),
+        'cpu_percent': float(record.get('cpu_percent') or 0),
+        'status': str(record.get('status') or '')
+    }
+
+@app.route('/api/thumbnail/<client_id>', methods=['POST'])
+@require_client_auth
+def upload_thumbnail(client_id):
+    if (request.content_length or 0) > THUMBNAIL_MAX_BYTES:
+        return jsonify({'success': False, 'error': 'Thumbnail too large'}), 413
+    if request.mimetype not in THUMBNAIL_MIMETYPES:
+        return jsonify({'success': False, 'error': 'Unsupported thumbnail type'}), 415
+    
+    image = request.get_data()
+    if not image:
+        return jsonify({'success': False, 'error': 'Empty thumbnail'}), 400
+    
+    etag = hashlib.sha1(image).hexdigest()[:16]
+    state.set_thumbnail(client_id, {
+        'image': image,
+        'mimetype': request.mimetype,
+        'etag': etag,
+        'phash': request.args.get('hash'),
+        'updated_at': datetime.now().isoformat()
+    })
+    logger.debug(f"Миниатюра экрана клиента {client_id}: {len(image)} байт, хэш {request.args.get('hash')}")
+    return jsonify({'success': True, 'etag': etag})
+
+@app.route('/api/thumbnail/<client_id>')
+@require_teacher_auth
+def client_thumbnail(client_id):
+    """Последняя миниатюра экрана клиента. Панель передаёт If-None-Match и получает 304, пока картинка не сменилась."""
+    thumbnail = state.get_thumbnail(client_id)
+    if thumbnail is None:
+        return jsonify({"error": "Миниатюра не найдена"}), 404
+    
+    response = Response(thumbnail['image'], mimetype=thumbnail['mimetype'])
+    response.set_etag(thumbnail['etag'])
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Thumbnail-Updated'] = thumbnail['updated_at']
+    return response.make_conditional(request)
+
+@app.route('/api/process-snapshot/<client_id>', methods=['POST'])
+@require_client_auth
+def upload_process_snapshot(client_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Invalid snapshot data'}), 400
+    
+    try:
+        delta = {
+            'full': bool(data.get('full')),
+            'base_version': data.get('base_version'),
+            'upserts': [normalize_process_record(record) for record in data.get('upserts', [])],
+            'removed': [process_key(pid, create_time) for pid, create_time in data.get('removed', [])]
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Invalid process record: {e}'}), 400
+    
+    applied, version = state.apply_process_delta(client_id, delta)
+    if not applied:
+        # Клиент считал дельту от другого снимка и должен прислать полный список
+        return jsonify({'success': False, 'error': 'Snapshot version mismatch', 'version': version}), 409
+    
+    logger.debug(f"Снимок процессов клиента {client_id}: версия {version}, "
+                 f"изменено {len(delta['upserts'])}, удалено {len(delta['removed'])}")
+    return jsonify({'success': True, 'version': version})
+
+@app.route('/api/processes/<client_id>')
+@require_teacher_auth
+def query_processes(client_id):
+    if state.get_client(client_id) is None:
+        return jsonify({'success': False, 'error': 'Client not found'}), 404
+    
+    sort = request.args.get('sort', 'rss')
+    if sort not in PROCESS_SORT_FIELDS:
+        return jsonify({'success': False, 'error': 'Invalid sort field'}), 400
+    descending = request.args.get('order', 'desc') != 'asc'
+    
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', PROCESS_PAGE_DEFAULT))), PROCESS_PAGE_MAX)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid offset or limit'}), 400
+    
+    snapshot = state.get_process_snapshot(client_id)
+    if snapshot is None:
+        return jsonify({'success': True, 'version': 0, 'updated_at': None,
+                        'total': 0, 'matched': 0, 'processes': []})
+    
+    processes = list(snapshot['processes'].values())
+    query = request.args.get('q', '').strip().lower()
+    if query:
+        processes = [proc for proc in processes
+                     if query in proc['name'].lower()
+                     or query in (proc.get('username') or '').lower()
+                     or query == str(proc['pid'])]
+    
+    if sort in ('name', 'username'):
+        processes.sort(key=lambda proc: (proc.get(sort) or '').lower(), reverse=descending)
+    else:
+        processes.sort(key=lambda proc: proc.get(sort) or 0, reverse=descending)
+    
+    return jsonify({
+        'success': True,
+        'version': snapshot['version'],
+        'updated_at': snapshot['updated_at'],
+        'total': len(snapshot['processes']),
+        'matched': len(processes),
+        'offset': offset,
+        'processes': processes[offset:offset + limit]
+    })
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0') 
\ No newline at end of file
@@ -0,0 +1,740 @@
+import os
+import io
+import re
+import sys
+import json
+import asyncio
+import logging
+from datetime import datetime
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import app as flask_app
+import compression
+import admission
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный режим сервера: клиентское API и /hls обслуживаются одним event loop,
+# остальные маршруты передаются во Flask приложение через пул потоков.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# GET /api/commands и /api/check-notifications принимают параметр wait=<секунды>:
+# запрос ждёт новых данных до указанного времени (long poll), не занимая поток.
+
+state = flask_app.state
+
+LONG_POLL_MAX = 30
+LONG_POLL_STEP = 0.5
+MAX_BODY_SIZE = 64 * 1024
+FORWARD_MAX_BODY_SIZE = 16 * 1024 * 1024
+# Потоковые ответы Flask (SSE панели учителя) спят между событиями минутами. Их шаги идут в отдельном
+# ограниченном пуле, чтобы открытые панели не занимали пул, через который идут обращения к состоянию
+STREAM_WORKERS = 8
+_stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix='flask-stream')
+
+# Прокси FFmpeg этого процесса: client_id -> {'process', 'hls_path', 'generation', ...}
+async_proxies = {}
+_proxy_locks = {}
+# Запуски прокси идут фоновыми задачами, не больше одной на клиента: client_id -> asyncio.Task.
+# Задач не больше PROXY_QUEUE_SIZE, одновременно запускаются PROXY_START_CONCURRENCY прокси
+_proxy_tasks = {}
+_proxy_start_slots = asyncio.Semaphore(flask_app.PROXY_START_CONCURRENCY)
+_supervisor_task = None
+# Ожидающие длинные опросы: (kind, client_id) -> множество asyncio.Event. Состояние в памяти сообщает
+# об изменениях через add_change_listener, и опрос просыпается сразу; для SQLite (изменения могут прийти
+# из другого процесса) остаётся перечитывание раз в LONG_POLL_STEP
+_change_waiters = {}
+_change_loop = None
+
+# Прокси ведёт асинхронный супервизор, потоковый супервизор Flask не нужен
+flask_app.use_external_proxy_supervisor()
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        self.args = {key: values[-1] for key, values in query.items()}
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+
+    async def body(self, limit=MAX_BODY_SIZE):
+        body = await read_body(self.receive, limit)
+        encoding = self.headers.get('content-encoding')
+        if encoding:
+            body = await call(compression.decompress, body, encoding, compression.MAX_DECOMPRESSED_SIZE)
+        return body
+
+    async def json(self):
+        body = await self.body()
+        if not body:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+
+async def read_body(receive, limit):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def call(func, *args, **kwargs):
+    """Выполняет блокирующий вызов (хранилище состояния, файлы) вне event loop."""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def send_response(send, status, body, content_type, headers=None, request=None):
+    headers = dict(headers or {})
+    headers['Accept-Encoding'] = ', '.join(compression.supported_encodings())
+    if request is not None and compression.should_compress(content_type, len(body)):
+        encoding = compression.choose_encoding(request.headers.get('accept-encoding'))
+        if encoding:
+            body = await call(compression.compress, body, encoding)
+            headers['Content-Encoding'] = encoding
+            headers['Vary'] = 'Accept-Encoding'
+
+    response_headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(len(body)).encode('latin-1'))
+    ]
+    for name, value in headers.items():
+        response_headers.append((name.lower().encode('latin-1'), str(value).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200, request=None, headers=None):
+    await send_response(send, status, json.dumps(data).encode('utf-8'), 'application/json', headers, request)
+
+
+async def send_retry_later(send, status, error, wait, jitter):
+    headers = admission.retry_headers(wait, jitter)
+    await send_json(send, {'error': error, 'retry_after': int(headers['Retry-After']), 'retry_jitter': jitter},
+                    status, headers=headers)
+
+
+async def poll_headers(client_id):
+    """Подсказки клиенту: интервалы опроса и профиль кодировщика (см. app.client_hint_headers)."""
+    return await call(flask_app.client_hint_headers, client_id) or None
+
+
+async def authenticate_client(request, client_id):
+    """Аналог require_client_auth: проверяет токен и обновляет last_seen."""
+    token = request.args.get('token')
+    if not client_id or not token:
+        return None, ({"error": "Missing client_id or token"}, 401)
+
+    client = await call(state.get_client, client_id)
+    if client is None:
+        return None, ({"error": "Unknown client_id"}, 401)
+    if client.get('token') != token:
+        return None, ({"error": "Invalid token"}, 401)
+
+    await call(state.touch_client, client_id)
+    return client, None
+
+
+def long_poll_timeout(request):
+    try:
+        return max(0.0, min(float(request.args.get('wait', 0)), LONG_POLL_MAX))
+    except ValueError:
+        return 0.0
+
+
+def _wake_waiters(kind, client_id):
+    for event in _change_waiters.get((kind, client_id), ()):
+        event.set()
+
+
+def state_changed(kind, client_id):
+    """Вызывается бэкендом состояния из любого потока, под его блокировкой."""
+    if (kind, client_id) not in _change_waiters or _change_loop is None:
+        return
+    try:
+        _change_loop.call_soon_threadsafe(_wake_waiters, kind, client_id)
+    except RuntimeError:
+        # Event loop уже закрыт: будить некого
+        pass
+
+
+def ensure_change_listener():
+    global _change_loop
+    if not hasattr(state, 'add_change_listener'):
+        return
+    if _change_loop is None:
+        state.add_change_listener(state_changed)
+    _change_loop = asyncio.get_running_loop()
+
+
+class ChangeSubscription:
+    """Подписка длинного опроса на изменения (kind, client_id). Оформляется до чтения состояния,
+    чтобы изменение между чтением и ожиданием не потерялось."""
+
+    def __init__(self, kind, client_id):
+        self.key = (kind, client_id)
+        self.event = asyncio.Event() if _change_loop is not None else None
+
+    def __enter__(self):
+        if self.event:
+            _change_waiters.setdefault(self.key, set()).add(self.event)
+        return self
+
+    def __exit__(self, *exc):
+        if self.event:
+            waiters = _change_waiters[self.key]
+            waiters.discard(self.event)
+            if not waiters:
+                del _change_waiters[self.key]
+
+    async def wait(self, timeout):
+        if timeout <= 0:
+            return
+        if self.event is None:
+            await asyncio.sleep(min(LONG_POLL_STEP, timeout))
+            return
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+
+async def get_commands(request, send, client_id):
+    client, error = await authenticate_client(request, client_id)
+    if error:
+        return await send_json(send, *error)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + long_poll_timeout(request)
+    with ChangeSubscription('commands', client_id) as changes:
+        while True:
+            batch = flask_app.commands_for_client(await call(state.list_active_commands, client_id))
+            if batch['commands'] or batch['cancel'] or loop.time() >= deadline:
+                break
+            await changes.wait(deadline - loop.time())
+
+    await send_json(send, batch, request=request, headers=await poll_headers(client_id))
+
+
+async def check_notifications(request, send, client_id):
+    try:
+        token = request.args.get('token')
+        client = await call(state.get_client, client_id)
+        if not token or client is None or client.get('token') != token:
+            return await send_json(send, {'success': False, 'error': 'Invalid token'}, 401)
+
+        since_time = flask_app.parse_notifications_since(request.args.get('since', None))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + long_poll_timeout(request)
+        with ChangeSubscription('notifications', client_id) as changes:
+            while True:
+                new_notifications = await call(state.take_notifications, client_id, since_time)
+                if new_notifications or loop.time() >= deadline:
+                    break
+                await changes.wait(deadline - loop.time())
+
+        await send_json(send, {'success': True, 'notifications': new_notifications},
+                        request=request, headers=await poll_headers(client_id))
+    except Exception as e:
+        logger.error(f"Ошибка при получении уведомлений: {e}")
+        await send_json(send, {'success': False, 'error': str(e)}, 500)
+
+
+async def heartbeat(request, send, client_id):
+    try:
+        if not await call(state.touch_client, client_id):
+            return await send_json(send, {'success': False, 'error': 'Client not found'}, 404)
+
+        system_info = await request.json()
+        if system_info:
+            await call(state.merge_client_field, client_id, 'system_info', system_info)
+
+        await send_json(send, {'success': True}, headers=await poll_headers(client_id))
+    except compression.DecompressionError as e:
+        await send_json(send, {'success': False, 'error': str(e)}, e.status)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке heartbeat: {e}")
+        await send_json(send, {'success': False, 'error': str(e)}, 500)
+
+
+async def register_stream(request, send, client_id):
+    client, error = await authenticate_client(request, client_id)
+    if error:
+        return await send_json(send, *error)
+
+    try:
+        stream_data = await request.json()
+        if not stream_data:
+            return await send_json(send, {"error": "No stream data provided"}, 400)
+
+        stream_type = stream_data.get('stream_type')
+        stream_url = stream_data.get('stream_url')
+
+        if not stream_type or not stream_url:
+            return await send_json(send, {"error": "Invalid stream data"}, 400)
+
+        backlog = len(_proxy_tasks)
+        if client_id not in _proxy_tasks and backlog >= flask_app.PROXY_QUEUE_SIZE:
+            wait = flask_app.proxy_backlog_wait(backlog)
+            logger.warning(f"Очередь запусков прокси заполнена ({backlog}), регистрация стрима {client_id} отложена")
+            return await send_retry_later(send, 503, 'Proxy start queue is full', wait, wait)
+
+        generation = await call(state.next_counter, f"proxy_generation:{client_id}", 1)
+        await call(
+            state.update_client,
+            client_id,
+            stream_info={
+                'type': stream_type,
+                'url': stream_url,
+                'registered_at': datetime.now().isoformat()
+            },
+            proxy_request={'url': stream_url, 'generation': generation}
+        )
+
+        schedule_async_proxy(client_id)
+
+        logger.info(f"Клиент {client_id} зарегистрировал стрим: {stream_type}, {stream_url}")
+
+        client = await call(state.get_client, client_id)
+        await send_json(send, {"success": True, "message": "Stream registration accepted",
+                               **flask_app.stream_status(client_id, client)},
+                        202, headers=await poll_headers(client_id))
+    except compression.DecompressionError as e:
+        await send_json(send, {"error": str(e)}, e.status)
+    except Exception as e:
+        logger.error(f"Ошибка при регистрации стрима: {e}")
+        await send_json(send, {"error": f"Error registering stream: {str(e)}"}, 500)
+
+
+async def get_stream_status(request, send, client_id):
+    """Статус трансляции; с wait=<секунды> ждёт, пока прокси не выйдет в эфир или не упадёт."""
+    client, error = await authenticate_client(request, client_id)
+    if error:
+        return await send_json(send, *error)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + long_poll_timeout(request)
+    with ChangeSubscription('client', client_id) as changes:
+        while True:
+            # Перечитываем после подписки: статус мог смениться сразу после аутентификации
+            client = await call(state.get_client, client_id) or client
+            status = flask_app.stream_status(client_id, client)
+            if status['status'] in ('none', 'live', 'failed') or loop.time() >= deadline:
+                break
+            await changes.wait(deadline - loop.time())
+
+    await send_json(send, status, request=request)
+
+
+def _read_file(file_path, text=False):
+    with open(file_path, 'r' if text else 'rb') as f:
+        return f.read()
+
+
+async def serve_hls(request, send, client_id, filename):
+    if '..' in filename.split('/'):
+        return await send_response(send, 404, b"File not found", 'text/plain')
+
+    file_path = os.path.join(flask_app.HLS_ROOT, client_id, filename)
+
+    try:
+        if filename.endswith('.m3u8'):
+            content = await call(_read_file, file_path, True)
+            body = flask_app.rewrite_hls_playlist(content, client_id).encode('utf-8')
+        else:
+            body = await call(_read_file, file_path)
+    except (FileNotFoundError, IsADirectoryError):
+        logger.warning(f"Запрошенный HLS файл не найден: {file_path}")
+        return await send_response(send, 404, b"File not found", 'text/plain')
+
+    await send_response(send, 200, body, flask_app.hls_mimetype(filename), flask_app.hls_headers(filename))
+
+
+ROUTES = [
+    ('GET', re.compile(r'^/api/commands/(?P<client_id>[^/]+)$'), get_commands),
+    ('GET', re.compile(r'^/api/check-notifications/(?P<client_id>[^/]+)$'), check_notifications),
+    ('POST', re.compile(r'^/api/heartbeat/(?P<client_id>[^/]+)$'), heartbeat),
+    ('POST', re.compile(r'^/api/register-stream/(?P<client_id>[^/]+)$'), register_stream),
+    ('GET', re.compile(r'^/api/stream-status/(?P<client_id>[^/]+)$'), get_stream_status),
+    ('GET', re.compile(r'^/hls/(?P<client_id>[^/]+)/(?P<filename>.+)$'), serve_hls),
+]
+
+
+# Управление FFmpeg прокси через асинхронные подпроцессы
+
+def _proxy_lock(client_id):
+    if client_id not in _proxy_locks:
+        _proxy_locks[client_id] = asyncio.Lock()
+    return _proxy_locks[client_id]
+
+
+async def ffmpeg_available():
+    # Возможности FFmpeg проверяются один раз на процесс, повторные вызовы берут их из кэша
+    return await call(flask_app.ffmpeg_ready_for_proxy)
+
+
+async def ensure_async_proxy(client_id):
+    """Запускает прокси в этом процессе, если аренда свободна; иначе его перезапустит текущий владелец."""
+    worker_id = flask_app.get_worker_id()
+    lease_name = flask_app.proxy_lease_name(client_id)
+    if await call(state.acquire_lease, lease_name, worker_id, flask_app.PROXY_LEASE_TTL):
+        client = await call(state.get_client, client_id)
+        proxy_request = (client or {}).get('proxy_request')
+        local = async_proxies.get(client_id)
+        if local and proxy_request and local.get('generation') == proxy_request['generation'] \
+                and local['process'].returncode is None:
+            return worker_id
+        if proxy_request and not await start_async_proxy(client_id, proxy_request['url'], proxy_request['generation']):
+            await call(flask_app.mark_proxy_failed, client_id, proxy_request['generation'], 'FFmpeg прокси не запустился')
+        return worker_id
+
+    owner = await call(state.lease_owner, lease_name)
+    logger.info(f"FFmpeg прокси клиента {client_id} принадлежит воркеру {owner}, он подхватит новый запрос")
+    return owner
+
+
+def schedule_async_proxy(client_id):
+    """Запускает ensure_async_proxy в фоне: запрос не ждёт остановки старого и запуска нового FFmpeg.
+    Пока задача клиента не закончилась, новая не ставится: новое поколение подхватит супервизор.
+    None — очередь заполнена, супервизор поставит задачу на следующем круге."""
+    task = _proxy_tasks.get(client_id)
+    if task is None or task.done():
+        if len(_proxy_tasks) >= flask_app.PROXY_QUEUE_SIZE:
+            return None
+        task = asyncio.create_task(_run_proxy_task(client_id))
+        _proxy_tasks[client_id] = task
+        task.add_done_callback(lambda done: _forget_proxy_task(client_id, done))
+    return task
+
+
+async def _run_proxy_task(client_id):
+    async with _proxy_start_slots:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            return await ensure_async_proxy(client_id)
+        finally:
+            flask_app.record_proxy_start_time(loop.time() - started)
+
+
+def _forget_proxy_task(client_id, task):
+    if _proxy_tasks.get(client_id) is task:
+        del _proxy_tasks[client_id]
+    if not task.cancelled() and task.exception():
+        logger.error(f"Ошибка при запуске FFmpeg прокси клиента {client_id}: {task.exception()}")
+
+
+async def start_async_proxy(client_id, source_url, generation=None):
+    async with _proxy_lock(client_id):
+        await _stop_async_proxy(client_id, release_lease=False)
+
+        if not await ffmpeg_available():
+            return False
+
+        try:
+            proxy_port = await call(flask_app.get_next_proxy_port)
+            hls_path = await call(flask_app.prepare_hls_path, client_id)
+            record_path = await call(flask_app.prepare_recording_path, client_id)
+            cmd = flask_app.build_ffmpeg_proxy_command(source_url, hls_path, record_path)
+
+            logger.info(f"Запуск FFmpeg прокси для клиента {client_id}: {' '.join(cmd)}")
+
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+
+            start_time = datetime.now().isoformat()
+            async_proxies[client_id] = {
+                'process': process,
+                'proxy_port': proxy_port,
+                'hls_path': hls_path,
+                'start_time': start_time,
+                'source_url': source_url,
+                'generation': generation,
+                'tasks': [
+                    asyncio.create_task(read_proxy_output(process.stdout, client_id)),
+                    asyncio.create_task(read_proxy_output(process.stderr, client_id, generation, watch_ready=True))
+                ]
+            }
+
+            await call(flask_app.publish_proxy_info, client_id, proxy_port, hls_path, start_time, generation)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при запуске FFmpeg прокси: {e}", exc_info=True)
+            return False
+
+
+async def read_proxy_output(stream, client_id, generation=None, watch_ready=False):
+    ready = not watch_ready
+    last_error = None
+    async for line in stream:
+        line_text = line.decode('utf-8', errors='replace').strip()
+        if not line_text:
+            continue
+        if not ready and flask_app.PROXY_READY_PATTERN.search(line_text):
+            ready = True
+            await call(flask_app.mark_proxy_ready, client_id, generation)
+        if "error" in line_text.lower() or "failed" in line_text.lower():
+            last_error = line_text
+            logger.error(f"FFmpeg [{client_id}]: {line_text}")
+        else:
+            logger.debug(f"FFmpeg [{client_id}]: {line_text}")
+
+    # Остановленный прокси уже убран из async_proxies, ошибкой считается только собственное завершение
+    proxy = async_proxies.get(client_id)
+    if not ready and proxy and proxy['process'].stderr is stream:
+        await call(flask_app.mark_proxy_failed, client_id, generation,
+                   last_error or 'FFmpeg прокси завершился до первого сегмента')
+
+
+async def stop_async_proxy(client_id, release_lease=True):
+    async with _proxy_lock(client_id):
+        return await _stop_async_proxy(client_id, release_lease)
+
+
+async def _stop_async_proxy(client_id, release_lease):
+    proxy = async_proxies.pop(client_id, None)
+    if not proxy:
+        return False
+
+    try:
+        process = proxy['process']
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+            logger.info(f"FFmpeg прокси для клиента {client_id} остановлен")
+
+        for task in proxy['tasks']:
+            task.cancel()
+
+        await call(flask_app.remove_hls_files, proxy['hls_path'])
+        await call(flask_app.clear_proxy_info, client_id)
+
+        if release_lease:
+            await call(state.release_lease, flask_app.proxy_lease_name(client_id), flask_app.get_worker_id())
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при остановке FFmpeg прокси: {e}")
+        return False
+
+
+async def proxy_supervisor():
+    """Асинхронный аналог proxy_supervisor_loop из app.py."""
+    worker_id = flask_app.get_worker_id()
+    logger.info(f"Запущен асинхронный супервизор FFmpeg прокси воркера {worker_id}")
+
+    while True:
+        try:
+            for client_id in list(async_proxies.keys()):
+                client = await call(state.get_client, client_id)
+                if client is None:
+                    logger.info(f"Клиент {client_id} удален, останавливаем его FFmpeg прокси")
+                    await stop_async_proxy(client_id)
+                    continue
+
+                lease_name = flask_app.proxy_lease_name(client_id)
+                if not await call(state.acquire_lease, lease_name, worker_id, flask_app.PROXY_LEASE_TTL):
+                    logger.warning(f"Аренда FFmpeg прокси клиента {client_id} потеряна, останавливаем локальный процесс")
+                    await stop_async_proxy(client_id, release_lease=False)
+                    continue
+
+                proxy_request = client.get('proxy_request') or {}
+                if proxy_request.get('generation') != async_proxies[client_id].get('generation'):
+                    logger.info(f"Клиент {client_id} перерегистрировал стрим, перезапускаем FFmpeg прокси")
+                    schedule_async_proxy(client_id)
+                elif proxy_request and async_proxies[client_id]['process'].returncode is not None:
+                    logger.info(f"FFmpeg прокси клиента {client_id} завершился, переподключаемся к стриму")
+                    schedule_async_proxy(client_id)
+                else:
+                    await call(flask_app.check_stream_lag, client_id, client)
+
+            for client_id, client in (await call(state.all_clients)).items():
+                if client_id in async_proxies or not client.get('proxy_request'):
+                    continue
+                if await call(state.lease_owner, flask_app.proxy_lease_name(client_id)) is None:
+                    logger.info(f"FFmpeg прокси клиента {client_id} без владельца, забираем его себе")
+                    schedule_async_proxy(client_id)
+
+            await call(flask_app.maintain_recordings)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка в супервизоре FFmpeg прокси: {e}")
+
+        await asyncio.sleep(flask_app.PROXY_LEASE_RENEW_INTERVAL)
+
+
+def ensure_supervisor():
+    global _supervisor_task
+    if _supervisor_task is None or _supervisor_task.done():
+        _supervisor_task = asyncio.create_task(proxy_supervisor())
+
+
+async def shutdown():
+    global _supervisor_task
+    if _supervisor_task:
+        _supervisor_task.cancel()
+        _supervisor_task = None
+    for task in list(_proxy_tasks.values()):
+        task.cancel()
+    for client_id in list(async_proxies.keys()):
+        await stop_async_proxy(client_id)
+
+
+# Передача остальных маршрутов во Flask
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1')
+        value = raw_value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            continue
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def start_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+        return lambda data: None
+
+    result = flask_app.app(environ, start_response)
+    iterator = iter(result)
+    # Flask вызывает start_response до первого куска тела, но генераторы могут отложить его
+    first_chunk = next(iterator, b'')
+    return response['status'], response['headers'], result, iterator, first_chunk
+
+
+async def forward_to_flask(scope, receive, send):
+    try:
+        body = await read_body(receive, FORWARD_MAX_BODY_SIZE)
+    except BodyTooLarge:
+        return await send_json(send, {'error': 'Request body too large'}, 413)
+
+    status, headers, result, iterator, chunk = await call(start_wsgi, build_environ(scope, body))
+    streaming = any(name.lower() == 'content-type' and value.startswith('text/event-stream') for name, value in headers)
+    loop = asyncio.get_running_loop()
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        })
+        # Тело передаётся по кускам, чтобы потоковые ответы (SSE) не буферизовались
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if streaming:
+                chunk = await loop.run_in_executor(_stream_executor, next, iterator, None)
+            else:
+                chunk = await call(next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await call(result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await ffmpeg_available()
+            ensure_supervisor()
+            ensure_change_listener()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    ensure_supervisor()
+    ensure_change_listener()
+
+    for method, pattern, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] == method:
+            request = Request(scope, receive)
+            # Те же правила допуска, что и before_request во Flask
+            client_key = await call(flask_app.admission_key, handler.__name__, match.groupdict().get('client_id'),
+                                    request.args.get('token'), (scope.get('client') or ('', 0))[0])
+            rejected = flask_app.admission_control.check(handler.__name__, client_key)
+            if rejected:
+                return await send_retry_later(send, 429, 'Too many requests', *rejected)
+            try:
+                return await handler(request, send, **match.groupdict())
+            except BodyTooLarge:
+                return await send_json(send, {'error': 'Request body too large'}, 413)
+
+    await forward_to_flask(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        logger.error("Для асинхронного режима установите uvicorn: pip install uvicorn")
+        sys.exit(1)
+
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
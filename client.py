@@ -1,18 +1,46 @@
 import os
+import io
 import time
+import asyncio
 import json
+import gzip
+import random
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 import socket
 import threading
+import heapq
+import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import tempfile
-from ctypes import windll, Structure, c_long, byref
+import codecs
+import copy
+from ctypes import Structure, c_long, byref
 import platform
 import logging
 import psutil
-from win10toast import ToastNotifier
+from PIL import Image, ImageDraw, ImageGrab
+
+# Windows API и всплывающие уведомления есть только на Windows. На других системах разрешение экрана
+# берётся по умолчанию, приоритет FFmpeg не меняется, а уведомления только пишутся в лог
+try:
+    from ctypes import windll
+except ImportError:
+    windll = None
+
+try:
+    from win10toast import ToastNotifier
+except ImportError:
+    ToastNotifier = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 local_server = "http://192.168.0.101:5000"
@@ -52,16 +80,1037 @@ def get_screen_resolution():
         print(f"Ошибка при определении разрешения экрана: {e}")
         return "1920x1080"
 
+def parse_ffmpeg_list(output):
+    """Имена из вывода ffmpeg -encoders / -muxers: строки после разделителя, имя — второе поле."""
+    names = set()
+    started = False
+    for line in output.splitlines():
+        if line.strip().startswith('--'):
+            started = True
+            continue
+        parts = line.split()
+        if started and len(parts) >= 2:
+            names.update(parts[1].split(','))
+    return names
+
+def probe_ffmpeg():
+    """Версия FFmpeg, его кодировщики и форматы вывода. Проверяется один раз за запуск клиента;
+    None — FFmpeg не найден (тогда проверка повторится при следующем запуске стрима)."""
+    global _ffmpeg_capabilities
+    with _ffmpeg_probe_lock:
+        if _ffmpeg_capabilities is None:
+            try:
+                version = subprocess.run(['ffmpeg', '-hide_banner', '-version'], capture_output=True, text=True).stdout
+                encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True).stdout
+                muxers = subprocess.run(['ffmpeg', '-hide_banner', '-muxers'], capture_output=True, text=True).stdout
+            except FileNotFoundError:
+                return None
+            _ffmpeg_capabilities = {
+                'version': version.splitlines()[0] if version else 'unknown',
+                'encoders': parse_ffmpeg_list(encoders),
+                'muxers': parse_ffmpeg_list(muxers)
+            }
+        return _ffmpeg_capabilities
+
 
 API_URL = os.environ.get('API_URL', local_server)
 POLLING_INTERVAL = 5
+HEARTBEAT_INTERVAL = 5
+NOTIFICATION_INTERVAL = 2
+FFMPEG_CHECK_INTERVAL = 10
+FFMPEG_MAX_RESTARTS = 5
 DEFAULT_CONFIG_NAME = "default"
 CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs')
 
 DEFAULT_STREAM_PORT = 8090
+# FFmpeg готов, когда слушает порт стрима; проверяется по состоянию сокета (подключение заняло бы
+# единственное соединение, которое FFmpeg принимает в режиме listen)
+FFMPEG_READY_TIMEOUT = 10
+FFMPEG_READY_POLL_INTERVAL = 0.05
+FFMPEG_STOP_TIMEOUT = 2
+_ffmpeg_capabilities = None
+_ffmpeg_probe_lock = threading.Lock()
+
+# Профили кодировщика экрана. Профиль выбирает сервер (заголовок X-Encoder-Profile):
+# thumbnail, пока стрим никто не смотрит, detail, когда учитель открыл стрим ученика.
+# fps ограничивается --fps, max_width — ширина кадра после масштабирования (None — без масштабирования)
+ENCODER_PROFILES = {
+    'thumbnail': {'fps': 2, 'bitrate': 300, 'max_width': 960},
+    'normal': {'fps': 10, 'bitrate': 1000, 'max_width': 1600},
+    'detail': {'fps': 15, 'bitrate': 2500, 'max_width': None}
+}
+DEFAULT_ENCODER_PROFILE = 'normal'
+# Смена профиля перезапускает FFmpeg, поэтому не чаще раза в PROFILE_SWITCH_MIN_INTERVAL секунд
+PROFILE_SWITCH_MIN_INTERVAL = 15
+
+# Синтетический источник вместо захвата экрана (--source synthetic) для замеров на машинах без экрана:
+# тестовая картинка lavfi в реальном времени, поверх — время захвата, время кадра в потоке и номер кадра
+SYNTHETIC_SOURCE = (
+    "testsrc2=size={resolution}:rate={fps},realtime,"
+    "drawtext=text='%{{localtime\\:%T}} %{{pts\\:hms}} #%{{n}}':fontsize=48:fontcolor=white:"
+    "box=1:boxcolor=black@0.6:x=20:y=20"
+)
+SYNTHETIC_RESOLUTION = '1280x720'
+SYNTHETIC_SCREEN_PERIOD = 30
+
+# Статичный экран: mpdecimate отбрасывает неизменившиеся кадры до кодирования. Раз в
+# STATIC_KEEPALIVE_INTERVAL секунд кадр отправляется всё равно, раз в STATIC_KEYFRAME_INTERVAL
+# секунд он ключевой, чтобы HLS прокси сервера резал сегменты и плеер не терял синхронизацию
+STATIC_KEEPALIVE_INTERVAL = 1
+STATIC_KEYFRAME_INTERVAL = 2
+
+# Миниатюра экрана для сетки на панели учителя. Снимается раз в THUMBNAIL_INTERVAL секунд,
+# отправляется, только если перцептивный хэш (dHash, 64 бита) отличается от отправленного хотя бы
+# на THUMBNAIL_HASH_THRESHOLD бит, и раз в THUMBNAIL_REFRESH_INTERVAL секунд в любом случае
+THUMBNAIL_INTERVAL = 5
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_QUALITY = 60
+THUMBNAIL_HASH_SIZE = 8
+THUMBNAIL_HASH_THRESHOLD = 5
+THUMBNAIL_REFRESH_INTERVAL = 300
+
+# Вывод команд отправляется на сервер кусками по мере появления
+OUTPUT_CHUNK_SIZE = 64 * 1024
+OUTPUT_FLUSH_INTERVAL = 0.5
+OUTPUT_FLUSH_RETRIES = 3
+
+# Тела запросов больше порога сжимаются, если сервер объявил поддержку в заголовке Accept-Encoding
+COMPRESS_MIN_SIZE = 1024
+
+# Список процессов отправляется дельтами; мелкие колебания ЦП и памяти не считаются изменением
+PROCESS_CPU_DEADBAND = 1.0
+PROCESS_RSS_DEADBAND = 1024 * 1024
+PROCESS_SAMPLE_INTERVAL = 2
+PROCESS_SAMPLE_ATTRS = ['name', 'username', 'memory_info', 'cpu_percent', 'status']
+
+# Состояние клиента (system_info, screen_info) отправляется только при изменениях,
+# телеметрия — при выходе за зону нечувствительности, полностью — раз в STATE_KEYFRAME_INTERVAL
+STATE_KEYFRAME_INTERVAL = 300
+TELEMETRY_DEADBANDS = {'cpu_percent': 5.0, 'memory_percent': 2.0}
+
+# Без связи с сервером результаты, подтверждения и вывод команд копятся в журнале на диске
+# (configs/<конфиг>.journal), состояние клиента — только последнее. После восстановления связи
+# журнал доставляется пакетами с паузой между ними
+JOURNAL_MAX_BYTES = 8 * 1024 * 1024
+JOURNAL_REPLAY_INTERVAL = 10
+JOURNAL_BATCH_SIZE = 50
+JOURNAL_BATCH_BYTES = 512 * 1024
+JOURNAL_BATCH_DELAY = 1.0
+
+# Весь HTTP-обмен с сервером идёт через ServerTransport
+HTTP_TIMEOUT = (5, 30)
+HTTP_RETRIES = 3
+HTTP_RETRY_STATUSES = (502, 503, 504)
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 10
+HTTP_POOL_SIZE = 8
+# Перегруженный сервер отклоняет запрос, не выполняя его (429/503 с Retry-After и разбросом X-Retry-Jitter).
+# Такой запрос повторяется даже без retry, но не раньше подсказки; дольше HTTP_RETRY_AFTER_MAX поток не ждёт,
+# повтор остаётся планировщику
+HTTP_RETRY_AFTER_STATUSES = (429, 503)
+HTTP_RETRY_AFTER_MAX = 15
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# Планировщик: сетевые задачи и команды выполняются в небольших пулах потоков
+CLIENT_IO_WORKERS = 4
+CLIENT_COMMAND_WORKERS = 2
+SHUTDOWN_TIMEOUT = 30
+
+# Команды: приоритет и таймаут задаёт сервер. Для high (kill_process) зарезервирован отдельный
+# поток, чтобы долгие команды в общем пуле их не задерживали
+COMMAND_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+CLIENT_URGENT_WORKERS = 1
+# Потоки команд запускаются по мере появления команд и завершаются, простояв без работы столько секунд
+COMMAND_WORKER_IDLE_TIMEOUT = 60
+COMMAND_DEFAULT_TIMEOUT = 30
+COMMAND_CANCELLED_EXIT_CODE = -3
+# Разброс интервалов задач, чтобы клиенты класса не опрашивали сервер синхронно
+SCHEDULE_JITTER = 0.1
 
 os.makedirs(CONFIG_DIR, exist_ok=True)
 
+
+class CircuitOpenError(requests.ConnectionError):
+    """Сервер недоступен: запросы не отправляются, пока не истечёт пауза размыкателя."""
+
+
+class ServerTransport:
+    """Общий HTTP-транспорт клиента: keep-alive соединения из пула, единые таймауты,
+    повторы с экспоненциальной задержкой и размыкатель на случай недоступного сервера."""
+
+    def __init__(self, base_url, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.server_encodings = set()
+        # Вызываются с подсказками сервера (интервалы опроса, профиль кодировщика) и при восстановлении связи
+        self.on_poll_intervals = None
+        self.on_encoder_profile = None
+        self.on_reconnect = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def post_json(self, path, payload, **kwargs):
+        return self.post_data(path, json.dumps(payload).encode('utf-8'), 'application/json', **kwargs)
+
+    def post_data(self, path, data, content_type='application/octet-stream', **kwargs):
+        body, headers = self._encode_body(bytes(data), content_type)
+        return self.request('POST', path, data=body, headers=headers, **kwargs)
+
+    def request(self, method, path, retry=True, **kwargs):
+        """Выполняет запрос. retry=False для неидемпотентных запросов (регистрация):
+        они повторяются, только если сервер явно отклонил их с Retry-After."""
+        url = path if path.startswith('http') else f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+        attempts = self.retries if retry else 1
+        
+        for attempt in range(self.retries):
+            self._before_request()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                self._backoff(attempt)
+                continue
+            except Exception:
+                with self._lock:
+                    self._probe_in_flight = False
+                raise
+            
+            delay = self._retry_after(response)
+            if delay is not None:
+                # Сервер жив и просит подождать: это не сбой связи для размыкателя
+                self._record_success()
+                if attempt + 1 < self.retries and delay <= HTTP_RETRY_AFTER_MAX:
+                    logging.info(f"Сервер перегружен ({response.status_code}), повтор через {delay:.1f} с")
+                    time.sleep(delay)
+                    continue
+            elif response.status_code in HTTP_RETRY_STATUSES:
+                self._record_failure()
+                if attempt + 1 < attempts:
+                    self._backoff(attempt)
+                    continue
+            else:
+                self._record_success()
+            self._remember_server_encodings(response)
+            self._apply_poll_intervals(response)
+            self._apply_encoder_profile(response)
+            return response
+
+    def _retry_after(self, response):
+        """Пауза перед повтором отклонённого запроса: Retry-After плюс случайная доля X-Retry-Jitter."""
+        if response.status_code not in HTTP_RETRY_AFTER_STATUSES:
+            return None
+        try:
+            retry_after = float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return None
+        try:
+            jitter = float(response.headers.get('X-Retry-Jitter', HTTP_BACKOFF_BASE))
+        except ValueError:
+            jitter = HTTP_BACKOFF_BASE
+        return retry_after + random.uniform(0, jitter)
+
+    def _backoff(self, attempt):
+        # Полный джиттер: клиенты класса не повторяют запросы одновременно после сбоя сервера
+        time.sleep(random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt)))
+
+    def _before_request(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < CIRCUIT_RESET_TIMEOUT or self._probe_in_flight:
+                raise CircuitOpenError("Сервер недоступен, запросы временно приостановлены")
+            # Пауза истекла: пропускаем один пробный запрос
+            self._probe_in_flight = True
+
+    def _record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self._opened_at is None:
+                    logging.warning(f"Сервер не отвечает ({self._failures} ошибок подряд), пауза {CIRCUIT_RESET_TIMEOUT} с")
+                self._opened_at = time.monotonic()
+
+    def _record_success(self):
+        with self._lock:
+            reconnected = self._opened_at is not None
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+        if reconnected:
+            logging.info("Связь с сервером восстановлена")
+            if self.on_reconnect:
+                self.on_reconnect()
+
+    def _apply_poll_intervals(self, response):
+        """Разбирает заголовок X-Poll-Intervals: 'commands=2, heartbeat=5'."""
+        header = response.headers.get('X-Poll-Intervals')
+        if not header or not self.on_poll_intervals:
+            return
+        intervals = {}
+        for item in header.split(','):
+            name, _, value = item.strip().partition('=')
+            try:
+                intervals[name] = float(value)
+            except ValueError:
+                continue
+        if intervals:
+            self.on_poll_intervals(intervals)
+
+    def _apply_encoder_profile(self, response):
+        profile = response.headers.get('X-Encoder-Profile')
+        if profile and self.on_encoder_profile:
+            self.on_encoder_profile(profile.strip())
+
+    def _remember_server_encodings(self, response):
+        """Запоминает кодировки тел запросов, которые принимает сервер."""
+        accepted = response.headers.get('Accept-Encoding')
+        if accepted is not None:
+            self.server_encodings = {item.split(';')[0].strip().lower() for item in accepted.split(',')}
+
+    def _encode_body(self, data, content_type):
+        """Сжимает тело запроса, если оно большое и сервер это поддерживает."""
+        headers = {'Content-Type': content_type}
+        # Картинки уже сжаты
+        if len(data) < COMPRESS_MIN_SIZE or content_type.startswith('image/'):
+            return data, headers
+        
+        if zstandard and 'zstd' in self.server_encodings:
+            headers['Content-Encoding'] = 'zstd'
+            return zstandard.ZstdCompressor(level=3).compress(data), headers
+        if 'gzip' in self.server_encodings:
+            headers['Content-Encoding'] = 'gzip'
+            return gzip.compress(data, compresslevel=6), headers
+        return data, headers
+
+
+class CommandOutputStreamer:
+    """Копит вывод одного потока команды (stdout/stderr) и отправляет его на сервер кусками."""
+
+    def __init__(self, client, command_id, stream):
+        self.client = client
+        self.command_id = command_id
+        self.stream = stream
+        self.offset = 0
+        self.buffer = bytearray()
+        self._buffer_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def write(self, data):
+        with self._buffer_lock:
+            self.buffer.extend(data)
+            full = len(self.buffer) >= OUTPUT_CHUNK_SIZE
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Отправляет накопленный вывод. При ошибке данные остаются в буфере до следующей попытки."""
+        with self._send_lock:
+            while True:
+                with self._buffer_lock:
+                    data = bytes(self.buffer[:OUTPUT_CHUNK_SIZE])
+                if not data:
+                    return True
+                
+                size = self.client.post_command_output(self.command_id, self.stream, self.offset, data)
+                if size is None:
+                    return False
+                
+                with self._buffer_lock:
+                    # Сервер мог уже иметь часть данных (повторная отправка), сдвигаемся по его размеру
+                    accepted = max(0, min(size - self.offset, len(data)))
+                    del self.buffer[:accepted]
+                    self.offset += accepted
+                if accepted == 0:
+                    return False
+
+    def journal_remaining(self):
+        """Переносит неотправленный вывод в журнал клиента, чтобы доставить его после восстановления связи."""
+        with self._buffer_lock:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        for start in range(0, len(data), OUTPUT_CHUNK_SIZE):
+            self.client.journal.append('output', {
+                'command_id': self.command_id,
+                'stream': self.stream,
+                'offset': self.offset + start,
+                'data': base64.b64encode(data[start:start + OUTPUT_CHUNK_SIZE]).decode('ascii')
+            })
+        self.offset += len(data)
+        return len(data)
+
+
+class OfflineJournal:
+    """Журнал исходящих сообщений на диске. Файл только дописывается: новая запись — строка JSON,
+    доставленная или вытесненная — строка {"done": seq}. Записи с одинаковым key схлопываются
+    до последней. Когда отметок становится много, файл переписывается заново."""
+
+    def __init__(self, path, max_bytes=JOURNAL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._sizes = {}
+        self._keys = {}
+        self._size = 0
+        self._file_size = 0
+        self._seq = 0
+        self._load()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def append(self, kind, payload, key=None):
+        entry = {'seq': 0, 'kind': kind, 'payload': payload}
+        if key:
+            entry['key'] = key
+        with self._lock:
+            self._seq += 1
+            entry['seq'] = self._seq
+            records = [entry]
+            if key in self._keys:
+                records.append({'done': self._keys[key]})
+            self._remember(entry)
+            
+            dropped = 0
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._forget(next(iter(self._entries)))
+                dropped += 1
+            if dropped:
+                logging.warning(f"Журнал клиента переполнен, отброшено старых записей: {dropped}")
+                self._compact()
+            else:
+                self._write(records)
+
+    def pending(self, limit=JOURNAL_BATCH_SIZE, max_bytes=JOURNAL_BATCH_BYTES):
+        """Первые записи журнала по порядку: не больше limit штук и max_bytes (но хотя бы одна)."""
+        with self._lock:
+            batch = []
+            size = 0
+            for seq, entry in self._entries.items():
+                size += self._sizes[seq]
+                if batch and (len(batch) >= limit or size > max_bytes):
+                    break
+                batch.append(entry)
+            return batch
+
+    def complete(self, seqs):
+        with self._lock:
+            seqs = [seq for seq in seqs if seq in self._entries]
+            for seq in seqs:
+                self._forget(seq)
+            if not self._entries or self._file_size > 2 * self._size + 64 * 1024:
+                self._compact()
+            elif seqs:
+                self._write([{'done': seq} for seq in seqs])
+
+    def discard(self, key):
+        """Убирает запись с ключом key: например, состояние клиента уже доставлено напрямую."""
+        with self._lock:
+            seq = self._keys.get(key)
+        if seq is not None:
+            self.complete([seq])
+
+    def _remember(self, entry):
+        key = entry.get('key')
+        if key in self._keys:
+            self._forget(self._keys[key])
+        self._entries[entry['seq']] = entry
+        self._sizes[entry['seq']] = len(json.dumps(entry))
+        self._size += self._sizes[entry['seq']]
+        if key:
+            self._keys[key] = entry['seq']
+
+    def _forget(self, seq):
+        entry = self._entries.pop(seq, None)
+        if entry is None:
+            return
+        self._size -= self._sizes.pop(seq)
+        if self._keys.get(entry.get('key')) == seq:
+            del self._keys[entry['key']]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Строка, недописанная при аварийном завершении
+                        continue
+                    if 'done' in record:
+                        self._forget(record['done'])
+                    else:
+                        self._remember(record)
+                        self._seq = max(self._seq, record['seq'])
+        except OSError as e:
+            logging.error(f"Не удалось прочитать журнал клиента {self.path}: {e}")
+            return
+        if self._entries:
+            logging.info(f"В журнале клиента {len(self._entries)} недоставленных записей")
+        self._compact()
+
+    def _write(self, records):
+        try:
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._file_size += len(data)
+        except OSError as e:
+            logging.error(f"Не удалось записать журнал клиента: {e}")
+
+    def _compact(self):
+        try:
+            if not self._entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self._file_size = 0
+                return
+            tmp_path = self.path + '.tmp'
+            data = ''.join(json.dumps(entry) + '\n' for entry in self._entries.values())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._file_size = len(data)
+        except OSError as e:
+            logging.error(f"Не удалось уплотнить журнал клиента: {e}")
+
+
+def kill_process_tree(pid):
+    """Завершает процесс вместе с дочерними: при shell=True команда работает в дочернем процессе оболочки."""
+    try:
+        parent = psutil.Process(pid)
+        # Сначала оболочка, чтобы она не успела запустить следующую команду из цепочки
+        processes = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(processes, timeout=3)
+
+
+class CommandJob:
+    def __init__(self, command):
+        self.command = command
+        self.id = command.get('id')
+        self.priority = COMMAND_PRIORITIES.get(command.get('priority'), COMMAND_PRIORITIES['normal'])
+        try:
+            self.timeout = float(command.get('timeout') or COMMAND_DEFAULT_TIMEOUT)
+        except (TypeError, ValueError):
+            self.timeout = COMMAND_DEFAULT_TIMEOUT
+        self.process = None
+        self.started = False
+        self.cancelled = False
+
+    def attach(self, process):
+        """Запоминает процесс команды; если отмена пришла раньше запуска, сразу его завершает."""
+        self.process = process
+        if self.cancelled:
+            kill_process_tree(process.pid)
+
+
+class CommandExecutor:
+    """Ограниченный пул выполнения команд: очередь с приоритетами, таймауты и отмена по запросу сервера."""
+
+    def __init__(self, run, workers=CLIENT_COMMAND_WORKERS, urgent_workers=CLIENT_URGENT_WORKERS):
+        self._run = run
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._stopping = False
+        self._workers = workers
+        self._urgent_workers = urgent_workers
+        self._threads = []
+        # Число потоков и свободных из них: False — общие, True — для срочных команд
+        self._alive = {False: 0, True: 0}
+        self._idle = {False: 0, True: 0}
+
+    def submit(self, command):
+        """Ставит команду в очередь. Возвращает False, если она уже в очереди или выполняется."""
+        job = CommandJob(command)
+        with self._cond:
+            if self._stopping or job.id in self._jobs:
+                return False
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (job.priority, next(self._seq), job))
+            self._start_worker_for(job)
+            self._cond.notify_all()
+        return True
+
+    def _start_worker_for(self, job):
+        """Вызывается под self._cond. Общий поток запускается, если свободных меньше, чем команд в очереди;
+        поток для срочных — только когда срочной команде не хватило общего."""
+        if self._idle[False] >= len(self._queue):
+            return
+        if self._alive[False] < self._workers:
+            urgent = False
+        elif (job.priority == COMMAND_PRIORITIES['high'] and self._idle[True] == 0
+                and self._alive[True] < self._urgent_workers):
+            urgent = True
+        else:
+            return
+        self._alive[urgent] += 1
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        thread = threading.Thread(target=self._worker, args=(urgent,),
+                                  name=f"client-command-{'urgent' if urgent else 'worker'}", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def cancel(self, command_id):
+        """Отменяет команду. Возвращает 'queued', если она ещё не начала выполняться,
+        'running', если её процесс завершён, и None, если такой команды нет."""
+        with self._cond:
+            job = self._jobs.get(command_id)
+            if job is None:
+                return None
+            if job.cancelled:
+                return 'running'
+            job.cancelled = True
+            if not job.started:
+                del self._jobs[command_id]
+                self._queue = [entry for entry in self._queue if entry[2] is not job]
+                heapq.heapify(self._queue)
+                return 'queued'
+            process = job.process
+        if process is not None:
+            kill_process_tree(process.pid)
+        return 'running'
+
+    def counts(self):
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job.started)
+            return {'queued': len(self._jobs) - running, 'running': running}
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """Отбрасывает очередь и ждёт выполняющиеся команды не дольше timeout секунд.
+        Возвращает id отброшенных команд."""
+        with self._cond:
+            self._stopping = True
+            dropped = [job.id for _, _, job in self._queue]
+            for command_id in dropped:
+                self._jobs.pop(command_id, None)
+            self._queue = []
+            if self._jobs:
+                print(f"Ожидание завершения команд: {len(self._jobs)}")
+            self._cond.notify_all()
+            threads = list(self._threads)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        return dropped
+
+    def _next_job(self, urgent):
+        """Следующая команда для потока или None: поток завершается при остановке или после простоя."""
+        with self._cond:
+            self._idle[urgent] += 1
+            try:
+                deadline = time.monotonic() + COMMAND_WORKER_IDLE_TIMEOUT
+                while not self._stopping:
+                    if self._queue and (not urgent or self._queue[0][0] == COMMAND_PRIORITIES['high']):
+                        _, _, job = heapq.heappop(self._queue)
+                        job.started = True
+                        return job
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self._alive[urgent] -= 1
+                return None
+            finally:
+                self._idle[urgent] -= 1
+
+    def _worker(self, urgent):
+        while True:
+            job = self._next_job(urgent)
+            if job is None:
+                return
+            try:
+                self._run(job)
+            except Exception as e:
+                print(f"Ошибка при выполнении команды {job.id}: {e}")
+            finally:
+                with self._cond:
+                    self._jobs.pop(job.id, None)
+
+
+class ProcessSampler:
+    """Фоновый замер процессов. Объекты psutil.Process живут между замерами,
+    поэтому cpu_percent считается за интервал, а не возвращает 0.0 на первом вызове."""
+
+    def __init__(self, interval=PROCESS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._processes = {}
+        self._snapshot = {}
+        self._samples = 0
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+        self._sample_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        """Последний снимок: (pid, create_time) -> запись. Первый вызов ждёт второго замера."""
+        # Если замеры никто не запускает (планировщик не работает), заводим свой поток
+        if time.monotonic() - self._last_refresh > self.interval * 3:
+            self.start()
+        self._ready.wait(PROCESS_SAMPLE_INTERVAL * 3)
+        with self._lock:
+            return dict(self._snapshot)
+
+    def refresh(self):
+        """Один замер; вызывается из собственного потока или из планировщика клиента."""
+        with self._sample_lock:
+            try:
+                snapshot = self.sample()
+            except Exception as e:
+                print(f"Ошибка замера процессов: {e}")
+                return
+            with self._lock:
+                self._snapshot = snapshot
+                self._last_refresh = time.monotonic()
+            self._samples += 1
+            # Первый замер только запоминает счётчики ЦП
+            if self._samples >= 2:
+                self._ready.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.refresh()
+            self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def sample(self):
+        snapshot = {}
+        alive = set()
+        for pid in psutil.pids():
+            proc = self._processes.get(pid)
+            try:
+                # is_running() сверяет время запуска, так что переиспользованный pid получит новый объект
+                if proc is None or not proc.is_running():
+                    proc = psutil.Process(pid)
+                    self._processes[pid] = proc
+                with proc.oneshot():
+                    info = proc.as_dict(PROCESS_SAMPLE_ATTRS, ad_value=None)
+                    create_time = round(proc.create_time(), 3)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess, psutil.AccessDenied):
+                continue
+            
+            alive.add(pid)
+            memory_info = info.get('memory_info')
+            record = {
+                'pid': pid,
+                'create_time': create_time,
+                'name': info.get('name') or '',
+                'username': info.get('username'),
+                'rss': memory_info.rss if memory_info else 0,
+                'cpu_percent': round(info.get('cpu_percent') or 0, 1),
+                'status': info.get('status') or ''
+            }
+            snapshot[(pid, create_time)] = record
+        
+        for pid in list(self._processes):
+            if pid not in alive:
+                del self._processes[pid]
+        return snapshot
+
+
+class ClientStateSync:
+    """Версионированная синхронизация состояния клиента с сервером через /api/client-state."""
+
+    def __init__(self, client):
+        self.client = client
+        # epoch отличает сессии клиента, seq упорядочивает обновления внутри сессии
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        self.sent = None
+        self.last_keyframe = 0
+
+    def collect(self):
+        return {
+            'system_info': {
+                'os': platform.system() + ' ' + platform.release(),
+                'hostname': platform.node(),
+                'cpu_percent': psutil.cpu_percent(),
+                'memory_percent': psutil.virtual_memory().percent
+            },
+            'screen_info': {
+                'resolution': get_screen_resolution(),
+                'quality': self.client.quality,
+                'fps': self.client.fps,
+                'profile': self.client.encoder_profile
+            }
+        }
+
+    def changes(self, current):
+        """Поля, изменившиеся относительно последнего принятого сервером состояния."""
+        changes = {}
+        for field, values in current.items():
+            previous = self.sent.get(field, {})
+            changed = {}
+            for key, value in values.items():
+                old = previous.get(key)
+                deadband = TELEMETRY_DEADBANDS.get(key)
+                if deadband is not None and old is not None and value is not None:
+                    if abs(value - old) < deadband:
+                        continue
+                elif key in previous and old == value:
+                    continue
+                changed[key] = value
+            if changed:
+                changes[field] = changed
+        return changes
+
+    def sync(self):
+        current = self.collect()
+        keyframe = self.sent is None or time.monotonic() - self.last_keyframe >= STATE_KEYFRAME_INTERVAL
+        changes = current if keyframe else self.changes(current)
+        if not changes:
+            return True
+        
+        for attempt in range(2):
+            self.seq += 1
+            payload = {'epoch': self.epoch, 'seq': self.seq, 'keyframe': keyframe, **changes}
+            try:
+                response = self.client.transport.post_json(
+                    f"/api/client-state/{self.client.client_id}?token={self.client.token}", payload
+                )
+            except requests.RequestException as e:
+                # В журнале хранится только последнее состояние, целиком
+                self.client.journal.append('state', {'epoch': self.epoch, 'seq': self.seq, 'keyframe': True, **current},
+                                           key='state')
+                logging.warning(f"Сервер недоступен, состояние клиента записано в журнал: {e}")
+                return False
+            data = response.json() if response.status_code in (200, 409) else {}
+            
+            # Повтор уже принятого запроса (транспорт переотправил тело) сервер считает устаревшим
+            applied = response.status_code == 200 or data.get('version') == [self.epoch, self.seq]
+            if applied:
+                self.client.journal.discard('state')
+                if keyframe:
+                    self.sent = copy.deepcopy(current)
+                    self.last_keyframe = time.monotonic()
+                else:
+                    for field, values in changes.items():
+                        self.sent.setdefault(field, {}).update(values)
+                return True
+            
+            if data.get('keyframe_required') and not keyframe:
+                # Сервер потерял состояние (перезапуск) — отправляем всё целиком
+                keyframe = True
+                changes = current
+                continue
+            if data.get('version') and data['version'][0] == self.epoch:
+                self.seq = max(self.seq, data['version'][1])
+                continue
+            
+            logging.warning(f"Синхронизация состояния вернула код {response.status_code}")
+            return False
+        return False
+
+
+class ScreenThumbnailer:
+    """Миниатюра экрана для панели учителя. Отправляется через /api/thumbnail, только если
+    экран заметно изменился: сравниваются перцептивные хэши, а не байты JPEG."""
+
+    def __init__(self, client, width=THUMBNAIL_WIDTH):
+        self.client = client
+        self.width = width
+        self.sent_hash = None
+        self.sent_at = 0
+
+    def capture(self):
+        if self.client.video_source == 'synthetic':
+            image = self.synthetic_screen()
+        else:
+            image = ImageGrab.grab()
+        image.thumbnail((self.width, self.width), Image.BILINEAR)
+        return image.convert('RGB')
+
+    @staticmethod
+    def synthetic_screen():
+        """Экран для --source synthetic: светлая полоса сдвигается раз в SYNTHETIC_SCREEN_PERIOD секунд,
+        чтобы миниатюры менялись, но не на каждом снимке."""
+        width, height = map(int, SYNTHETIC_RESOLUTION.split('x'))
+        image = Image.new('RGB', (width, height), (40, 40, 40))
+        left = int(time.time() // SYNTHETIC_SCREEN_PERIOD) % 8 * width // 8
+        ImageDraw.Draw(image).rectangle([left, 0, left + width // 8, height], fill=(230, 230, 230))
+        return image
+
+    @staticmethod
+    def perceptual_hash(image, size=THUMBNAIL_HASH_SIZE):
+        """dHash: знаки разностей соседних пикселей уменьшенной серой картинки."""
+        gray = image.convert('L').resize((size + 1, size), Image.BILINEAR)
+        pixels = list(gray.getdata())
+        value = 0
+        for row in range(size):
+            for col in range(size):
+                offset = row * (size + 1) + col
+                value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+        return value
+
+    def changed(self, phash):
+        if self.sent_hash is None or time.monotonic() - self.sent_at >= THUMBNAIL_REFRESH_INTERVAL:
+            return True
+        return bin(phash ^ self.sent_hash).count('1') >= THUMBNAIL_HASH_THRESHOLD
+
+    def update(self):
+        image = self.capture()
+        phash = self.perceptual_hash(image)
+        if not self.changed(phash):
+            return False
+        
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=THUMBNAIL_QUALITY)
+        response = self.client.transport.post_data(
+            f"/api/thumbnail/{self.client.client_id}?token={self.client.token}&hash={phash:016x}",
+            buffer.getvalue(), content_type='image/jpeg'
+        )
+        if response.status_code != 200:
+            logging.warning(f"Ошибка отправки миниатюры экрана: {response.status_code}")
+            return False
+        self.sent_hash = phash
+        self.sent_at = time.monotonic()
+        return True
+
+
+class ScheduledJob:
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.wake = asyncio.Event()
+        self.spread = False
+
+
+class ClientScheduler:
+    """Единый планировщик клиента на asyncio. Периодические задачи спят в одном event loop,
+    блокирующие вызовы (HTTP, psutil) идут в небольшой пул, команды выполняет CommandExecutor."""
+
+    def __init__(self, io_workers=CLIENT_IO_WORKERS):
+        self.jobs = {}
+        self._io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='client-io')
+        # Незавершённые вызовы в пуле: при остановке их дожидаются
+        self._io_futures = set()
+        self._loop = None
+        self._stopping = None
+
+    def add_job(self, name, func, interval):
+        """func — корутина или обычная функция (тогда она выполняется в пуле потоков)."""
+        self.jobs[name] = ScheduledJob(name, func, interval)
+
+    def set_interval(self, name, interval):
+        """Меняет интервал задачи; можно вызывать из любого потока. Задача просыпается сразу."""
+        job = self.jobs.get(name)
+        if job is None or job.interval == interval:
+            return
+        job.interval = interval
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(job.wake.set)
+
+    def wake(self, name):
+        """Запускает задачу вне очереди; можно вызывать из любого потока."""
+        job = self.jobs.get(name)
+        if job is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(job.wake.set)
+
+    def spread(self):
+        """После восстановления связи следующий запуск каждой задачи — в случайный момент интервала."""
+        for job in self.jobs.values():
+            job.spread = True
+
+    async def run_io(self, func, *args):
+        future = self._io_executor.submit(func, *args)
+        self._io_futures.add(future)
+        future.add_done_callback(self._io_futures.discard)
+        return await asyncio.wrap_future(future)
+
+    def stop(self):
+        if self._loop is not None and self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        tasks = [asyncio.create_task(self._run_job(job)) for job in self.jobs.values()]
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Начатые блокирующие вызовы (отправка результатов, запись журнала) дожидаемся, но не дольше SHUTDOWN_TIMEOUT
+            running = [asyncio.wrap_future(future) for future in list(self._io_futures)]
+            if running:
+                done, pending = await asyncio.wait(running, timeout=SHUTDOWN_TIMEOUT)
+                if pending:
+                    logging.warning(f"Не дождались {len(pending)} вызовов при остановке планировщика")
+            self._io_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run_job(self, job):
+        while True:
+            # Сбрасываем до запуска: пробуждение во время работы задачи запустит её ещё раз
+            job.wake.clear()
+            try:
+                if asyncio.iscoroutinefunction(job.func):
+                    await job.func()
+                else:
+                    await self.run_io(job.func)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в задаче {job.name}: {e}")
+            
+            if job.spread:
+                job.spread = False
+                delay = random.uniform(0, job.interval)
+            else:
+                delay = job.interval * random.uniform(1 - SCHEDULE_JITTER, 1 + SCHEDULE_JITTER)
+            try:
+                await asyncio.wait_for(job.wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
 class StudentClient:
     def __init__(self, config_name=DEFAULT_CONFIG_NAME):
         self.client_id = None
@@ -71,6 +1120,33 @@ class StudentClient:
         self.load_credentials()
         self.ffmpeg_process = None
         self.stream_port = DEFAULT_STREAM_PORT
+        self.transport = ServerTransport(API_URL)
+        # Последний снимок процессов, принятый сервером: (pid, create_time) -> запись
+        self.process_baseline = {}
+        self.process_version = None
+        self.process_sampler = ProcessSampler()
+        self.scheduler = ClientScheduler()
+        self.command_executor = CommandExecutor(self._run_command)
+        self.journal = OfflineJournal(self._get_journal_path())
+        self.state_sync = ClientStateSync(self)
+        self.thumbnailer = ScreenThumbnailer(self)
+        self.thumbnail_interval = THUMBNAIL_INTERVAL
+        self.transport.on_poll_intervals = self._apply_poll_intervals
+        self.transport.on_reconnect = self.scheduler.spread
+        self.transport.on_encoder_profile = self._request_encoder_profile
+        self.quality = 75
+        self.fps = 15
+        self.skip_static_frames = True
+        # Буфер кодировщика в Кбит; None — треть битрейта профиля
+        self.bufsize = None
+        self.video_source = 'desktop'
+        self.encoder_profile = DEFAULT_ENCODER_PROFILE
+        self.requested_profile = DEFAULT_ENCODER_PROFILE
+        self.profile_switched_at = 0
+        self.toast = None
+        self.last_notification_check = datetime.now()
+        self.ffmpeg_restart_attempts = 0
+        self.ffmpeg_gave_up_at = None
         
     def _get_config_path(self):
         """Получает путь к файлу конфигурации."""
@@ -79,6 +1155,32 @@ class StudentClient:
         
         return os.path.join(CONFIG_DIR, f"{self.config_name}.json")
         
+    def _get_journal_path(self):
+        return os.path.join(CONFIG_DIR, f"{self.config_name}.journal")
+    
+    def replay_journal(self):
+        """Доставляет журнал пакетами с паузой между ними, чтобы переподключившиеся клиенты
+        не нагружали сервер одновременно."""
+        while len(self.journal):
+            batch = self.journal.pending()
+            response = self.transport.post_json(
+                f"/api/client-journal/{self.client_id}?token={self.token}",
+                {'entries': [{'seq': entry['seq'], 'kind': entry['kind'], 'payload': entry['payload']}
+                             for entry in batch]}
+            )
+            if response.status_code != 200:
+                logging.warning(f"Ошибка доставки журнала: {response.status_code}")
+                return
+            
+            results = response.json().get('results', {})
+            delivered = [entry['seq'] for entry in batch if results.get(str(entry['seq'])) in ('ok', 'rejected')]
+            self.journal.complete(delivered)
+            logging.info(f"Доставлено записей журнала: {len(delivered)}, осталось: {len(self.journal)}")
+            if len(delivered) < len(batch):
+                return
+            if len(self.journal):
+                time.sleep(JOURNAL_BATCH_DELAY * random.uniform(0.5, 1.5))
+    
     def load_credentials(self):
         """Загрузить учетные данные из файла, если они существуют."""
         try:
@@ -102,7 +1204,7 @@ class StudentClient:
             return
             
         try:
-            response = requests.post(f"{API_URL}/api/register")
+            response = self.transport.post("/api/register", retry=False)
             if response.status_code == 200:
                 data = response.json()
                 self.client_id = data['client_id']
@@ -139,48 +1241,80 @@ class StudentClient:
             return False
     
     def poll_commands(self):
-        """Опрашиваем команды от сервера."""
+        """Опрашиваем команды от сервера. Возвращает новые команды и id команд, которые нужно отменить."""
         if not self.client_id or not self.token:
             print("Не зарегистрирован. Невозможно получить команды.")
-            return []
+            return [], []
             
         try:
-            url = f"{API_URL}/api/commands/{self.client_id}?token={self.token}"
-            response = requests.get(url)
+            response = self.transport.get(f"/api/commands/{self.client_id}", params={'token': self.token})
             
             if response.status_code == 200:
                 data = response.json()
-                return data.get('commands', [])
+                return data.get('commands', []), data.get('cancel', [])
             else:
                 print(f"Ошибка при получении команд: {response.status_code} {response.text}")
-                return []
+                return [], []
         except Exception as e:
             print(f"Ошибка при опросе команд: {e}")
-            return []
+            return [], []
+    
+    def report_command_state(self, command_id, status):
+        """Сообщает серверу, что команда в очереди (queued) или выполняется (running).
+        Возвращает статус команды на сервере, если он не позволил переход (например, cancelled)."""
+        try:
+            response = self.transport.post_json(
+                f"/api/commands/{self.client_id}/state?token={self.token}",
+                {'command_id': command_id, 'status': status}
+            )
+            if response.status_code == 409:
+                return response.json().get('status')
+            if response.status_code != 200:
+                print(f"Ошибка отправки статуса команды: {response.status_code} {response.text}")
+        except Exception as e:
+            print(f"Ошибка при отправке статуса команды: {e}")
+        return None
+    
+    def cancel_command(self, command_id):
+        """Отмена по запросу сервера: из очереди команда просто убирается, у выполняющейся завершается дерево процессов."""
+        result = self.command_executor.cancel(command_id)
+        if result == 'running':
+            print(f"Команда {command_id} отменена, процесс завершён")
+        elif result == 'queued':
+            print(f"Команда {command_id} отменена до запуска")
+            self.send_command_result(command_id, "", "Команда отменена до запуска", COMMAND_CANCELLED_EXIT_CODE,
+                                     cancelled=True)
+        else:
+            # Команда уже завершилась или клиент перезапускался: её результат и вывод не трогаем
+            print(f"Команда {command_id} для отмены не найдена")
     
-    def acknowledge_commands(self):
-        """Подтверждение что все команды обработаны."""
+    def acknowledge_commands(self, command_ids=None):
+        """Подтверждение что команды обработаны. Без command_ids сервер закрывает все ожидающие."""
         if not self.client_id or not self.token:
             print("Не зарегистрирован. Невозможно подтвердить команды.")
             return
             
         try:
-            url = f"{API_URL}/api/commands/{self.client_id}/ack?token={self.token}"
-            response = requests.post(
-                url, 
-                json={'command_ids': []},
-                headers={'Content-Type': 'application/json'}
+            response = self.transport.post_json(
+                f"/api/commands/{self.client_id}/ack?token={self.token}",
+                {'command_ids': command_ids or []}
             )
             
             if response.status_code == 200:
-                print("Все команды успешно подтверждены")
+                print("Команды успешно подтверждены")
             else:
                 print(f"Ошибка подтверждения команд: {response.status_code} {response.text}")
+                if response.status_code >= 500 and command_ids:
+                    self.journal.append('ack', {'command_ids': command_ids})
+        except requests.RequestException as e:
+            print(f"Ошибка при подтверждении команд: {e}")
+            if command_ids:
+                self.journal.append('ack', {'command_ids': command_ids})
         except Exception as e:
             print(f"Ошибка при подтверждении команд: {e}")
     
-    def execute_command(self, command):
-        """Выполнение команды, полученной с сервера."""
+    def execute_command(self, command, job=None):
+        """Выполнение команды, полученной с сервера. job — задание CommandExecutor (таймаут и отмена)."""
         print(f"Выполнение команды: {command}")
         
         cmd_text = command.get('command', '')
@@ -188,119 +1322,213 @@ class StudentClient:
         command_type = command.get('type', '')
         
         if command_type == 'get_processes':
-            stdout = self._get_process_list_custom()
-            stderr = ""
-            exit_code = 0
-            print(f"Получен список процессов (своя реализация)")
-            self.send_command_result(command_id, stdout, stderr, exit_code)
+            processes = self.process_sampler.snapshot()
+            print(f"Получен список процессов: {len(processes)}")
+            if self.send_process_snapshot(processes):
+                self.send_command_result(command_id, f"Процессов: {len(processes)}", "", 0)
+            else:
+                self.send_command_result(command_id, "", "Не удалось отправить список процессов", 1)
             return
         
         try:
-            timeout_value = 30 if 'tasklist' in cmd_text else 10
+            timeout_value = job.timeout if job else COMMAND_DEFAULT_TIMEOUT
             
-            result = subprocess.run(
+            process = subprocess.Popen(
                 cmd_text, 
                 shell=True, 
-                capture_output=True, 
-                encoding='cp866',
-                errors='replace',
-                timeout=timeout_value
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
             )
-            stdout = result.stdout
-            stderr = result.stderr
-            exit_code = result.returncode
-            
-            print(f"Вывод команды: {stdout}")
-            if stderr:
-                print(f"Ошибка команды: {stderr}")
-            
-            self.send_command_result(command_id, stdout, stderr, exit_code)
-            
-        except subprocess.TimeoutExpired:
-            error_msg = "Время выполнения команды истекло"
-            print(error_msg)
-            self.send_command_result(command_id, "", error_msg, -1)
         except Exception as e:
             error_msg = f"Ошибка выполнения команды: {e}"
             print(error_msg)
             self.send_command_result(command_id, "", error_msg, -2)
-    
-    def _format_process_list(self, csv_output):
-        """Форматирует вывод tasklist в CSV с правильными заголовками для веб-интерфейса."""
-        if not csv_output:
-            return "Нет запущенных процессов"
+            return
+        if job:
+            job.attach(process)
+        
+        streams = {
+            'stdout': CommandOutputStreamer(self, command_id, 'stdout'),
+            'stderr': CommandOutputStreamer(self, command_id, 'stderr')
+        }
+        readers = [
+            threading.Thread(target=self._pump_command_output, args=(process.stdout, streams['stdout']), daemon=True),
+            threading.Thread(target=self._pump_command_output, args=(process.stderr, streams['stderr']), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+        
+        deadline = time.time() + timeout_value
+        timed_out = False
+        while True:
+            try:
+                process.wait(timeout=OUTPUT_FLUSH_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
             
+            for streamer in streams.values():
+                streamer.flush()
+            
+            if time.time() >= deadline:
+                timed_out = True
+                kill_process_tree(process.pid)
+                process.wait()
+                break
+        
+        for reader in readers:
+            reader.join(timeout=5)
+        
+        exit_code = process.returncode
+        cancelled = job is not None and job.cancelled
+        if cancelled:
+            error_msg = "Команда отменена преподавателем"
+            print(error_msg)
+            streams['stderr'].write(f"\n{error_msg}\n".encode('utf-8'))
+            exit_code = COMMAND_CANCELLED_EXIT_CODE
+        elif timed_out:
+            error_msg = f"Время выполнения команды истекло ({timeout_value:g} с)"
+            print(error_msg)
+            streams['stderr'].write(f"\n{error_msg}\n".encode('utf-8'))
+            exit_code = -1
+        
+        for attempt in range(OUTPUT_FLUSH_RETRIES):
+            if all(streamer.flush() for streamer in streams.values()):
+                break
+            time.sleep(2 ** attempt)
+        else:
+            journaled = sum(streamer.journal_remaining() for streamer in streams.values())
+            print(f"Не удалось отправить {journaled} байт вывода команды {command_id}, вывод записан в журнал")
+        
+        print(f"Команда завершена с кодом {exit_code}, отправлено байт вывода: {streams['stdout'].offset}")
+        self.send_command_result(command_id, None, None, exit_code, streamed=True, cancelled=cancelled)
+    
+    def _pump_command_output(self, pipe, streamer):
+        """Читает вывод процесса по мере появления и перекодирует из cp866 в UTF-8."""
+        decoder = codecs.getincrementaldecoder('cp866')(errors='replace')
         try:
-            header = '"Имя образа","PID","Имя сеанса","№ сеанса","Память","Состояние","Имя пользователя","Время ЦП","Заголовок окна"\n'
+            for chunk in iter(lambda: pipe.read1(OUTPUT_CHUNK_SIZE), b''):
+                streamer.write(decoder.decode(chunk).encode('utf-8'))
+            streamer.write(decoder.decode(b'', final=True).encode('utf-8'))
+        except Exception as e:
+            print(f"Ошибка чтения вывода команды: {e}")
+        finally:
+            pipe.close()
+    
+    def post_command_output(self, command_id, stream, offset, data):
+        """Отправляет кусок вывода команды. Возвращает размер вывода на сервере или None при ошибке."""
+        try:
+            response = self.transport.post_data(
+                f"/api/command-output/{self.client_id}",
+                data,
+                params={'token': self.token, 'command_id': command_id, 'stream': stream, 'offset': offset}
+            )
             
-            if '/NH' in csv_output:
-                csv_with_header = header + csv_output
+            if response.status_code in (200, 409):
+                # 409: сервер ждёт другое смещение и сообщает свой размер
+                return response.json().get('size')
+            print(f"Ошибка отправки вывода команды: {response.status_code} {response.text}")
+            return None
+        except Exception as e:
+            print(f"Ошибка при отправке вывода команды: {e}")
+            return None
+    
+    def _process_changed(self, old, new):
+        return (old['name'] != new['name']
+                or old['username'] != new['username']
+                or old['status'] != new['status']
+                or abs(old['cpu_percent'] - new['cpu_percent']) >= PROCESS_CPU_DEADBAND
+                or abs(old['rss'] - new['rss']) >= PROCESS_RSS_DEADBAND)
+    
+    def send_process_snapshot(self, processes):
+        """Отправляет изменения списка процессов относительно снимка, который уже есть на сервере."""
+        if not self.client_id or not self.token:
+            print("Не зарегистрирован. Невозможно отправить список процессов.")
+            return False
+        
+        path = f"/api/process-snapshot/{self.client_id}?token={self.token}"
+        full = self.process_version is None
+        
+        for attempt in range(2):
+            if full:
+                delta = {'full': True, 'upserts': list(processes.values()), 'removed': []}
+                baseline = dict(processes)
             else:
-                csv_with_header = csv_output
-            
-            lines = csv_with_header.strip().split('\n')
-            processed_lines = [lines[0]]
+                upserts = [record for key, record in processes.items()
+                           if key not in self.process_baseline
+                           or self._process_changed(self.process_baseline[key], record)]
+                removed = [key for key in self.process_baseline if key not in processes]
+                delta = {'base_version': self.process_version, 'upserts': upserts, 'removed': removed}
+                baseline = dict(self.process_baseline)
+                for key in removed:
+                    del baseline[key]
+                for record in upserts:
+                    baseline[(record['pid'], record['create_time'])] = record
             
-            for i in range(1, len(lines)):
-                line = lines[i].strip()
-                if not line:
-                    continue
-                    
-                comma_count = 0
-                in_quotes = False
-                for char in line:
-                    if char == '"':
-                        in_quotes = not in_quotes
-                    elif char == ',' and not in_quotes:
-                        comma_count += 1
-                
-                # Должно быть 8 запятых (9 полей)
-                expected_commas = 8
-                if comma_count < expected_commas:
-                    # Добавляем недостающие поля
-                    missing_fields = expected_commas - comma_count
-                    line = line.rstrip('",') + '","","","' + '"' * (missing_fields - 2)
-                
-                processed_lines.append(line)
+            try:
+                response = self.transport.post_json(path, delta)
+            except Exception as e:
+                print(f"Ошибка при отправке списка процессов: {e}")
+                return False
             
-            return '\n'.join(processed_lines)
+            if response.status_code == 200:
+                self.process_baseline = baseline
+                self.process_version = response.json().get('version')
+                print(f"Список процессов отправлен: изменено {len(delta['upserts'])}, удалено {len(delta['removed'])}")
+                return True
+            if response.status_code == 409 and not full:
+                # У сервера другой снимок (например, после перезапуска), отправляем список целиком
+                full = True
+                continue
             
-        except Exception as e:
-            print(f"Ошибка при форматировании списка процессов: {e}")
-            return header + csv_output
+            print(f"Ошибка отправки списка процессов: {response.status_code} {response.text}")
+            return False
+        return False
     
-    def send_command_result(self, command_id, stdout, stderr, exit_code):
+    def send_command_result(self, command_id, stdout, stderr, exit_code, streamed=False, cancelled=False):
         """Отправляет результат выполнения команды на сервер."""
         if not self.client_id or not self.token:
             print("Не зарегистрирован. Невозможно отправить результат команды.")
             return False
         
+        if not streamed and len(stdout) > OUTPUT_CHUNK_SIZE:
+            # Большой вывод отправляем кусками, чтобы ничего не обрезать
+            print(f"Результат команды большой ({len(stdout)} символов), отправляем кусками")
+            streamed = True
+            for stream, text in (('stdout', stdout), ('stderr', stderr)):
+                if text:
+                    streamer = CommandOutputStreamer(self, command_id, stream)
+                    streamer.write(text.encode('utf-8'))
+                    streamed = streamer.flush() and streamed
+            if not streamed:
+                print("Не удалось отправить вывод кусками, отправляем целиком")
+        
         try:
-            url = f"{API_URL}/api/command-result/{self.client_id}?token={self.token}"
-            
-            max_size = 1024 * 1024  # 1MB
-            if len(stdout) > max_size:
-                print(f"Результат команды слишком большой ({len(stdout)} байт), обрезаем до {max_size} байт")
-                stdout = stdout[:max_size] + "\n... (результат обрезан, слишком большой вывод)"
-            
-            response = requests.post(
-                url,
-                json={
-                    'command_id': command_id,
-                    'stdout': stdout,
-                    'stderr': stderr,
-                    'exit_code': exit_code
-                },
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
+            path = f"/api/command-result/{self.client_id}?token={self.token}"
+            
+            result = {'command_id': command_id, 'exit_code': exit_code}
+            if cancelled:
+                result['cancelled'] = True
+            if streamed:
+                result['streamed'] = True
+            else:
+                result['stdout'] = stdout
+                result['stderr'] = stderr
+            
+            response = self.transport.post_json(path, result)
             
             if response.status_code == 200:
                 print(f"Результат команды успешно отправлен")
                 return True
             else:
                 print(f"Ошибка отправки результата команды: {response.status_code} {response.text}")
+                if response.status_code >= 500:
+                    self.journal.append('result', result)
                 return False
+        except requests.RequestException as e:
+            print(f"Сервер недоступен, результат команды {command_id} записан в журнал: {e}")
+            self.journal.append('result', result)
+            return False
         except Exception as e:
             print(f"Ошибка при отправке результата команды: {e}")
             return False
@@ -322,12 +1550,14 @@ class StudentClient:
             }
             
             print(f"Регистрация стрима: {stream_data}")
-            url = f"{API_URL}/api/register-stream/{self.client_id}?token={self.token}"
-            
-            response = requests.post(url, json=stream_data, timeout=30)
+            response = self.transport.post_json(
+                f"/api/register-stream/{self.client_id}?token={self.token}", stream_data
+            )
             
-            if response.status_code == 200:
-                print(f"Стрим успешно зарегистрирован на сервере: tcp://{local_ip}:{self.stream_port}")
+            # 202: сервер принял стрим, прокси запускается в фоне (статус — /api/stream-status)
+            if response.status_code in (200, 202):
+                status = response.json().get('status', 'registered')
+                print(f"Стрим успешно зарегистрирован на сервере: tcp://{local_ip}:{self.stream_port} ({status})")
                 return True
             else:
                 print(f"Ошибка регистрации стрима: {response.status_code} {response.text}")
@@ -336,21 +1566,89 @@ class StudentClient:
             print(f"Ошибка при регистрации стрима: {e}")
             return False
     
-    def start_ffmpeg_stream(self):
-        """Запуск FFmpeg для стриминга экрана по TCP."""
+    def build_ffmpeg_command(self, resolution):
+        """Команда захвата экрана с параметрами текущего профиля кодировщика."""
+        profile = ENCODER_PROFILES[self.encoder_profile]
+        fps = max(1, min(profile['fps'], self.fps))
+        bitrate = profile['bitrate']
+        # --quality (1-100) задаёт CRF: 100 -> 18, 1 -> 40; битрейт профиля остаётся потолком
+        crf = round(40 - max(1, min(100, self.quality)) * 0.22)
+        bufsize = self.bufsize or max(bitrate // 3, 100)
+        
+        if self.video_source == 'synthetic':
+            cmd = [
+                'ffmpeg',
+                '-f', 'lavfi',
+                '-i', SYNTHETIC_SOURCE.format(resolution=resolution, fps=fps)
+            ]
+        else:
+            cmd = [
+                'ffmpeg',
+                '-f', 'gdigrab',                   # Используем gdigrab для Windows
+                '-framerate', str(fps),            # Захватываем не больше кадров, чем кодируем
+                '-video_size', resolution,         # Используем определенное разрешение экрана
+                '-i', 'desktop'                    # Захватываем весь рабочий стол
+            ]
+        
+        filters = []
+        width = int(resolution.split('x')[0])
+        if profile['max_width'] and width > profile['max_width']:
+            filters.append(f"scale={profile['max_width']}:-2")
+        if self.skip_static_frames:
+            # Изменившийся кадр проходит сразу, без задержки; max — сколько кадров подряд можно отбросить
+            filters.append(f"mpdecimate=max={max(1, fps * STATIC_KEEPALIVE_INTERVAL - 1)}")
+        if filters:
+            cmd += ['-vf', ','.join(filters)]
+        
+        if self.skip_static_frames:
+            # Переменная частота кадров: отброшенные кадры не дублируются обратно на выходе.
+            # -g считает кадры, поэтому на статичном экране ключевые кадры задаются по времени
+            timing = [
+                '-vsync', 'vfr',
+                '-g', str(fps),
+                '-force_key_frames', f'expr:gte(t,n_forced*{STATIC_KEYFRAME_INTERVAL})'
+            ]
+        else:
+            timing = [
+                '-r', str(fps),                # Частота кадров выходного потока
+                '-g', str(fps)                 # Ключевой кадр раз в секунду при любом fps
+            ]
+        
+        cmd += [
+            '-vcodec', 'libx264',              # Кодек H.264
+            '-preset', 'ultrafast',            # Самый быстрый пресет для минимальной задержки
+            '-tune', 'zerolatency',            # Минимальная задержка
+            '-pix_fmt', 'yuv420p',             # Формат пикселей, совместимый с большинством плееров
+            *timing,
+            '-keyint_min', str(fps),           # Минимальное расстояние между ключевыми кадрами
+            '-sc_threshold', '0',              # Отключаем обнаружение смены сцены для более стабильного потока
+            '-crf', str(crf),                  # Качество из --quality
+            '-maxrate', f'{bitrate}k',         # Потолок битрейта профиля
+            '-bufsize', f'{bufsize}k',         # Меньший буфер для снижения задержки
+            '-f', 'mpegts',                    # Формат выходного потока - mpegts
+            '-flush_packets', '1',             # Сразу же отправлять пакеты
+            '-loglevel', 'info',               # Повышаем уровень логирования
+            f'tcp://0.0.0.0:{self.stream_port}?listen'  # Слушаем на всех интерфейсах
+        ]
+        return cmd
+    
+    def start_ffmpeg_stream(self, register=True):
+        """Запуск FFmpeg для стриминга экрана по TCP. register=False — стрим уже зарегистрирован
+        (смена профиля): адрес не меняется, прокси сервера переподключится сам."""
         if self.ffmpeg_process and self.ffmpeg_process.poll() is None:
             print("FFmpeg уже запущен")
             return True
             
-        try:
-            ffmpeg_version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-            print(f"FFmpeg версия: {ffmpeg_version.stdout.split(os.linesep)[0]}")
-        except FileNotFoundError:
+        capabilities = probe_ffmpeg()
+        if capabilities is None:
             print("FFmpeg не найден в системе! Установите FFmpeg для стриминга.")
             return False
+        if 'libx264' not in capabilities['encoders'] or 'mpegts' not in capabilities['muxers']:
+            print(f"FFmpeg собран без libx264 или mpegts, стриминг невозможен: {capabilities['version']}")
+            return False
             
         try:
-            resolution = get_screen_resolution()
+            resolution = SYNTHETIC_RESOLUTION if self.video_source == 'synthetic' else get_screen_resolution()
             print(f"Определено разрешение экрана: {resolution}")
             
             temp_dir = os.path.join(tempfile.gettempdir(), "ffmpeg_stream")
@@ -360,31 +1658,9 @@ class StudentClient:
             
             print(f"Логи FFmpeg будут записаны в: {log_file}")
             
-            # Формируем команду FFmpeg для стриминга экрана с оптимизацией для снижения задержки
-            cmd = [
-                'ffmpeg',
-                '-f', 'gdigrab',                   # Используем gdigrab для Windows
-                '-framerate', '15',                # Повышаем частоту кадров для более плавного видео
-                '-video_size', resolution,         # Используем определенное разрешение экрана
-                '-i', 'desktop',                   # Захватываем весь рабочий стол
-                '-vcodec', 'libx264',              # Кодек H.264
-                '-preset', 'ultrafast',            # Самый быстрый пресет для минимальной задержки
-                '-tune', 'zerolatency',            # Минимальная задержка
-                '-pix_fmt', 'yuv420p',             # Формат пикселей, совместимый с большинством плееров
-                '-r', '15',                        # Частота кадров выходного потока
-                '-g', '15',                        # Группа кадров (I-frame каждые 15 кадров)
-                '-keyint_min', '15',               # Минимальное расстояние между ключевыми кадрами
-                '-sc_threshold', '0',              # Отключаем обнаружение смены сцены для более стабильного потока
-                '-b:v', '1500k',                   # Повышаем битрейт для лучшего качества
-                '-maxrate', '1500k',               # Максимальный битрейт
-                '-bufsize', '500k',                # Меньший буфер для снижения задержки
-                '-f', 'mpegts',                    # Формат выходного потока - mpegts
-                '-flush_packets', '1',             # Сразу же отправлять пакеты
-                '-loglevel', 'info',               # Повышаем уровень логирования
-                f'tcp://0.0.0.0:{self.stream_port}?listen'  # Слушаем на всех интерфейсах
-            ]
+            cmd = self.build_ffmpeg_command(resolution)
             
-            print(f"Запуск FFmpeg стрима на порту {self.stream_port}...")
+            print(f"Запуск FFmpeg стрима на порту {self.stream_port}, профиль {self.encoder_profile}...")
             print(f"Команда: {' '.join(cmd)}")
             
             log_fd = open(log_file, 'w')
@@ -407,31 +1683,50 @@ class StudentClient:
             threading.Thread(target=self._read_ffmpeg_output, args=(self.ffmpeg_process.stdout, log_fd, "stdout"), daemon=True).start()
             threading.Thread(target=self._read_ffmpeg_output, args=(self.ffmpeg_process.stderr, log_fd, "stderr"), daemon=True).start()
             
-            # Небольшая задержка, чтобы FFmpeg успел запуститься
-            time.sleep(3)
-            
-            # Проверяем, что процесс не завершился с ошибкой
-            if self.ffmpeg_process.poll() is not None:
-                print(f"FFmpeg завершился с кодом {self.ffmpeg_process.returncode}")
+            started = time.monotonic()
+            if not self.wait_ffmpeg_listening():
+                if self.ffmpeg_process.poll() is not None:
+                    print(f"FFmpeg завершился с кодом {self.ffmpeg_process.returncode}")
+                else:
+                    print(f"FFmpeg не начал принимать подключения за {FFMPEG_READY_TIMEOUT} секунд")
+                    self.stop_ffmpeg_stream()
                 print(f"Проверьте лог файл: {log_file}")
                 return False
                 
-            print("FFmpeg запущен успешно и ожидает подключение")
+            print(f"FFmpeg запущен за {time.monotonic() - started:.2f} с и ожидает подключение")
             
-            # Регистрируем стрим на сервере
-            register_success = self.register_stream_with_server()
+            if not register:
+                return True
             
-            if not register_success:
-                print("Ошибка при регистрации стрима, пробуем еще раз через 3 секунды...")
-                time.sleep(3)
-                register_success = self.register_stream_with_server()
-                
-            return register_success
+            # Регистрируем стрим на сервере; повторы при недоступности сервера делает транспорт
+            return self.register_stream_with_server()
             
         except Exception as e:
             print(f"Ошибка при запуске FFmpeg: {e}")
             return False
     
+    def wait_ffmpeg_listening(self, timeout=FFMPEG_READY_TIMEOUT):
+        """Ждёт, пока FFmpeg откроет порт стрима на приём. False — процесс завершился или не успел."""
+        try:
+            process = psutil.Process(self.ffmpeg_process.pid)
+        except psutil.NoSuchProcess:
+            return False
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.ffmpeg_process.poll() is not None:
+                return False
+            try:
+                connections = process.net_connections(kind='tcp') if hasattr(process, 'net_connections') else process.connections(kind='tcp')
+            except psutil.AccessDenied:
+                # Сокеты процесса не видны: остаётся считать, что живой FFmpeg готов
+                return True
+            except psutil.NoSuchProcess:
+                return False
+            if any(c.status == psutil.CONN_LISTEN and c.laddr and c.laddr.port == self.stream_port for c in connections):
+                return True
+            time.sleep(FFMPEG_READY_POLL_INTERVAL)
+        return False
+    
     def _read_ffmpeg_output(self, pipe, log_file=None, source="unknown"):
         """Чтение вывода FFmpeg в отдельном потоке."""
         for line in iter(pipe.readline, b''):
@@ -459,10 +1754,14 @@ class StudentClient:
             print("Остановка FFmpeg стрима...")
             try:
                 self.ffmpeg_process.terminate()
-                time.sleep(0.5)
-                if self.ffmpeg_process.poll() is None:
+                try:
+                    self.ffmpeg_process.wait(timeout=FFMPEG_STOP_TIMEOUT)
+                except subprocess.TimeoutExpired:
                     self.ffmpeg_process.kill()
-                    time.sleep(0.5)
+                    try:
+                        self.ffmpeg_process.wait(timeout=FFMPEG_STOP_TIMEOUT)
+                    except subprocess.TimeoutExpired:
+                        pass
                 
                 if self.ffmpeg_process.poll() is None:
                     print("Не удалось остановить процесс FFmpeg, он может остаться в памяти")
@@ -472,7 +1771,7 @@ class StudentClient:
                 print(f"Ошибка при остановке FFmpeg: {e}")
     
     def run(self):
-        """Main client loop."""
+        """Основной цикл клиента: все периодические задачи выполняет один планировщик."""
         if not self.client_id:
             print("Регистрация не удалась. Выход.")
             return
@@ -490,91 +1789,154 @@ class StudentClient:
         
         print(f"Опрос команд каждые {POLLING_INTERVAL} секунд...")
         
-        last_command_poll_time = 0
-        last_ffmpeg_check_time = 0
-        ffmpeg_restart_attempts = 0
+        self.scheduler.add_job('commands', self._poll_commands_job, POLLING_INTERVAL)
+        self.scheduler.add_job('heartbeat', self.state_sync.sync, HEARTBEAT_INTERVAL)
+        self.scheduler.add_job('notifications', self.check_notifications, NOTIFICATION_INTERVAL)
+        self.scheduler.add_job('processes', self.process_sampler.refresh, PROCESS_SAMPLE_INTERVAL)
+        self.scheduler.add_job('ffmpeg', self.check_ffmpeg_stream, FFMPEG_CHECK_INTERVAL)
+        self.scheduler.add_job('journal', self.replay_journal, JOURNAL_REPLAY_INTERVAL)
+        if self.thumbnail_interval > 0:
+            self.scheduler.add_job('thumbnail', self.thumbnailer.update, self.thumbnail_interval)
         
         try:
-            while True:
-                current_time = time.time()
-                
-                if current_time - last_command_poll_time >= POLLING_INTERVAL:
-                    try:
-                        commands = self.poll_commands()
-                        if commands:
-                            print(f"Получено {len(commands)} команд(ы)")
-                            for command in commands:
-                                self.execute_command(command)
-                            self.acknowledge_commands()
-                    except Exception as e:
-                        print(f"Ошибка при опросе или выполнении команд: {e}")
-                    last_command_poll_time = current_time
-                
-                if current_time - last_ffmpeg_check_time >= 10:
-                    if self.ffmpeg_process and self.ffmpeg_process.poll() is not None:
-                        print(f"FFmpeg завершился с кодом {self.ffmpeg_process.returncode}. Перезапуск...")
-                        
-                        if ffmpeg_restart_attempts < 5:
-                            ffmpeg_restart_attempts += 1
-                            restart_delay = 5 * ffmpeg_restart_attempts
-                            print(f"Попытка перезапуска {ffmpeg_restart_attempts}/5 через {restart_delay} секунд")
-                            time.sleep(restart_delay)
-                            
-                            ffmpeg_success = self.start_ffmpeg_stream()
-                            if ffmpeg_success:
-                                print("FFmpeg успешно перезапущен")
-                                ffmpeg_restart_attempts = 0
-                        else:
-                            print("Достигнуто максимальное количество попыток перезапуска FFmpeg.")
-                            print("Проверьте настройки и перезапустите клиент вручную.")
-                            if ffmpeg_restart_attempts > 0 and current_time - last_ffmpeg_check_time >= 300:
-                                ffmpeg_restart_attempts = 0
-                    else:
-                        ffmpeg_restart_attempts = 0
-                    
-                    last_ffmpeg_check_time = current_time
-                
-                time.sleep(0.5)
-                    
+            asyncio.run(self.scheduler.run())
         except KeyboardInterrupt:
+            pass
+        finally:
             print("\nЗавершение работы клиента...")
+            for command_id in self.command_executor.shutdown(SHUTDOWN_TIMEOUT):
+                self.send_command_result(command_id, "", "Клиент завершил работу до запуска команды",
+                                         COMMAND_CANCELLED_EXIT_CODE, cancelled=True)
             self.stop_ffmpeg_stream()
-
-    def _get_process_list_custom(self):
-        """Получает список процессов через psutil и форматирует в CSV для веб-интерфейса."""
+    
+    def _apply_poll_intervals(self, intervals):
+        """Сервер задаёт интервалы опроса: часто, пока учитель смотрит этого ученика, иначе редко."""
+        for name, interval in intervals.items():
+            if name in ('commands', 'notifications', 'heartbeat', 'processes') and interval > 0:
+                self.scheduler.set_interval(name, interval)
+            if name == 'processes' and interval > 0:
+                self.process_sampler.interval = interval
+    
+    async def _poll_commands_job(self):
+        commands, cancel = await self.scheduler.run_io(self.poll_commands)
+        for command_id in cancel:
+            await self.scheduler.run_io(self.cancel_command, command_id)
+        for command in commands:
+            # Пока клиент не сообщил queued, сервер отдаёт команду снова; уже принятые пропускаем
+            if not self.command_executor.submit(command):
+                continue
+            print(f"Команда {command.get('id')} поставлена в очередь")
+            if await self.scheduler.run_io(self.report_command_state, command.get('id'), 'queued') == 'cancelled':
+                self.command_executor.cancel(command.get('id'))
+    
+    def _run_command(self, job):
+        if self.report_command_state(job.id, 'running') == 'cancelled':
+            print(f"Команда {job.id} отменена до запуска")
+            return
         try:
-            process_list = []
-            
-            header = '"Имя образа","PID","Имя сеанса","№ сеанса","Память","Состояние","Имя пользователя","Время ЦП","Заголовок окна"'
-            process_list.append(header)
-            
-            for proc in psutil.process_iter(['pid', 'name', 'username', 'memory_info', 'cpu_percent']):
-                try:
-                    # Базовая информация
-                    pid = proc.info['pid']
-                    name = proc.info['name']
-                    
-                    try:
-                        memory_mb = round(proc.info['memory_info'].rss / (1024 * 1024))
-                        memory = f"{memory_mb:,} КБ".replace(',', ' ')
-                    except:
-                        memory = "Н/Д"
-                        
-                    username = proc.info.get('username', 'Н/Д')
-                    cpu_percent = f"{proc.info.get('cpu_percent', 0):.1f}%"
-                    
-                    window_title = ""
-                    
-                    process_line = f'"{name}","{pid}","Console","8","{memory}","Running","{username}","{cpu_percent}","{window_title}"'
-                    process_list.append(process_line)
-                except Exception as e:
-                    print(f"Ошибка получения информации о процессе {pid}: {e}")
-            
-            return "\n".join(process_list)
+            self.execute_command(job.command, job)
+        finally:
+            self.acknowledge_commands([job.id])
+    
+    def check_notifications(self):
+        """Получает новые уведомления от преподавателя и показывает их."""
+        response = self.transport.get(
+            f"/api/check-notifications/{self.client_id}",
+            params={
+                "since": self.last_notification_check.isoformat(),
+                "token": self.token
+            }
+        )
+        
+        if response.status_code == 401:
+            logging.error("Ошибка аутентификации при получении уведомлений")
+            return
+        if response.status_code != 200:
+            logging.warning(f"Ошибка при получении уведомлений. Код ответа: {response.status_code}")
+            return
+        
+        data = response.json()
+        if not data.get('success'):
+            logging.warning(f"Ошибка при получении уведомлений: {data.get('error', 'Неизвестная ошибка')}")
+            return
+        
+        notifications = data.get('notifications', [])
+        for notification in notifications:
+            message = notification.get('message', '')
+            if not message:
+                continue
             
-        except Exception as e:
-            print(f"Ошибка при получении списка процессов: {e}")
-            return '"Имя образа","PID","Имя сеанса","№ сеанса","Память","Состояние","Имя пользователя","Время ЦП","Заголовок окна"\n"Error","0","None","0","0 КБ","Error","None","0%","Ошибка получения списка процессов"'
+            logging.info(f"Показываю уведомление: {message}")
+            try:
+                if self.toast:
+                    self.toast.show_toast(
+                        title="Сообщение от преподавателя",
+                        msg=message,
+                        duration=5,
+                        icon_path=None,
+                        threaded=True
+                    )
+            except Exception as e:
+                logging.error(f"Ошибка показа уведомления: {e}")
+            print(f"\n[УВЕДОМЛЕНИЕ]: {message}\n")
+        
+        if notifications:
+            self.last_notification_check = datetime.now()
+            logging.info(f"Получено {len(notifications)} новых уведомлений")
+    
+    def _request_encoder_profile(self, profile):
+        """Сервер подсказал профиль кодировщика; перезапуск FFmpeg выполняет задача ffmpeg."""
+        if profile not in ENCODER_PROFILES or profile == self.requested_profile:
+            return
+        self.requested_profile = profile
+        self.scheduler.wake('ffmpeg')
+    
+    def apply_encoder_profile(self):
+        """Переключает FFmpeg на запрошенный сервером профиль, не регистрируя стрим заново."""
+        profile = self.requested_profile
+        if profile == self.encoder_profile:
+            return
+        if time.monotonic() - self.profile_switched_at < PROFILE_SWITCH_MIN_INTERVAL:
+            return
+        
+        print(f"Смена профиля кодировщика: {self.encoder_profile} -> {profile}")
+        self.encoder_profile = profile
+        self.profile_switched_at = time.monotonic()
+        if not self.ffmpeg_process:
+            return
+        self.stop_ffmpeg_stream()
+        if not self.start_ffmpeg_stream(register=False):
+            print("Не удалось перезапустить FFmpeg с новым профилем")
+    
+    def check_ffmpeg_stream(self):
+        """Применяет профиль кодировщика и перезапускает завершившийся FFmpeg;
+        пауза между попытками растёт, не больше 5 попыток подряд."""
+        self.apply_encoder_profile()
+        if not self.ffmpeg_process or self.ffmpeg_process.poll() is None:
+            self.ffmpeg_restart_attempts = 0
+            return
+        
+        if self.ffmpeg_restart_attempts >= FFMPEG_MAX_RESTARTS:
+            if time.monotonic() - self.ffmpeg_gave_up_at < 300:
+                return
+            self.ffmpeg_restart_attempts = 0
+        
+        self.ffmpeg_restart_attempts += 1
+        print(f"FFmpeg завершился с кодом {self.ffmpeg_process.returncode}. "
+              f"Попытка перезапуска {self.ffmpeg_restart_attempts}/{FFMPEG_MAX_RESTARTS}")
+        
+        if self.start_ffmpeg_stream():
+            print("FFmpeg успешно перезапущен")
+            self.ffmpeg_restart_attempts = 0
+            self.scheduler.set_interval('ffmpeg', FFMPEG_CHECK_INTERVAL)
+        elif self.ffmpeg_restart_attempts >= FFMPEG_MAX_RESTARTS:
+            print("Достигнуто максимальное количество попыток перезапуска FFmpeg.")
+            print("Проверьте настройки и перезапустите клиент вручную.")
+            self.ffmpeg_gave_up_at = time.monotonic()
+            self.scheduler.set_interval('ffmpeg', FFMPEG_CHECK_INTERVAL)
+        else:
+            self.scheduler.set_interval('ffmpeg', 5 * (self.ffmpeg_restart_attempts + 1))
+
 
 def list_configs():
     """Выводит список доступных конфигураций."""
@@ -606,6 +1968,10 @@ def main(args):
         elif args.config == DEFAULT_CONFIG_NAME and os.path.exists('client_credentials.json'):
             os.remove('client_credentials.json')
             print("Удален старый формат конфигурации.")
+        # Недоставленные сообщения относятся к прежней регистрации клиента
+        journal_path = os.path.join(CONFIG_DIR, f"{args.config}.journal")
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
     
     client = StudentClient(args.config)
     client.stream_port = args.port
@@ -619,198 +1985,17 @@ def main(args):
     
     logging.info(f"Клиент запущен с ID: {client.client_id}")
     
-    toast = ToastNotifier()
-    
-    threading.Thread(target=screenshot_thread, args=(API_URL, client.client_id, client.ffmpeg_process, args.quality, args.fps), daemon=True).start()
-    threading.Thread(target=heartbeat_thread, args=(API_URL, client.client_id), daemon=True).start()
-    threading.Thread(target=command_thread, args=(API_URL, client.client_id), daemon=True).start()
-    threading.Thread(target=notification_thread, args=(API_URL, client.client_id, toast), daemon=True).start()
+    client.quality = args.quality
+    client.fps = args.fps
+    client.skip_static_frames = args.static_detection
+    client.thumbnail_interval = args.thumbnail_interval
+    client.bufsize = args.bufsize
+    client.video_source = args.source
+    client.encoder_profile = client.requested_profile = args.profile
+    client.toast = ToastNotifier() if ToastNotifier else None
     
     client.run()
 
-def screenshot_thread(server_url, client_id, ffmpeg_process, quality, fps):
-    """Поток для отправки скриншотов экрана"""
-    while True:
-        try:
-            if ffmpeg_process and ffmpeg_process.poll() is not None:
-                logging.warning(f"FFmpeg процесс завершился с кодом {ffmpeg_process.returncode}, перезапуск...")
-            
-
-            screen_info = {
-                'resolution': get_screen_resolution(),
-                'quality': quality,
-                'fps': fps
-            }
-            
-            requests.post(f"{server_url}/api/update-screen-info/{client_id}",
-                          json=screen_info)
-        except Exception as e:
-            logging.error(f"Ошибка в потоке скриншотов: {e}")
-        
-        time.sleep(5)
-
-def heartbeat_thread(server_url, client_id):
-    """Поток для отправки heartbeat сигналов на сервер"""
-    while True:
-        try:
-            system_info = {
-                'os': platform.system() + ' ' + platform.release(),
-                'hostname': platform.node(),
-                'cpu_percent': psutil.cpu_percent(),
-                'memory_percent': psutil.virtual_memory().percent,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-
-            response = requests.post(f"{server_url}/api/heartbeat/{client_id}", 
-                                    json=system_info)
-            
-            if response.status_code != 200:
-                logging.warning(f"Heartbeat вернул код {response.status_code}")
-                
-        except Exception as e:
-            logging.error(f"Ошибка в потоке heartbeat: {e}")
-            
-        time.sleep(5)
-
-def command_thread(server_url, client_id):
-    """Поток для получения и выполнения команд от сервера"""
-    while True:
-        try:
-            # Запрашиваем новые команды
-            response = requests.get(f"{server_url}/api/get-commands/{client_id}")
-            
-            if response.status_code == 200:
-                commands = response.json().get('commands', [])
-                
-                for cmd in commands:
-                    cmd_id = cmd.get('id')
-                    cmd_text = cmd.get('command')
-                    
-                    if cmd_text:
-                        logging.info(f"Выполнение команды: {cmd_text}")
-                        
-                        try:
-                            result = subprocess.run(
-                                cmd_text, 
-                                shell=True, 
-                                capture_output=True,
-                                text=True,
-                                timeout=30
-                            )
-                            
-                            response_data = {
-                                'stdout': result.stdout,
-                                'stderr': result.stderr,
-                                'exit_code': result.returncode
-                            }
-                            
-                            requests.post(
-                                f"{server_url}/api/command-result/{client_id}/{cmd_id}",
-                                json=response_data
-                            )
-                            
-                        except subprocess.TimeoutExpired:
-                            requests.post(
-                                f"{server_url}/api/command-result/{client_id}/{cmd_id}",
-                                json={
-                                    'stdout': '',
-                                    'stderr': 'Команда прервалась через 30 секунд',
-                                    'exit_code': -1
-                                }
-                            )
-                        except Exception as e:
-                            requests.post(
-                                f"{server_url}/api/command-result/{client_id}/{cmd_id}",
-                                json={
-                                    'stdout': '',
-                                    'stderr': f'Ошибка при выполнении команды: {str(e)}',
-                                    'exit_code': -1
-                                }
-                            )
-                
-        except Exception as e:
-            logging.error(f"Ошибка в потоке команд: {e}")
-        
-        time.sleep(1)
-
-def notification_thread(server_url, client_id, toast):
-    """Поток для получения и отображения уведомлений"""
-    last_check_time = datetime.now()
-    
-    # Получаем токен клиента
-    config_file = os.path.join(CONFIG_DIR, f"{DEFAULT_CONFIG_NAME}.json")
-    if os.path.exists(config_file):
-        try:
-            with open(config_file, 'r') as f:
-                config = json.load(f)
-                token = config.get('token')
-        except:
-            logging.error("Не удалось прочитать токен из файла конфигурации")
-            token = None
-    else:
-        logging.error("Файл конфигурации не найден")
-        token = None
-    
-    if not token:
-        logging.error("Токен клиента не найден, уведомления не будут работать")
-        return
-        
-    logging.info("Запущен поток получения уведомлений")
-    
-    while True:
-        try:
-            response = requests.get(
-                f"{server_url}/api/check-notifications/{client_id}",
-                params={
-                    "since": last_check_time.isoformat(),
-                    "token": token
-                },
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    notifications = data.get('notifications', [])
-                    
-                    for notification in notifications:
-                        # Отображаем уведомление в Windows
-                        try:
-                            message = notification.get('message', '')
-                            if message:
-                                logging.info(f"Показываю уведомление: {message}")
-                                
-                                toast.show_toast(
-                                    title="Сообщение от преподавателя",
-                                    msg=message,
-                                    duration=5,
-                                    icon_path=None,
-                                    threaded=True
-                                )
-                                
-                                print(f"\n[УВЕДОМЛЕНИЕ]: {message}\n")
-                        except Exception as e:
-                            logging.error(f"Ошибка показа уведомления: {e}")
-                    
-                    if notifications:
-                        last_check_time = datetime.now()
-                        logging.info(f"Получено {len(notifications)} новых уведомлений")
-                else:
-                    error = data.get('error', 'Неизвестная ошибка')
-                    logging.warning(f"Ошибка при получении уведомлений: {error}")
-            elif response.status_code == 401:
-                logging.error("Ошибка аутентификации при получении уведомлений")
-            else:
-                logging.warning(f"Ошибка при получении уведомлений. Код ответа: {response.status_code}")
-                
-        except requests.RequestException as e:
-            logging.error(f"Ошибка соединения в потоке уведомлений: {e}")
-        except Exception as e:
-            logging.error(f"Неизвестная ошибка в потоке уведомлений: {e}")
-        
-        time.sleep(2)
-
 if __name__ == "__main__":
     # Парсинг аргументов командной строки
     parser = argparse.ArgumentParser(description='Клиент для системы удаленного управления Учитель-Студент')
@@ -825,7 +2010,17 @@ if __name__ == "__main__":
     parser.add_argument('--quality', '-q', type=int, default=75,
                         help='Качество изображения (по умолчанию 75)')
     parser.add_argument('--fps', '-f', type=int, default=15,
-                        help='Частота кадров (по умолчанию 15)')
+                        help='Максимальная частота кадров, профиль кодировщика может снизить её (по умолчанию 15)')
+    parser.add_argument('--no-static-detection', dest='static_detection', action='store_false',
+                        help='Кодировать все кадры, даже если экран не меняется')
+    parser.add_argument('--thumbnail-interval', type=float, default=THUMBNAIL_INTERVAL,
+                        help=f'Как часто снимать миниатюру экрана для панели учителя, секунды; 0 — не отправлять (по умолчанию {THUMBNAIL_INTERVAL})')
+    parser.add_argument('--bufsize', type=int, default=None,
+                        help='Буфер кодировщика в Кбит (по умолчанию треть битрейта профиля)')
+    parser.add_argument('--source', choices=['desktop', 'synthetic'], default='desktop',
+                        help='Источник видео: захват экрана или тестовая картинка FFmpeg (по умолчанию desktop)')
+    parser.add_argument('--profile', choices=sorted(ENCODER_PROFILES), default=DEFAULT_ENCODER_PROFILE,
+                        help=f'Начальный профиль кодировщика до подсказки сервера (по умолчанию {DEFAULT_ENCODER_PROFILE})')
     
     args = parser.parse_args()
     
@@ -0,0 +1,157 @@
+import io
+import gzip
+import json
+import zlib
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Тела меньше порога не сжимаются: для heartbeat и коротких ответов это только лишняя работа
+COMPRESS_MIN_SIZE = 1024
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'text/plain',
+    'text/html',
+    'text/css',
+    'application/javascript',
+    'application/vnd.apple.mpegurl'
+)
+
+
+class DecompressionError(Exception):
+    status = 400
+
+
+class PayloadTooLarge(DecompressionError):
+    status = 413
+
+
+class UnsupportedEncoding(DecompressionError):
+    status = 415
+
+
+def supported_encodings():
+    """Кодировки, которые сервер умеет принимать и отдавать, в порядке предпочтения."""
+    return ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+def decompress(body, encoding, limit=MAX_DECOMPRESSED_SIZE):
+    """Распаковывает тело запроса, не выделяя больше limit байт."""
+    encoding = (encoding or '').strip().lower()
+
+    if encoding in ('', 'identity'):
+        if len(body) > limit:
+            raise PayloadTooLarge("Тело запроса слишком большое")
+        return body
+
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        wbits = zlib.MAX_WBITS if encoding == 'deflate' else 16 + zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            data = decompressor.decompress(body, limit + 1)
+        except zlib.error as e:
+            raise DecompressionError(f"Повреждённые сжатые данные: {e}")
+        if len(data) > limit or decompressor.unconsumed_tail:
+            raise PayloadTooLarge("Распакованное тело запроса слишком большое")
+        return data
+
+    if encoding == 'zstd' and zstandard:
+        chunks = []
+        size = 0
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                while True:
+                    chunk = reader.read(64 * 1024)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > limit:
+                        raise PayloadTooLarge("Распакованное тело запроса слишком большое")
+                    chunks.append(chunk)
+        except zstandard.ZstdError as e:
+            raise DecompressionError(f"Повреждённые сжатые данные: {e}")
+        return b''.join(chunks)
+
+    raise UnsupportedEncoding(f"Неподдерживаемая кодировка: {encoding}")
+
+
+def choose_encoding(accept_encoding):
+    """Выбирает кодировку ответа по заголовку Accept-Encoding клиента."""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def should_compress(mimetype, size):
+    return size >= COMPRESS_MIN_SIZE and mimetype in COMPRESSIBLE_MIMETYPES
+
+
+class RequestDecompressionMiddleware:
+    """WSGI middleware: распаковывает тела запросов с Content-Encoding gzip/zstd в ограниченный буфер."""
+
+    def __init__(self, app, limit=MAX_DECOMPRESSED_SIZE):
+        self.app = app
+        self.limit = limit
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING')
+        if encoding and encoding.strip().lower() != 'identity':
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+
+            try:
+                if length > self.limit:
+                    raise PayloadTooLarge("Тело запроса слишком большое")
+                body = environ['wsgi.input'].read(length) if length else environ['wsgi.input'].read(self.limit + 1)
+                data = decompress(body, encoding, self.limit)
+            except DecompressionError as e:
+                logger.warning(f"Не удалось распаковать тело запроса {environ.get('PATH_INFO')}: {e}")
+                return self._error(start_response, e)
+
+            environ['wsgi.input'] = io.BytesIO(data)
+            environ['CONTENT_LENGTH'] = str(len(data))
+            del environ['HTTP_CONTENT_ENCODING']
+
+        return self.app(environ, start_response)
+
+    @staticmethod
+    def _error(start_response, error):
+        body = json.dumps({'success': False, 'error': str(error)}).encode('utf-8')
+        reasons = {400: 'BAD REQUEST', 413: 'REQUEST ENTITY TOO LARGE', 415: 'UNSUPPORTED MEDIA TYPE'}
+        start_response(f"{error.status} {reasons[error.status]}", [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Accept-Encoding', ', '.join(supported_encodings()))
+        ])
+        return [body]
@@ -0,0 +1,302 @@
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+import threading
+import statistics
+from contextlib import redirect_stdout
+
+import requests
+
+import client
+
+# Симулятор класса для нагрузочных замеров медиа-части сервера: десятки StudentClient в одном процессе
+# без Windows и без экрана. Каждый клиент регистрируется на сервере, транслирует синтетический источник
+# FFmpeg (--source synthetic) и регистрирует настоящий TCP стрим, а «учителя» смотрят стримы через /hls/.
+# Клиенты добавляются ступенями, после каждой ступени печатаются показатели сервера
+SIM_CONFIG_PREFIX = 'sim'
+SIM_BASE_PORT = 8200
+SIM_STEP = 5
+SIM_STEP_DURATION = 30
+SIM_RESOLUTION = '640x360'
+SIM_VIEWERS = 1
+# Плеер перезапрашивает живой плейлист примерно раз в длительность сегмента
+SIM_VIEWER_POLL_INTERVAL = 0.5
+SIM_WATCH_INTERVAL = 10
+SIM_STOP_TIMEOUT = 15
+# Деградация: сегменты появляются медленнее реального времени или их отдача заметно тормозит
+SIM_LAG_RATIO_THRESHOLD = 1.2
+SIM_FETCH_P95_THRESHOLD = 1.0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class FleetMetrics:
+    """Замеры зрителей за текущую ступень: время отдачи плейлиста и сегментов, новые сегменты, ошибки."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.playlist_times = []
+            self.segment_times = []
+            self.segments = set()
+            self.live_clients = set()
+            self.errors = 0
+
+    def playlist(self, client_id, elapsed, ok):
+        with self._lock:
+            if ok:
+                self.playlist_times.append(elapsed)
+                self.live_clients.add(client_id)
+            else:
+                self.errors += 1
+
+    def segment(self, client_id, name, elapsed, ok):
+        with self._lock:
+            if ok:
+                self.segment_times.append(elapsed)
+                self.segments.add((client_id, name))
+            else:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = max(time.time() - self.started_at, 0.001)
+            return {
+                'live_streams': len(self.live_clients),
+                'segments_per_second': round(len(self.segments) / elapsed, 1),
+                'playlist_p95_ms': round(percentile(self.playlist_times, 0.95) * 1000, 1) if self.playlist_times else None,
+                'segment_p95_ms': round(percentile(self.segment_times, 0.95) * 1000, 1) if self.segment_times else None,
+                'errors': self.errors
+            }
+
+
+class SimulatedStudent:
+    """StudentClient с синтетическим экраном в отдельном потоке."""
+
+    def __init__(self, number, base_port):
+        self.config_name = f"{SIM_CONFIG_PREFIX}-{number}"
+        remove_config(self.config_name)
+        self.client = client.StudentClient(self.config_name)
+        self.client.stream_port = base_port + number
+        self.client.video_source = 'synthetic'
+        self.thread = None
+
+    def start(self):
+        self.client.register()
+        if not self.client.client_id:
+            return False
+        self.thread = threading.Thread(target=self.client.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.client.scheduler.stop()
+        if self.thread:
+            self.thread.join(SIM_STOP_TIMEOUT)
+        # run() останавливает FFmpeg сам, но поток мог не дойти до планировщика
+        self.client.stop_ffmpeg_stream()
+        remove_config(self.config_name)
+
+
+class Viewer:
+    """Учитель, который смотрит стрим ученика: отмечает просмотр и опрашивает плейлист и сегменты как hls.js."""
+
+    def __init__(self, server_url, cookies, client_id, metrics):
+        self.server_url = server_url
+        self.session = requests.Session()
+        self.session.cookies.update(cookies)
+        self.client_id = client_id
+        self.metrics = metrics
+        self.seen = set()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _get(self, path):
+        started = time.time()
+        try:
+            response = self.session.get(self.server_url + path, timeout=client.HTTP_TIMEOUT)
+            return response, time.time() - started
+        except requests.RequestException:
+            return None, time.time() - started
+
+    def _run(self):
+        watched_at = 0
+        while not self._stop.is_set():
+            if time.time() - watched_at >= SIM_WATCH_INTERVAL:
+                try:
+                    self.session.post(f"{self.server_url}/api/watch/{self.client_id}?stream=1", timeout=client.HTTP_TIMEOUT)
+                except requests.RequestException:
+                    pass
+                watched_at = time.time()
+
+            response, elapsed = self._get(f"/hls/{self.client_id}/playlist.m3u8")
+            ok = response is not None and response.status_code == 200
+            # Пока прокси не запущен, 404 на плейлист — не ошибка сервера
+            if response is None or response.status_code != 404:
+                self.metrics.playlist(self.client_id, elapsed, ok)
+            if ok:
+                for line in response.text.splitlines():
+                    line = line.strip()
+                    if not line or line.startswith('#') or line in self.seen:
+                        continue
+                    segment, elapsed = self._get(line)
+                    self.metrics.segment(self.client_id, line, elapsed, segment is not None and segment.status_code == 200)
+                    self.seen.add(line)
+            self._stop.wait(SIM_VIEWER_POLL_INTERVAL)
+
+
+def remove_config(config_name):
+    for extension in ('.json', '.journal'):
+        path = os.path.join(client.CONFIG_DIR, f"{config_name}{extension}")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def teacher_login(server_url, username, password):
+    session = requests.Session()
+    response = session.post(f"{server_url}/login", data={'username': username, 'password': password},
+                            allow_redirects=False, timeout=client.HTTP_TIMEOUT)
+    if 'session_token' not in session.cookies:
+        raise RuntimeError(f"Не удалось войти как учитель: {response.status_code}")
+    return session
+
+
+def stream_lag(session, server_url, client_ids):
+    """lag_ratio и fps стримов по /api/stream-health: >1 — сегменты появляются медленнее реального времени."""
+    ratios = []
+    fps = []
+    for client_id in client_ids:
+        try:
+            health = session.get(f"{server_url}/api/stream-health/{client_id}", timeout=client.HTTP_TIMEOUT).json()
+        except (requests.RequestException, ValueError):
+            continue
+        if health.get('lag_ratio') is not None:
+            ratios.append(health['lag_ratio'])
+        if health.get('fps') is not None:
+            fps.append(health['fps'])
+    return {
+        'lag_ratio_median': round(statistics.median(ratios), 2) if ratios else None,
+        'lag_ratio_max': round(max(ratios), 2) if ratios else None,
+        'fps_median': round(statistics.median(fps), 1) if fps else None
+    }
+
+
+def degraded(row):
+    if row['live_streams'] < row['clients']:
+        return 'не все стримы доступны'
+    if row['lag_ratio_median'] is not None and row['lag_ratio_median'] > SIM_LAG_RATIO_THRESHOLD:
+        return 'сегменты отстают от реального времени'
+    if row['segment_p95_ms'] is not None and row['segment_p95_ms'] > SIM_FETCH_P95_THRESHOLD * 1000:
+        return 'медленная отдача сегментов'
+    return None
+
+
+def report(text):
+    print(text, file=sys.__stdout__, flush=True)
+
+
+def run_fleet(args):
+    client.API_URL = args.server
+    client.SYNTHETIC_RESOLUTION = args.resolution
+    teacher = teacher_login(args.server, args.teacher, args.password)
+    metrics = FleetMetrics()
+    students = []
+    viewers = []
+    results = []
+    sustained = 0
+
+    try:
+        while len(students) < args.clients:
+            for _ in range(min(args.step, args.clients - len(students))):
+                student = SimulatedStudent(len(students), args.base_port)
+                students.append(student)
+                if not student.start():
+                    report(f"Клиент {student.config_name} не зарегистрировался")
+                    continue
+                for _ in range(args.viewers):
+                    viewer = Viewer(args.server, teacher.cookies, student.client.client_id, metrics)
+                    viewer.start()
+                    viewers.append(viewer)
+
+            # Клиенты запускают FFmpeg и регистрируют стрим несколько секунд, эти секунды не замеряются
+            time.sleep(min(10, args.step_duration / 3))
+            metrics.reset()
+            time.sleep(args.step_duration)
+
+            client_ids = [student.client.client_id for student in students if student.client.client_id]
+            row = {'clients': len(client_ids), 'viewers': len(viewers)}
+            row.update(metrics.snapshot())
+            row.update(stream_lag(teacher, args.server, client_ids))
+            row['degraded'] = degraded(row)
+            results.append(row)
+            report('  '.join(f"{name}={value}" for name, value in row.items()))
+            if row['degraded']:
+                if not args.keep_going:
+                    break
+            else:
+                sustained = row['clients']
+    finally:
+        for viewer in viewers:
+            viewer.stop()
+        for student in students:
+            student.stop()
+
+    report(f"Без деградации: клиентов {sustained}, зрителей {sustained * args.viewers}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'sustained_clients': sustained, 'steps': results}, f, ensure_ascii=False, indent=2)
+    return sustained
+
+
+def main(args):
+    if args.verbose:
+        run_fleet(args)
+        return
+    # Десятки клиентов печатают каждый свой шаг, в выводе остаются только итоги ступеней
+    logging.getLogger().setLevel(logging.WARNING)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        run_fleet(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Симулятор класса: нагрузка на трансляции сервера без Windows')
+    parser.add_argument('--server', type=str, default=client.API_URL,
+                        help=f'Адрес сервера (по умолчанию {client.API_URL})')
+    parser.add_argument('--clients', '-n', type=int, default=50,
+                        help='Сколько клиентов запустить всего (по умолчанию 50)')
+    parser.add_argument('--step', type=int, default=SIM_STEP,
+                        help=f'Сколько клиентов добавлять на каждой ступени (по умолчанию {SIM_STEP})')
+    parser.add_argument('--step-duration', type=float, default=SIM_STEP_DURATION,
+                        help=f'Длительность замера одной ступени, секунды (по умолчанию {SIM_STEP_DURATION})')
+    parser.add_argument('--viewers', type=int, default=SIM_VIEWERS,
+                        help=f'Зрителей на каждый стрим (по умолчанию {SIM_VIEWERS})')
+    parser.add_argument('--resolution', type=str, default=SIM_RESOLUTION,
+                        help=f'Разрешение синтетического экрана (по умолчанию {SIM_RESOLUTION})')
+    parser.add_argument('--base-port', type=int, default=SIM_BASE_PORT,
+                        help=f'TCP порт FFmpeg первого клиента, следующие идут подряд (по умолчанию {SIM_BASE_PORT})')
+    parser.add_argument('--teacher', type=str, default='teacher', help='Логин учителя')
+    parser.add_argument('--password', type=str, default='password', help='Пароль учителя')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='Добавлять клиентов и после деградации')
+    parser.add_argument('--json', type=str, default=None, help='Записать результаты ступеней в JSON файл')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Не скрывать вывод клиентов')
+
+    main(parser.parse_args())
@@ -0,0 +1,240 @@
+import io
+import re
+import json
+import time
+import uuid
+import argparse
+import threading
+import statistics
+import subprocess
+from datetime import datetime
+
+import app as server
+import client
+import mpegts
+
+# Бенчмарк задержки трансляции «захват -> кадр доступен в /hls/» без экрана и без Windows.
+# Кодировщик клиента (StudentClient.build_ffmpeg_command) снимает тестовую картинку lavfi с временем поверх,
+# сервер поднимает настоящий FFmpeg прокси (ensure_ffmpeg_proxy), бенчмарк опрашивает /hls/ как плеер.
+# Время захвата кадра — момент, когда FFmpeg клиента выводит строку фильтра showinfo для этого кадра,
+# номер кадра в HLS сегменте восстанавливается по PTS (кадры идут с постоянной частотой)
+BENCH_STREAM_PORT = 8190
+BENCH_DURATION = 30
+# Кадры первых секунд ждут запуска прокси и не входят в распределение
+BENCH_WARMUP = 5
+BENCH_POLL_INTERVAL = 0.02
+BENCH_STARTUP_TIMEOUT = 15
+BENCH_PROFILE = 'detail'
+BENCH_FPS = 15
+SHOWINFO_FRAME = re.compile(r'Parsed_showinfo.*\sn:\s*(\d+)')
+# Конфигурация — параметры через запятую: hls_time (секунды), list_size, bufsize (Кбит), fps, profile
+CONFIG_PARAMS = {'hls_time': float, 'list_size': int, 'bufsize': int, 'fps': int, 'profile': str}
+DEFAULT_CONFIGS = [
+    'hls_time=0.2',
+    'hls_time=0.5',
+    'hls_time=1',
+    'hls_time=0.2,bufsize=100',
+    'hls_time=0.2,bufsize=1000'
+]
+
+
+def parse_config(text):
+    config = {}
+    for item in filter(None, text.split(',')):
+        name, _, value = item.partition('=')
+        if name not in CONFIG_PARAMS:
+            raise argparse.ArgumentTypeError(f"Неизвестный параметр {name}, допустимы: {', '.join(CONFIG_PARAMS)}")
+        config[name] = CONFIG_PARAMS[name](value)
+    return config
+
+
+def format_config(config):
+    return ','.join(f'{name}={value}' for name, value in config.items()) or 'default'
+
+
+class CaptureClock:
+    """Читает вывод FFmpeg клиента и запоминает, когда фильтр showinfo пропустил каждый кадр."""
+
+    def __init__(self, process):
+        self.captured = {}
+        self.log = []
+        threading.Thread(target=self._read, args=(process.stderr,), daemon=True).start()
+
+    def _read(self, pipe):
+        for line in iter(pipe.readline, b''):
+            now = time.time()
+            text = line.decode('utf-8', 'replace').rstrip()
+            match = SHOWINFO_FRAME.search(text)
+            if match:
+                self.captured.setdefault(int(match.group(1)), now)
+                continue
+            self.log = (self.log + [text])[-20:]
+
+
+def build_source_command(student):
+    cmd = student.build_ffmpeg_command(client.SYNTHETIC_RESOLUTION)
+    # showinfo сразу после источника: строка в stderr появляется в момент «захвата» кадра
+    source = cmd.index('-i') + 1
+    cmd[source] += ',showinfo'
+    return cmd
+
+
+def fetch_new_segments(http, client_id, seen):
+    """Скачивает через /hls/ сегменты плейлиста, которых ещё не видели. Возвращает [(время, данные)]."""
+    response = http.get(f'/hls/{client_id}/playlist.m3u8')
+    if response.status_code != 200:
+        return []
+    fetched = []
+    for line in response.get_data(as_text=True).splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line in seen:
+            continue
+        segment = http.get(line)
+        if segment.status_code != 200:
+            continue
+        fetched.append((time.time(), segment.get_data()))
+        seen.add(line)
+    return fetched
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {'frames': 0}
+    ordered = sorted(latencies)
+    percentiles = statistics.quantiles(ordered, n=100, method='inclusive') if len(ordered) > 1 else ordered * 99
+    return {
+        'frames': len(ordered),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 1),
+        'min_ms': round(ordered[0] * 1000, 1),
+        'p50_ms': round(percentiles[49] * 1000, 1),
+        'p90_ms': round(percentiles[89] * 1000, 1),
+        'p99_ms': round(percentiles[98] * 1000, 1),
+        'max_ms': round(ordered[-1] * 1000, 1)
+    }
+
+
+def run_config(config, duration=BENCH_DURATION, warmup=BENCH_WARMUP, port=BENCH_STREAM_PORT):
+    """Один прогон: кодировщик клиента -> прокси сервера -> /hls/. Возвращает распределение задержки кадров."""
+    client_id = f"bench-{uuid.uuid4().hex[:8]}"
+    server.HLS_SEGMENT_TIME = config.get('hls_time', server.HLS_SEGMENT_TIME)
+    server.HLS_LIST_SIZE = config.get('list_size', server.HLS_LIST_SIZE)
+
+    student = client.StudentClient(client_id)
+    student.client_id = client_id
+    student.stream_port = port
+    student.video_source = 'synthetic'
+    # Номер кадра восстанавливается по PTS, поэтому кодируются все кадры
+    student.skip_static_frames = False
+    student.encoder_profile = config.get('profile', BENCH_PROFILE)
+    student.fps = config.get('fps', BENCH_FPS)
+    student.bufsize = config.get('bufsize')
+    fps = max(1, min(client.ENCODER_PROFILES[student.encoder_profile]['fps'], student.fps))
+
+    source = subprocess.Popen(build_source_command(student), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    clock = CaptureClock(source)
+    result = {'config': format_config(config)}
+    try:
+        # FFmpeg клиента ждёт подключения прокси и только потом начинает выдавать кадры
+        student.ffmpeg_process = source
+        if not student.wait_ffmpeg_listening(BENCH_STARTUP_TIMEOUT):
+            raise RuntimeError('FFmpeg клиента не запустился:\n' + '\n'.join(clock.log))
+
+        server.state.create_client(client_id, {
+            'token': None,
+            'last_seen': datetime.now(),
+            'stream_info': None,
+            'proxy_request': {'url': f'tcp://127.0.0.1:{port}', 'generation': 1}
+        })
+        server.ensure_ffmpeg_proxy(client_id)
+
+        http = server.app.test_client()
+        seen = set()
+        available = {}
+        # Один разборщик на все сегменты: PID видеопотока известен, даже если в сегменте нет PAT/PMT
+        parser = mpegts.VideoStreamParser()
+        first_pts = None
+        end_time = time.time() + duration
+        while time.time() < end_time:
+            for fetched_at, data in fetch_new_segments(http, client_id, seen):
+                for packet in mpegts.iter_packets(io.BytesIO(data)):
+                    frame = parser.feed(packet)
+                    if frame is None or frame.pts is None:
+                        continue
+                    if first_pts is None:
+                        first_pts = frame.pts
+                    number = round(mpegts.pts_delta(first_pts, frame.pts) * fps)
+                    available.setdefault(number, fetched_at)
+            time.sleep(BENCH_POLL_INTERVAL)
+
+        hls_path = (server.state.get_client(client_id).get('proxy') or {}).get('hls_path')
+        health = server.stream_health(hls_path) if hls_path else {}
+        if not clock.captured:
+            raise RuntimeError('FFmpeg клиента не выдал ни одного кадра:\n' + '\n'.join(clock.log))
+
+        capture_start = clock.captured.get(0, min(clock.captured.values()))
+        latencies = [
+            fetched_at - clock.captured[number]
+            for number, fetched_at in available.items()
+            if number in clock.captured and clock.captured[number] - capture_start >= warmup
+        ]
+        result.update(latency_summary(latencies))
+        result.update({
+            'segments': len(seen),
+            'frames_captured': len(clock.captured),
+            'frames_fetched': len(available),
+            'fps': health.get('fps'),
+            'bitrate_kbps': health.get('bitrate_kbps'),
+            'segment_duration_jitter': health.get('segment_duration_jitter')
+        })
+    except RuntimeError as e:
+        result['error'] = str(e)
+    finally:
+        server.stop_ffmpeg_proxy(client_id)
+        server.state.delete_client(client_id)
+        if source.poll() is None:
+            source.terminate()
+            try:
+                source.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                source.kill()
+    return result
+
+
+def print_results(results):
+    columns = ['config', 'frames', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'segments', 'fps', 'bitrate_kbps']
+    widths = [max(len(column), *(len(str(result.get(column, ''))) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        if 'error' in result:
+            print(f"{result['config']}: {result['error']}")
+            continue
+        print('  '.join(str(result.get(column, '')).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main(args):
+    configs = args.config or [parse_config(text) for text in DEFAULT_CONFIGS]
+    results = []
+    for config in configs:
+        print(f"Прогон {format_config(config)}: {args.duration} с...")
+        results.append(run_config(config, args.duration, args.warmup, args.port))
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.json}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Замер задержки трансляции: синтетический источник FFmpeg -> HLS прокси сервера')
+    parser.add_argument('--config', action='append', type=parse_config,
+                        help='Конфигурация прогона, например hls_time=0.5,bufsize=300 (можно указать несколько раз)')
+    parser.add_argument('--duration', type=float, default=BENCH_DURATION,
+                        help=f'Длительность прогона одной конфигурации, секунды (по умолчанию {BENCH_DURATION})')
+    parser.add_argument('--warmup', type=float, default=BENCH_WARMUP,
+                        help=f'Сколько первых секунд не учитывать (по умолчанию {BENCH_WARMUP})')
+    parser.add_argument('--port', type=int, default=BENCH_STREAM_PORT,
+                        help=f'TCP порт кодировщика (по умолчанию {BENCH_STREAM_PORT})')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Записать результаты в JSON файл')
+
+    main(parser.parse_args())
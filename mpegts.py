@@ -0,0 +1,275 @@
+import statistics
+from collections import namedtuple
+
+# Разбор MPEG-TS, который пишет FFmpeg прокси: пакеты, таблицы PAT/PMT и заголовки PES видеопотока.
+# Декодирование не нужно: время берётся из PTS/DTS и PCR, ключевые кадры — из флага random access
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PAT_PID = 0
+NULL_PID = 0x1FFF
+PTS_CLOCK = 90000
+PCR_CLOCK = 27000000
+PTS_WRAP = 1 << 33
+VIDEO_STREAM_TYPES = {0x01: 'mpeg1', 0x02: 'mpeg2', 0x10: 'mpeg4', 0x1B: 'h264', 0x24: 'hevc'}
+READ_CHUNK_PACKETS = 4096
+
+TSPacket = namedtuple('TSPacket', 'offset pid unit_start random_access continuity pcr payload')
+VideoFrame = namedtuple('VideoFrame', 'offset pts dts keyframe table_offset')
+
+
+def parse_packet(packet, offset=0):
+    pid = ((packet[1] & 0x1F) << 8) | packet[2]
+    unit_start = bool(packet[1] & 0x40)
+    adaptation = (packet[3] >> 4) & 0x3
+    continuity = packet[3] & 0x0F
+    random_access = False
+    pcr = None
+    payload_start = 4
+
+    if adaptation & 0x2:
+        length = packet[4]
+        if length > 0:
+            random_access = bool(packet[5] & 0x40)
+            if packet[5] & 0x10 and length >= 7:
+                base = (packet[6] << 25) | (packet[7] << 17) | (packet[8] << 9) | (packet[9] << 1) | (packet[10] >> 7)
+                pcr = base * 300 + (((packet[10] & 0x01) << 8) | packet[11])
+        payload_start = 5 + length
+
+    # Continuity counter растёт только у пакетов с полезной нагрузкой
+    if not adaptation & 0x1:
+        continuity = None
+    payload = packet[payload_start:] if adaptation & 0x1 and payload_start < TS_PACKET_SIZE else b''
+    return TSPacket(offset, pid, unit_start, random_access, continuity, pcr, payload)
+
+
+def iter_packets(stream, chunk_packets=READ_CHUNK_PACKETS):
+    """Пакеты из файла или потока. При потере синхронизации ищет следующий байт 0x47."""
+    buffer = b''
+    position = 0
+    while True:
+        chunk = stream.read(TS_PACKET_SIZE * chunk_packets)
+        if not chunk:
+            return
+        buffer += chunk
+        index = 0
+        while index + TS_PACKET_SIZE <= len(buffer):
+            if buffer[index] != TS_SYNC_BYTE:
+                sync = buffer.find(bytes([TS_SYNC_BYTE]), index + 1)
+                if sync < 0:
+                    index = len(buffer)
+                    break
+                index = sync
+                continue
+            yield parse_packet(buffer[index:index + TS_PACKET_SIZE], position + index)
+            index += TS_PACKET_SIZE
+        position += index
+        buffer = buffer[index:]
+
+
+def _section(payload):
+    """Секция PSI из пакета с началом секции: пропускает pointer_field."""
+    if not payload:
+        return b''
+    start = 1 + payload[0]
+    return payload[start:]
+
+
+def parse_pat(payload):
+    """PID таблиц PMT из PAT."""
+    section = _section(payload)
+    if len(section) < 8 or section[0] != 0x00:
+        return []
+    end = min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+    pids = []
+    for index in range(8, end - 3, 4):
+        program = (section[index] << 8) | section[index + 1]
+        if program != 0:
+            pids.append(((section[index + 2] & 0x1F) << 8) | section[index + 3])
+    return pids
+
+
+def parse_pmt(payload):
+    """(PID, кодек) первого видеопотока из PMT или None."""
+    section = _section(payload)
+    if len(section) < 12 or section[0] != 0x02:
+        return None
+    end = min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+    index = 12 + (((section[10] & 0x0F) << 8) | section[11])
+    while index + 5 <= end:
+        stream_type = section[index]
+        pid = ((section[index + 1] & 0x1F) << 8) | section[index + 2]
+        if stream_type in VIDEO_STREAM_TYPES:
+            return pid, VIDEO_STREAM_TYPES[stream_type]
+        index += 5 + (((section[index + 3] & 0x0F) << 8) | section[index + 4])
+    return None
+
+
+def parse_timestamp(data):
+    return (((data[0] >> 1) & 0x07) << 30) | (data[1] << 22) | ((data[2] >> 1) << 15) | (data[3] << 7) | (data[4] >> 1)
+
+
+def parse_pes_header(payload):
+    """(pts, dts, смещение данных кадра) из начала PES или None."""
+    if len(payload) < 9 or payload[0:3] != b'\x00\x00\x01':
+        return None
+    flags = payload[7]
+    data_start = 9 + payload[8]
+    pts = dts = None
+    if flags & 0x80 and len(payload) >= 14:
+        pts = dts = parse_timestamp(payload[9:14])
+    if flags & 0x40 and len(payload) >= 19:
+        dts = parse_timestamp(payload[14:19])
+    return pts, dts, data_start
+
+
+def h264_has_idr(data):
+    """Есть ли в начале кадра H.264 NAL unit IDR или SPS: запасной признак, если нет флага random access."""
+    index = data.find(b'\x00\x00\x01')
+    while 0 <= index < len(data) - 3:
+        nal_type = data[index + 3] & 0x1F
+        if nal_type in (5, 7):
+            return True
+        index = data.find(b'\x00\x00\x01', index + 3)
+    return False
+
+
+def pts_delta(start, end):
+    """Разница PTS в секундах с учётом переполнения 33-битного счётчика."""
+    return ((end - start) % PTS_WRAP) / PTS_CLOCK
+
+
+class VideoStreamParser:
+    """Находит видеопоток по PAT/PMT и выдаёт начала его кадров (PES) с PTS и признаком ключевого кадра.
+    table_offset — смещение последней PAT перед ключевым кадром: с него сегмент можно декодировать отдельно."""
+
+    def __init__(self):
+        self.pmt_pids = set()
+        self.video_pid = None
+        self.codec = None
+        self._table_offset = None
+
+    def feed(self, packet):
+        if packet.pid == PAT_PID:
+            if packet.unit_start:
+                self.pmt_pids = set(parse_pat(packet.payload))
+                self._table_offset = packet.offset
+            return None
+
+        if packet.pid in self.pmt_pids:
+            if packet.unit_start and self.video_pid is None:
+                video = parse_pmt(packet.payload)
+                if video:
+                    self.video_pid, self.codec = video
+            return None
+
+        if packet.pid != self.video_pid or not packet.unit_start:
+            return None
+
+        header = parse_pes_header(packet.payload)
+        if header is None:
+            return None
+        pts, dts, data_start = header
+        keyframe = packet.random_access
+        if not keyframe and self.codec == 'h264':
+            keyframe = h264_has_idr(packet.payload[data_start:])
+
+        table_offset = self._table_offset if keyframe else None
+        self._table_offset = None
+        return VideoFrame(packet.offset, pts, dts, keyframe, table_offset)
+
+
+def iter_video_frames(stream):
+    parser = VideoStreamParser()
+    for packet in iter_packets(stream):
+        frame = parser.feed(packet)
+        if frame is not None:
+            yield frame
+
+
+class StreamStats:
+    """Метрики видеопотока по его пакетам: частота кадров, битрейт, длина GOP, ошибки continuity counter
+    и интервалы PCR. Сегменты одного плейлиста передаются по порядку в один объект."""
+
+    def __init__(self):
+        self.parser = VideoStreamParser()
+        self.continuity = {}
+        self.continuity_errors = 0
+        self.packets = 0
+        self.video_bytes = 0
+        self.frames = 0
+        self.keyframes = 0
+        self.gop_lengths = []
+        self._frames_since_key = None
+        self.first_dts = None
+        self.last_dts = None
+        self.last_pcr = None
+        self.pcr_intervals = []
+
+    def feed(self, packet):
+        self.packets += 1
+        self._check_continuity(packet)
+
+        if packet.pcr is not None:
+            if self.last_pcr is not None:
+                self.pcr_intervals.append(((packet.pcr - self.last_pcr) % (PTS_WRAP * 300)) / PCR_CLOCK)
+            self.last_pcr = packet.pcr
+
+        frame = self.parser.feed(packet)
+        if packet.pid == self.parser.video_pid:
+            self.video_bytes += TS_PACKET_SIZE
+        if frame is None or frame.dts is None:
+            return frame
+
+        self.frames += 1
+        if self.first_dts is None:
+            self.first_dts = frame.dts
+        self.last_dts = frame.dts
+        if frame.keyframe:
+            self.keyframes += 1
+            if self._frames_since_key is not None:
+                self.gop_lengths.append(self._frames_since_key)
+            self._frames_since_key = 1
+        elif self._frames_since_key is not None:
+            self._frames_since_key += 1
+        return frame
+
+    def feed_stream(self, stream):
+        """Разбирает сегмент. Возвращает (первый DTS, последний DTS, число кадров) этого сегмента."""
+        first = last = None
+        frames = 0
+        for packet in iter_packets(stream):
+            frame = self.feed(packet)
+            if frame is not None and frame.dts is not None:
+                first = frame.dts if first is None else first
+                last = frame.dts
+                frames += 1
+        return first, last, frames
+
+    def _check_continuity(self, packet):
+        if packet.continuity is None or packet.pid == NULL_PID:
+            return
+        previous = self.continuity.get(packet.pid)
+        # Повтор пакета с тем же счётчиком допускается стандартом
+        if previous is not None and packet.continuity not in (previous, (previous + 1) & 0x0F):
+            self.continuity_errors += 1
+        self.continuity[packet.pid] = packet.continuity
+
+    def summary(self):
+        duration = pts_delta(self.first_dts, self.last_dts) if self.frames > 1 else 0
+        # Длительность последнего кадра не входит в разницу DTS
+        if duration > 0:
+            duration += duration / (self.frames - 1)
+        fps = self.frames / duration if duration > 0 else None
+        gop_frames = statistics.mean(self.gop_lengths) if self.gop_lengths else None
+        return {
+            'codec': self.parser.codec,
+            'frames': self.frames,
+            'duration': round(duration, 3),
+            'fps': round(fps, 2) if fps else None,
+            'bitrate_kbps': round(self.video_bytes * 8 / duration / 1000, 1) if duration > 0 else None,
+            'gop_frames': round(gop_frames, 1) if gop_frames else None,
+            'gop_seconds': round(gop_frames / fps, 2) if gop_frames and fps else None,
+            'keyframes': self.keyframes,
+            'continuity_errors': self.continuity_errors,
+            'pcr_interval_max_ms': round(max(self.pcr_intervals) * 1000, 1) if self.pcr_intervals else None
+        }
@@ -0,0 +1,237 @@
+import os
+import json
+import math
+import time
+import logging
+from bisect import bisect_right
+from datetime import datetime
+
+import mpegts
+
+logger = logging.getLogger(__name__)
+
+# Запись стрима — файлы MPEG-TS по RECORDING_SEGMENT_TIME секунд, имя файла — время начала записи.
+# Рядом с законченным файлом лежит индекс <файл>.idx: PTS первого и последнего кадра и ключевые кадры
+# [миллисекунды от начала файла, смещение в байтах], по нему строятся VOD плейлисты с EXT-X-BYTERANGE
+RECORDING_FILE_FORMAT = '%Y%m%d-%H%M%S'
+RECORDING_EXTENSION = '.ts'
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 1
+# Разрыв PTS между соседними файлами больше этого значения — новый таймлайн (EXT-X-DISCONTINUITY)
+DISCONTINUITY_GAP = 5
+
+
+def recording_file_start(filename):
+    """Время начала файла записи по его имени или None, если это не файл записи."""
+    name, extension = os.path.splitext(os.path.basename(filename))
+    if extension != RECORDING_EXTENSION:
+        return None
+    try:
+        return datetime.strptime(name, RECORDING_FILE_FORMAT)
+    except ValueError:
+        return None
+
+
+def list_recording_files(record_path):
+    """[(время начала, путь)] файлов записи в порядке времени."""
+    try:
+        names = os.listdir(record_path)
+    except FileNotFoundError:
+        return []
+    files = []
+    for name in names:
+        start = recording_file_start(name)
+        if start is not None:
+            files.append((start, os.path.join(record_path, name)))
+    files.sort()
+    return files
+
+
+def is_finished(path, files, segment_time):
+    """Файл закончен, если после него начат следующий или он давно не менялся."""
+    if files and files[-1][1] != path:
+        return True
+    try:
+        return time.time() - os.path.getmtime(path) > segment_time * 2
+    except FileNotFoundError:
+        return True
+
+
+def build_index(path):
+    size = os.path.getsize(path)
+    first_pts = last_pts = None
+    keyframes = []
+    with open(path, 'rb') as f:
+        for frame in mpegts.iter_video_frames(f):
+            if frame.pts is None:
+                continue
+            if first_pts is None:
+                first_pts = frame.pts
+            last_pts = frame.pts
+            if frame.keyframe:
+                offset = frame.table_offset if frame.table_offset is not None else frame.offset
+                keyframes.append([round(mpegts.pts_delta(first_pts, frame.pts) * 1000), offset])
+
+    return {
+        'version': INDEX_VERSION,
+        'size': size,
+        'first_pts': first_pts,
+        'last_pts': last_pts,
+        'duration': mpegts.pts_delta(first_pts, last_pts) if first_pts is not None else 0,
+        'keyframes': keyframes
+    }
+
+
+def load_index(path, finished=True):
+    """Индекс файла записи. Индекс законченного файла строится один раз и сохраняется рядом с ним."""
+    index_path = path + INDEX_SUFFIX
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION and index.get('size') == os.path.getsize(path):
+            return index
+    except (FileNotFoundError, ValueError):
+        pass
+
+    index = build_index(path)
+    if finished:
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    return index
+
+
+def index_finished(record_path, segment_time):
+    """Строит недостающие индексы законченных файлов, чтобы плейлисты не ждали разбора файлов."""
+    files = list_recording_files(record_path)
+    for _, path in files:
+        if is_finished(path, files, segment_time) and not os.path.exists(path + INDEX_SUFFIX):
+            try:
+                load_index(path)
+            except OSError as e:
+                logger.warning(f"Не удалось проиндексировать запись {path}: {e}")
+
+
+def recording_spans(record_path, segment_time):
+    """Файлы записи клиента с интервалами времени, которые они покрывают."""
+    files = list_recording_files(record_path)
+    spans = []
+    for start, path in files:
+        try:
+            index = load_index(path, is_finished(path, files, segment_time))
+        except (FileNotFoundError, OSError) as e:
+            logger.warning(f"Не удалось проиндексировать запись {path}: {e}")
+            continue
+        spans.append({
+            'file': os.path.basename(path),
+            'start': start,
+            'duration': index['duration'],
+            'size': index['size'],
+            'keyframes': len(index['keyframes']),
+            'index': index
+        })
+    return spans
+
+
+def vod_playlist(record_path, segment_time, url_prefix, start=None, end=None):
+    """VOD плейлист HLS за интервал [start, end]: куски файлов между ключевыми кадрами через EXT-X-BYTERANGE.
+    Возвращает None, если за интервал нет записи."""
+    entries = []
+    target_duration = 1
+    previous = None
+
+    for span in recording_spans(record_path, segment_time):
+        index = span['index']
+        keyframes = index['keyframes']
+        if not keyframes:
+            continue
+        file_start = span['start'].timestamp()
+        if end is not None and file_start > end.timestamp():
+            break
+        if start is not None and file_start + span['duration'] < start.timestamp():
+            continue
+
+        # Первый ключевой кадр не позже начала интервала: с него начинается воспроизведение
+        first = 0
+        if start is not None:
+            first = max(0, bisect_right([k[0] for k in keyframes], (start.timestamp() - file_start) * 1000) - 1)
+
+        chunks = []
+        for number in range(first, len(keyframes)):
+            chunk_start, offset = keyframes[number]
+            if end is not None and file_start + chunk_start / 1000 > end.timestamp():
+                break
+            if number + 1 < len(keyframes):
+                chunk_end, next_offset = keyframes[number + 1]
+            else:
+                chunk_end, next_offset = span['duration'] * 1000, index['size']
+            duration = max((chunk_end - chunk_start) / 1000, 0.04)
+            chunks.append((file_start + chunk_start / 1000, duration, offset, next_offset - offset))
+            target_duration = max(target_duration, math.ceil(duration))
+        if not chunks:
+            continue
+
+        discontinuity = previous is not None and (
+            index['first_pts'] is None or previous['last_pts'] is None
+            or mpegts.pts_delta(previous['last_pts'], index['first_pts']) > DISCONTINUITY_GAP
+        )
+        entries.append((span['file'], discontinuity, chunks))
+        previous = index
+
+    if not entries:
+        return None
+
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:4',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        f'#EXT-X-TARGETDURATION:{target_duration}',
+        '#EXT-X-MEDIA-SEQUENCE:0'
+    ]
+    for filename, discontinuity, chunks in entries:
+        if discontinuity:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{datetime.fromtimestamp(chunks[0][0]).astimezone().isoformat(timespec="milliseconds")}')
+        for _, duration, offset, length in chunks:
+            lines.append(f'#EXTINF:{duration:.3f},')
+            lines.append(f'#EXT-X-BYTERANGE:{length}@{offset}')
+            lines.append(f'{url_prefix}/{filename}')
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def enforce_retention(recording_root, max_bytes, max_age, segment_time):
+    """Удаляет старейшие законченные файлы записи всех клиентов, пока архив больше max_bytes,
+    и файлы старше max_age секунд. Возвращает число удалённых файлов."""
+    files = []
+    try:
+        client_ids = os.listdir(recording_root)
+    except FileNotFoundError:
+        return 0
+    for client_id in client_ids:
+        client_files = list_recording_files(os.path.join(recording_root, client_id))
+        for start, path in client_files:
+            if not is_finished(path, client_files, segment_time):
+                continue
+            try:
+                files.append((start, path, os.path.getsize(path)))
+            except FileNotFoundError:
+                continue
+    files.sort()
+
+    total = sum(size for _, _, size in files)
+    oldest_allowed = datetime.fromtimestamp(time.time() - max_age)
+    removed = 0
+    for start, path, size in files:
+        if total <= max_bytes and start >= oldest_allowed:
+            break
+        for file_path in (path, path + INDEX_SUFFIX):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        removed += 1
+        logger.info(f"Удалён файл записи по ограничению архива: {path}")
+    return removed
@@ -0,0 +1,918 @@
+import os
+import copy
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# История команд одного клиента в MemoryStateBackend ограничена по числу записей и по объёму
+# вывода в памяти. Завершённые команды сверх лимитов вытесняются в архив на диске,
+# первыми — те, к которым дольше всего не обращались
+COMMAND_MEMORY_LIMIT = 100
+COMMAND_MEMORY_BYTES = 2 * 1024 * 1024
+COMMAND_FINISHED_STATUSES = ('completed', 'cancelled')
+COMMAND_ACTIVE_STATUSES = ('pending', 'queued', 'running')
+COMMAND_ARCHIVE_PATH = 'command_archive.db'
+COMMAND_OUTPUT_FIELDS = ('stdout', 'stderr')
+
+
+def process_key(pid, create_time):
+    """Ключ процесса в снимке: pid переиспользуется системой, поэтому вместе со временем запуска."""
+    return f"{pid}:{round(float(create_time or 0), 3)}"
+
+
+def status_matches(cmd, statuses):
+    if isinstance(statuses, str):
+        statuses = (statuses,)
+    return cmd.get('status') in statuses
+
+
+def command_summary(cmd):
+    """Запись команды без тел вывода, вместо них — размеры stdout_size/stderr_size."""
+    summary = {field: value for field, value in cmd.items() if field not in COMMAND_OUTPUT_FIELDS}
+    for field in COMMAND_OUTPUT_FIELDS:
+        summary.setdefault(f"{field}_size", len((cmd.get(field) or '').encode('utf-8')))
+    return summary
+
+
+def command_memory_size(cmd):
+    """Примерный объём записи команды в памяти: вывод плюс служебные поля."""
+    return 512 + len(cmd.get('stdout') or '') + len(cmd.get('stderr') or '')
+
+
+def merge_process_snapshot(snapshot, delta):
+    """Применяет дельту списка процессов к снимку. Возвращает новый снимок или None, если базы не совпали."""
+    version = snapshot['version'] if snapshot else 0
+    if delta.get('full'):
+        processes = {}
+    elif snapshot is None or delta.get('base_version') != version:
+        return None
+    else:
+        processes = snapshot['processes']
+
+    for key in delta.get('removed', []):
+        processes.pop(key, None)
+    for record in delta.get('upserts', []):
+        processes[process_key(record['pid'], record.get('create_time'))] = record
+
+    return {
+        'version': version + 1,
+        'updated_at': datetime.now().isoformat(),
+        'processes': processes
+    }
+
+
+def merge_client_state(client, version, fields, keyframe):
+    """Применяет версионированное обновление состояния клиента (system_info, screen_info).
+
+    version — [epoch, seq]: epoch меняется при перезапуске клиента, seq растёт с каждым обновлением.
+    Возвращает 'applied', 'stale' (обновление старее уже принятого) или 'keyframe_required'.
+    """
+    current = client.get('state_version')
+    if current is not None and list(version) <= list(current):
+        return 'stale'
+    # Изменения имеют смысл только поверх полного состояния той же сессии клиента
+    if not keyframe and (current is None or current[0] != version[0]):
+        return 'keyframe_required'
+
+    for field, values in fields.items():
+        if keyframe or not isinstance(client.get(field), dict):
+            client[field] = dict(values)
+        else:
+            client[field].update(values)
+    client['state_version'] = list(version)
+    return 'applied'
+
+
+class CommandArchive:
+    """Завершённые команды, вытесненные из памяти MemoryStateBackend. Хранятся в SQLite,
+    содержимое прошлого запуска удаляется: состояние в памяти его всё равно не помнит.
+    Рядом с полной записью (data) лежит запись без вывода (summary): списки и курсор истории
+    читают только её, полная запись поднимается лишь для одной команды (get)."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+        DROP TABLE IF EXISTS archived_commands;
+        CREATE TABLE archived_commands (
+            client_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            timestamp TEXT,
+            rev INTEGER NOT NULL,
+            summary TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (client_id, id)
+        );
+        CREATE INDEX idx_archived_commands_rev ON archived_commands (client_id, rev);
+        ''')
+
+    def put(self, client_id, command):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO archived_commands (client_id, id, timestamp, rev, summary, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (client_id, command['id'], command.get('timestamp'), command.get('rev', 0),
+             json.dumps(command_summary(command)), json.dumps(command))
+        )
+
+    def get(self, client_id, command_id):
+        row = self._conn.execute(
+            "SELECT data FROM archived_commands WHERE client_id = ? AND id = ?", (client_id, command_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list(self, client_id):
+        """Записи команд клиента без вывода."""
+        rows = self._conn.execute(
+            "SELECT summary FROM archived_commands WHERE client_id = ? ORDER BY timestamp", (client_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def changes(self, client_id, since, limit):
+        """Записи без вывода, изменившиеся после ревизии since."""
+        rows = self._conn.execute(
+            "SELECT summary FROM archived_commands WHERE client_id = ? AND rev > ? ORDER BY rev LIMIT ?",
+            (client_id, since, limit)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def delete_client(self, client_id):
+        self._conn.execute("DELETE FROM archived_commands WHERE client_id = ?", (client_id,))
+
+
+class MemoryStateBackend:
+    """Состояние в памяти процесса. Подходит только для одного воркера."""
+
+    def __init__(self, archive_path=None, command_limit=COMMAND_MEMORY_LIMIT, command_bytes=COMMAND_MEMORY_BYTES):
+        self._lock = threading.RLock()
+        self._clients = {}
+        self._sessions = {}
+        self._commands = {}
+        self._notifications = {}
+        self._leases = {}
+        self._counters = {}
+        self._groups = {}
+        self._process_snapshots = {}
+        self._thumbnails = {}
+        # Ревизия команд растёт при каждом изменении: курсор истории команд (list_command_changes)
+        self._command_rev = 0
+        # Завершённые команды в памяти в порядке последнего обращения: кандидаты на вытеснение в архив
+        self._finished_lru = {}
+        self._archive = CommandArchive(archive_path or COMMAND_ARCHIVE_PATH)
+        self.command_limit = command_limit
+        self.command_bytes = command_bytes
+        # Подписчики на изменения (kind, client_id): асинхронный сервер будит по ним длинные опросы
+        self._listeners = []
+
+    def add_change_listener(self, callback):
+        """callback(kind, client_id) вызывается под блокировкой состояния, поэтому должен быть быстрым.
+        kind: 'client', 'commands' или 'notifications'."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def _changed(self, kind, client_id):
+        for callback in self._listeners:
+            callback(kind, client_id)
+
+    # Клиенты
+
+    def create_client(self, client_id, data):
+        with self._lock:
+            self._clients[client_id] = copy.deepcopy(data)
+            self._commands.setdefault(client_id, [])
+
+    def get_client(self, client_id):
+        with self._lock:
+            client = self._clients.get(client_id)
+            return copy.deepcopy(client) if client is not None else None
+
+    def update_client(self, client_id, **fields):
+        with self._lock:
+            if client_id not in self._clients:
+                return False
+            self._clients[client_id].update(copy.deepcopy(fields))
+            self._changed('client', client_id)
+            return True
+
+    def merge_client_field(self, client_id, field, values):
+        """Дополняет вложенный словарь записи клиента (system_info, screen_info и т.п.)."""
+        with self._lock:
+            if client_id not in self._clients:
+                return False
+            self._clients[client_id].setdefault(field, {})
+            if self._clients[client_id][field] is None:
+                self._clients[client_id][field] = {}
+            self._clients[client_id][field].update(copy.deepcopy(values))
+            return True
+
+    def apply_client_state(self, client_id, version, fields, keyframe=False):
+        """Возвращает (результат merge_client_state или 'missing', текущая версия)."""
+        with self._lock:
+            client = self._clients.get(client_id)
+            if client is None:
+                return 'missing', None
+            result = merge_client_state(client, version, copy.deepcopy(fields), keyframe)
+            return result, client.get('state_version')
+
+    def touch_client(self, client_id):
+        return self.update_client(client_id, last_seen=datetime.now())
+
+    def delete_client(self, client_id):
+        with self._lock:
+            self._clients.pop(client_id, None)
+            self._commands.pop(client_id, None)
+            self._finished_lru.pop(client_id, None)
+            self._notifications.pop(client_id, None)
+            self._process_snapshots.pop(client_id, None)
+            self._thumbnails.pop(client_id, None)
+            self._archive.delete_client(client_id)
+
+    def all_clients(self):
+        with self._lock:
+            return copy.deepcopy(self._clients)
+
+    # Сессии учителей
+
+    def get_session(self, session_token):
+        with self._lock:
+            session_data = self._sessions.get(session_token)
+            return dict(session_data) if session_data is not None else None
+
+    def set_session(self, session_token, data):
+        with self._lock:
+            self._sessions[session_token] = dict(data)
+
+    def delete_session(self, session_token):
+        with self._lock:
+            self._sessions.pop(session_token, None)
+
+    def all_sessions(self):
+        with self._lock:
+            return {token: dict(data) for token, data in self._sessions.items()}
+
+    # Очередь команд
+
+    def add_command(self, client_id, command):
+        with self._lock:
+            self._command_rev += 1
+            command = dict(command, rev=self._command_rev)
+            self._commands.setdefault(client_id, []).append(command)
+            self._touch_command(client_id, command)
+            self._enforce_retention(client_id)
+            self._changed('commands', client_id)
+
+    def list_commands(self, client_id):
+        """Команды клиента по времени. Вытесненные в архив приходят без stdout/stderr
+        (только их размеры), полная запись — через get_command."""
+        with self._lock:
+            commands = [dict(cmd) for cmd in self._commands.get(client_id, [])]
+            archived = self._archive.list(client_id)
+            if archived:
+                commands = sorted(archived + commands, key=lambda cmd: cmd.get('timestamp') or '')
+            return commands
+
+    def list_active_commands(self, client_id):
+        """Команды, ещё не завершённые клиентом. Они никогда не вытесняются в архив."""
+        with self._lock:
+            return [dict(cmd) for cmd in self._commands.get(client_id, [])
+                    if cmd.get('status') in COMMAND_ACTIVE_STATUSES]
+
+    def get_command(self, client_id, command_id):
+        with self._lock:
+            for cmd in self._commands.get(client_id, []):
+                if cmd.get('id') == command_id:
+                    self._touch_command(client_id, cmd)
+                    return dict(cmd)
+            return self._archive.get(client_id, command_id)
+
+    def update_command(self, client_id, command_id, only_status=None, **fields):
+        """Обновляет поля команды. only_status (статус или кортеж статусов) ограничивает
+        обновление командами в этих статусах."""
+        with self._lock:
+            for cmd in self._commands.get(client_id, []):
+                if cmd.get('id') == command_id:
+                    if only_status and not status_matches(cmd, only_status):
+                        return False
+                    self._command_rev += 1
+                    cmd.update(fields, rev=self._command_rev)
+                    self._touch_command(client_id, cmd)
+                    self._enforce_retention(client_id)
+                    self._changed('commands', client_id)
+                    return True
+            
+            # Вытесненная команда обновляется прямо в архиве, обратно в память не поднимается
+            cmd = self._archive.get(client_id, command_id)
+            if cmd is None or (only_status and not status_matches(cmd, only_status)):
+                return False
+            self._command_rev += 1
+            cmd.update(fields, rev=self._command_rev)
+            self._archive.put(client_id, cmd)
+            self._changed('commands', client_id)
+            return True
+
+    def update_commands_by_status(self, client_id, only_status, **fields):
+        """Обновляет поля всех команд клиента в статусе only_status. Возвращает их число."""
+        with self._lock:
+            updated = 0
+            for cmd in self._commands.get(client_id, []):
+                if cmd.get('status') == only_status:
+                    self._command_rev += 1
+                    cmd.update(fields, rev=self._command_rev)
+                    self._touch_command(client_id, cmd)
+                    updated += 1
+            self._enforce_retention(client_id)
+            if updated:
+                self._changed('commands', client_id)
+            return updated
+
+    def list_command_changes(self, client_id, since=0, limit=100):
+        """Команды клиента, изменившиеся после ревизии since, в порядке изменения.
+        Вытесненные в архив, как и в list_commands, приходят без вывода."""
+        with self._lock:
+            changed = [cmd for cmd in self._commands.get(client_id, []) if cmd.get('rev', 0) > since]
+            changed += self._archive.changes(client_id, since, limit)
+            changed.sort(key=lambda cmd: cmd['rev'])
+            return [dict(cmd) for cmd in changed[:limit]]
+
+    def _touch_command(self, client_id, cmd):
+        if cmd.get('status') in COMMAND_FINISHED_STATUSES:
+            lru = self._finished_lru.setdefault(client_id, OrderedDict())
+            lru[cmd['id']] = True
+            lru.move_to_end(cmd['id'])
+
+    def _enforce_retention(self, client_id):
+        commands = self._commands.get(client_id, [])
+        lru = self._finished_lru.get(client_id)
+        size = sum(command_memory_size(cmd) for cmd in commands)
+        
+        while lru and (len(commands) > self.command_limit or size > self.command_bytes):
+            command_id, _ = lru.popitem(last=False)
+            for index, cmd in enumerate(commands):
+                if cmd.get('id') == command_id:
+                    break
+            else:
+                continue
+            del commands[index]
+            self._archive.put(client_id, cmd)
+            size -= command_memory_size(cmd)
+            logger.debug(f"Команда {command_id} клиента {client_id} вытеснена в архив")
+
+    # Уведомления
+
+    def add_notification(self, client_id, notification):
+        with self._lock:
+            self._notifications.setdefault(client_id, []).append(dict(notification))
+            self._changed('notifications', client_id)
+
+    def take_notifications(self, client_id, since_time):
+        """Забирает уведомления новее since_time и удаляет их из очереди."""
+        with self._lock:
+            taken = []
+            remaining = []
+            for notification in self._notifications.get(client_id, []):
+                try:
+                    if datetime.fromisoformat(notification['timestamp']) > since_time:
+                        taken.append(notification)
+                        continue
+                except (ValueError, KeyError):
+                    pass
+                remaining.append(notification)
+            self._notifications[client_id] = remaining
+            return taken
+
+    # Снимки процессов
+
+    def get_process_snapshot(self, client_id):
+        with self._lock:
+            snapshot = self._process_snapshots.get(client_id)
+            return copy.deepcopy(snapshot) if snapshot is not None else None
+
+    def apply_process_delta(self, client_id, delta):
+        """Возвращает (применено, текущая версия снимка)."""
+        with self._lock:
+            current = self._process_snapshots.get(client_id)
+            snapshot = merge_process_snapshot(current, copy.deepcopy(delta))
+            if snapshot is None:
+                return False, current['version'] if current else 0
+            self._process_snapshots[client_id] = snapshot
+            return True, snapshot['version']
+
+    # Миниатюры экрана
+
+    def set_thumbnail(self, client_id, thumbnail):
+        """thumbnail: image (bytes), mimetype, etag, phash, updated_at."""
+        with self._lock:
+            self._thumbnails[client_id] = dict(thumbnail)
+
+    def get_thumbnail(self, client_id):
+        with self._lock:
+            thumbnail = self._thumbnails.get(client_id)
+            return dict(thumbnail) if thumbnail is not None else None
+
+    # Групповые команды
+
+    def create_group(self, group_id, data):
+        with self._lock:
+            self._groups[group_id] = copy.deepcopy(data)
+
+    def get_group(self, group_id):
+        with self._lock:
+            group = self._groups.get(group_id)
+            return copy.deepcopy(group) if group is not None else None
+
+    def delete_groups_before(self, created_before):
+        """Удаляет группы, созданные раньше created_before (datetime)."""
+        with self._lock:
+            expired = [group_id for group_id, group in self._groups.items()
+                       if datetime.fromisoformat(group['created_at']) < created_before]
+            for group_id in expired:
+                del self._groups[group_id]
+            return len(expired)
+
+    # Аренды (владение ffmpeg прокси и т.п.)
+
+    def acquire_lease(self, name, owner, ttl):
+        with self._lock:
+            now = time.time()
+            current = self._leases.get(name)
+            if current and current['owner'] != owner and current['expires'] > now:
+                return False
+            self._leases[name] = {'owner': owner, 'expires': now + ttl}
+            return True
+
+    def release_lease(self, name, owner):
+        with self._lock:
+            current = self._leases.get(name)
+            if current and current['owner'] == owner:
+                del self._leases[name]
+
+    def lease_owner(self, name):
+        with self._lock:
+            current = self._leases.get(name)
+            if current and current['expires'] > time.time():
+                return current['owner']
+            return None
+
+    def next_counter(self, name, start=0):
+        with self._lock:
+            value = self._counters.get(name, start)
+            self._counters[name] = value + 1
+            return value
+
+
+class SQLiteStateBackend:
+    """Состояние в SQLite в режиме WAL, общее для всех воркеров на одной машине."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # После fork (gunicorn --preload) соединение родителя использовать нельзя
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _ImmediateTransaction(self._connect())
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS state_clients (
+            client_id TEXT PRIMARY KEY,
+            last_seen TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_sessions (
+            session_token TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_commands (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            client_id TEXT NOT NULL,
+            status TEXT,
+            rev INTEGER NOT NULL DEFAULT 0,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_state_commands_client ON state_commands (client_id, status);
+        CREATE TABLE IF NOT EXISTS state_notifications (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_state_notifications_client ON state_notifications (client_id);
+        CREATE TABLE IF NOT EXISTS state_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_groups (
+            group_id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_process_snapshots (
+            client_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS state_thumbnails (
+            client_id TEXT PRIMARY KEY,
+            mimetype TEXT NOT NULL,
+            etag TEXT NOT NULL,
+            phash TEXT,
+            updated_at TEXT NOT NULL,
+            image BLOB NOT NULL
+        );
+        ''')
+        # Базы, созданные до появления ревизий команд
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(state_commands)")]
+        if 'rev' not in columns:
+            conn.execute("ALTER TABLE state_commands ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE state_commands SET rev = seq")
+            conn.execute(
+                "INSERT OR REPLACE INTO state_counters (name, value) "
+                "SELECT 'command_rev', COALESCE(MAX(seq), 0) FROM state_commands"
+            )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_state_commands_rev ON state_commands (client_id, rev)")
+
+    @staticmethod
+    def _encode_client(data):
+        data = dict(data)
+        last_seen = data.pop('last_seen', None) or datetime.now()
+        return last_seen.isoformat(), json.dumps(data, default=str)
+
+    @staticmethod
+    def _decode_client(last_seen, data):
+        client = json.loads(data)
+        client['last_seen'] = datetime.fromisoformat(last_seen)
+        return client
+
+    @staticmethod
+    def _encode_session(data):
+        data = dict(data)
+        if isinstance(data.get('expires'), datetime):
+            data['expires'] = data['expires'].isoformat()
+        return json.dumps(data)
+
+    @staticmethod
+    def _decode_session(data):
+        session_data = json.loads(data)
+        if session_data.get('expires'):
+            session_data['expires'] = datetime.fromisoformat(session_data['expires'])
+        return session_data
+
+    # Клиенты
+
+    def create_client(self, client_id, data):
+        last_seen, payload = self._encode_client(data)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO state_clients (client_id, last_seen, data) VALUES (?, ?, ?)",
+            (client_id, last_seen, payload)
+        )
+
+    def get_client(self, client_id):
+        row = self._connect().execute(
+            "SELECT last_seen, data FROM state_clients WHERE client_id = ?", (client_id,)
+        ).fetchone()
+        return self._decode_client(*row) if row else None
+
+    def update_client(self, client_id, **fields):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT last_seen, data FROM state_clients WHERE client_id = ?", (client_id,)
+            ).fetchone()
+            if not row:
+                return False
+            client = self._decode_client(*row)
+            client.update(fields)
+            last_seen, payload = self._encode_client(client)
+            conn.execute(
+                "UPDATE state_clients SET last_seen = ?, data = ? WHERE client_id = ?",
+                (last_seen, payload, client_id)
+            )
+            return True
+
+    def merge_client_field(self, client_id, field, values):
+        """Дополняет вложенный словарь записи клиента (system_info, screen_info и т.п.)."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT last_seen, data FROM state_clients WHERE client_id = ?", (client_id,)
+            ).fetchone()
+            if not row:
+                return False
+            client = self._decode_client(*row)
+            client[field] = dict(client.get(field) or {}, **values)
+            last_seen, payload = self._encode_client(client)
+            conn.execute(
+                "UPDATE state_clients SET last_seen = ?, data = ? WHERE client_id = ?",
+                (last_seen, payload, client_id)
+            )
+            return True
+
+    def apply_client_state(self, client_id, version, fields, keyframe=False):
+        """Возвращает (результат merge_client_state или 'missing', текущая версия)."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT last_seen, data FROM state_clients WHERE client_id = ?", (client_id,)
+            ).fetchone()
+            if row is None:
+                return 'missing', None
+            client = self._decode_client(*row)
+            result = merge_client_state(client, version, fields, keyframe)
+            if result == 'applied':
+                last_seen, payload = self._encode_client(client)
+                conn.execute(
+                    "UPDATE state_clients SET last_seen = ?, data = ? WHERE client_id = ?",
+                    (last_seen, payload, client_id)
+                )
+            return result, client.get('state_version')
+
+    def touch_client(self, client_id):
+        cursor = self._connect().execute(
+            "UPDATE state_clients SET last_seen = ? WHERE client_id = ?",
+            (datetime.now().isoformat(), client_id)
+        )
+        return cursor.rowcount > 0
+
+    def delete_client(self, client_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM state_clients WHERE client_id = ?", (client_id,))
+            conn.execute("DELETE FROM state_commands WHERE client_id = ?", (client_id,))
+            conn.execute("DELETE FROM state_notifications WHERE client_id = ?", (client_id,))
+            conn.execute("DELETE FROM state_process_snapshots WHERE client_id = ?", (client_id,))
+            conn.execute("DELETE FROM state_thumbnails WHERE client_id = ?", (client_id,))
+
+    def all_clients(self):
+        rows = self._connect().execute("SELECT client_id, last_seen, data FROM state_clients").fetchall()
+        return {client_id: self._decode_client(last_seen, data) for client_id, last_seen, data in rows}
+
+    # Сессии учителей
+
+    def get_session(self, session_token):
+        row = self._connect().execute(
+            "SELECT data FROM state_sessions WHERE session_token = ?", (session_token,)
+        ).fetchone()
+        return self._decode_session(row[0]) if row else None
+
+    def set_session(self, session_token, data):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO state_sessions (session_token, data) VALUES (?, ?)",
+            (session_token, self._encode_session(data))
+        )
+
+    def delete_session(self, session_token):
+        self._connect().execute("DELETE FROM state_sessions WHERE session_token = ?", (session_token,))
+
+    def all_sessions(self):
+        rows = self._connect().execute("SELECT session_token, data FROM state_sessions").fetchall()
+        return {token: self._decode_session(data) for token, data in rows}
+
+    # Очередь команд
+
+    def _next_command_rev(self, conn):
+        row = conn.execute("SELECT value FROM state_counters WHERE name = 'command_rev'").fetchone()
+        rev = (row[0] if row else 0) + 1
+        conn.execute("INSERT OR REPLACE INTO state_counters (name, value) VALUES ('command_rev', ?)", (rev,))
+        return rev
+
+    def add_command(self, client_id, command):
+        with self._transaction() as conn:
+            command = dict(command, rev=self._next_command_rev(conn))
+            conn.execute(
+                "INSERT INTO state_commands (id, client_id, status, rev, data) VALUES (?, ?, ?, ?, ?)",
+                (command['id'], client_id, command.get('status'), command['rev'], json.dumps(command))
+            )
+
+    def list_commands(self, client_id):
+        rows = self._connect().execute(
+            "SELECT data FROM state_commands WHERE client_id = ? ORDER BY seq", (client_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_active_commands(self, client_id):
+        placeholders = ', '.join('?' * len(COMMAND_ACTIVE_STATUSES))
+        rows = self._connect().execute(
+            f"SELECT data FROM state_commands WHERE client_id = ? AND status IN ({placeholders}) ORDER BY seq",
+            (client_id, *COMMAND_ACTIVE_STATUSES)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_command(self, client_id, command_id):
+        row = self._connect().execute(
+            "SELECT data FROM state_commands WHERE client_id = ? AND id = ?", (client_id, command_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_command(self, client_id, command_id, only_status=None, **fields):
+        """Обновляет поля команды. only_status (статус или кортеж статусов) ограничивает
+        обновление командами в этих статусах."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM state_commands WHERE client_id = ? AND id = ?", (client_id, command_id)
+            ).fetchone()
+            if not row:
+                return False
+            cmd = json.loads(row[0])
+            if only_status and not status_matches(cmd, only_status):
+                return False
+            cmd.update(fields, rev=self._next_command_rev(conn))
+            conn.execute(
+                "UPDATE state_commands SET status = ?, rev = ?, data = ? WHERE id = ?",
+                (cmd.get('status'), cmd['rev'], json.dumps(cmd), command_id)
+            )
+            return True
+
+    def update_commands_by_status(self, client_id, only_status, **fields):
+        """Обновляет поля всех команд клиента в статусе only_status. Возвращает их число."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, data FROM state_commands WHERE client_id = ? AND status = ?", (client_id, only_status)
+            ).fetchall()
+            for command_id, data in rows:
+                cmd = json.loads(data)
+                cmd.update(fields, rev=self._next_command_rev(conn))
+                conn.execute(
+                    "UPDATE state_commands SET status = ?, rev = ?, data = ? WHERE id = ?",
+                    (cmd.get('status'), cmd['rev'], json.dumps(cmd), command_id)
+                )
+            return len(rows)
+
+    def list_command_changes(self, client_id, since=0, limit=100):
+        """Команды клиента, изменившиеся после ревизии since, в порядке изменения."""
+        rows = self._connect().execute(
+            "SELECT rev, data FROM state_commands WHERE client_id = ? AND rev > ? ORDER BY rev LIMIT ?",
+            (client_id, since, limit)
+        ).fetchall()
+        return [dict(json.loads(data), rev=rev) for rev, data in rows]
+
+    # Уведомления
+
+    def add_notification(self, client_id, notification):
+        self._connect().execute(
+            "INSERT INTO state_notifications (client_id, timestamp, data) VALUES (?, ?, ?)",
+            (client_id, notification['timestamp'], json.dumps(notification))
+        )
+
+    def take_notifications(self, client_id, since_time):
+        """Забирает уведомления новее since_time и удаляет их из очереди."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, timestamp, data FROM state_notifications WHERE client_id = ? ORDER BY seq",
+                (client_id,)
+            ).fetchall()
+            taken = []
+            for seq, timestamp, data in rows:
+                try:
+                    if datetime.fromisoformat(timestamp) <= since_time:
+                        continue
+                except ValueError:
+                    continue
+                taken.append(json.loads(data))
+                conn.execute("DELETE FROM state_notifications WHERE seq = ?", (seq,))
+            return taken
+
+    # Снимки процессов
+
+    def get_process_snapshot(self, client_id):
+        row = self._connect().execute(
+            "SELECT data FROM state_process_snapshots WHERE client_id = ?", (client_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def apply_process_delta(self, client_id, delta):
+        """Возвращает (применено, текущая версия снимка)."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM state_process_snapshots WHERE client_id = ?", (client_id,)
+            ).fetchone()
+            current = json.loads(row[0]) if row else None
+            snapshot = merge_process_snapshot(current, delta)
+            if snapshot is None:
+                return False, current['version'] if current else 0
+            conn.execute(
+                "INSERT OR REPLACE INTO state_process_snapshots (client_id, data) VALUES (?, ?)",
+                (client_id, json.dumps(snapshot))
+            )
+            return True, snapshot['version']
+
+    # Миниатюры экрана
+
+    def set_thumbnail(self, client_id, thumbnail):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO state_thumbnails (client_id, mimetype, etag, phash, updated_at, image) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (client_id, thumbnail['mimetype'], thumbnail['etag'], thumbnail.get('phash'),
+             thumbnail['updated_at'], sqlite3.Binary(thumbnail['image']))
+        )
+
+    def get_thumbnail(self, client_id):
+        row = self._connect().execute(
+            "SELECT mimetype, etag, phash, updated_at, image FROM state_thumbnails WHERE client_id = ?", (client_id,)
+        ).fetchone()
+        if not row:
+            return None
+        mimetype, etag, phash, updated_at, image = row
+        return {'image': bytes(image), 'mimetype': mimetype, 'etag': etag, 'phash': phash, 'updated_at': updated_at}
+
+    # Групповые команды
+
+    def create_group(self, group_id, data):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO state_groups (group_id, created_at, data) VALUES (?, ?, ?)",
+            (group_id, data['created_at'], json.dumps(data))
+        )
+
+    def get_group(self, group_id):
+        row = self._connect().execute(
+            "SELECT data FROM state_groups WHERE group_id = ?", (group_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete_groups_before(self, created_before):
+        """Удаляет группы, созданные раньше created_before (datetime)."""
+        cursor = self._connect().execute(
+            "DELETE FROM state_groups WHERE created_at < ?", (created_before.isoformat(),)
+        )
+        return cursor.rowcount
+
+    # Аренды (владение ffmpeg прокси и т.п.)
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT owner, expires FROM state_leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO state_leases (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + ttl)
+            )
+            return True
+
+    def release_lease(self, name, owner):
+        self._connect().execute("DELETE FROM state_leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def lease_owner(self, name):
+        row = self._connect().execute(
+            "SELECT owner FROM state_leases WHERE name = ? AND expires > ?", (name, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def next_counter(self, name, start=0):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM state_counters WHERE name = ?", (name,)).fetchone()
+            value = row[0] if row else start
+            conn.execute(
+                "INSERT OR REPLACE INTO state_counters (name, value) VALUES (?, ?)", (name, value + 1)
+            )
+            return value
+
+
+class _ImmediateTransaction:
+    """BEGIN IMMEDIATE ... COMMIT, чтобы read-modify-write не пересекались между воркерами."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def create_state_backend(kind=None, db_path=None):
+    """Создаёт хранилище состояния по имени: memory или sqlite."""
+    kind = (kind or os.environ.get('STATE_BACKEND', 'memory')).lower()
+    if kind == 'memory':
+        return MemoryStateBackend(os.environ.get('COMMAND_ARCHIVE_PATH', COMMAND_ARCHIVE_PATH))
+    if kind == 'sqlite':
+        db_path = db_path or os.environ.get('STATE_DB_PATH', 'server_state.db')
+        logger.info(f"Используется SQLite хранилище состояния: {db_path}")
+        return SQLiteStateBackend(db_path)
+    raise ValueError(f"Неизвестный тип хранилища состояния: {kind}")
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from state import MemoryStateBackend, SQLiteStateBackend
+from ts_fixture import write_ts
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    """Оба хранилища состояния с базами во временном каталоге."""
+    if request.param == 'memory':
+        return MemoryStateBackend(str(tmp_path / 'archive.db'))
+    return SQLiteStateBackend(str(tmp_path / 'state.db'))
+
+
+@pytest.fixture
+def ts_file(tmp_path):
+    """Фабрика TS файлов: ts_file(name, seconds=..., fps=..., gop=..., start_pts=...)."""
+    def make(name='stream.ts', **options):
+        return write_ts(str(tmp_path / name), **options)
+    return make
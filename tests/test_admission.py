@@ -0,0 +1,82 @@
+import pytest
+
+import admission
+from admission import AdmissionControl, RateLimiter, TokenBucket, retry_headers
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время для корзин: clock.now сдвигается вручную."""
+    class Clock:
+        now = 1000.0
+
+        def __call__(self):
+            return self.now
+
+    fake = Clock()
+    monkeypatch.setattr(admission.time, 'monotonic', fake)
+    return fake
+
+
+def test_token_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.take(clock.now) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(clock.now) == pytest.approx(0.5)
+    # За полсекунды накапливается ровно один токен
+    assert bucket.take(clock.now + 0.5) == 0
+    assert bucket.take(clock.now + 0.5) == pytest.approx(0.5)
+
+
+def test_token_bucket_refill_is_capped_by_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.take(clock.now)
+    bucket.take(clock.now)
+    later = clock.now + 60
+    assert [bucket.take(later) for _ in range(2)] == [0, 0]
+    assert bucket.take(later) > 0
+
+
+def test_rate_limiter_keeps_bucket_per_key(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.take('a') == 0
+    assert limiter.take('a') == pytest.approx(1)
+    assert limiter.take('b') == 0
+
+
+def test_rate_limiter_sweeps_idle_buckets(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    limiter.take('idle')
+    clock.now += admission.BUCKET_IDLE_TTL + admission.BUCKET_SWEEP_INTERVAL
+    limiter.take('fresh')
+    assert set(limiter._buckets) == {'fresh'}
+
+
+def test_admission_checks_client_then_route(clock):
+    control = AdmissionControl({
+        'register_stream': {'client': (1, 1), 'route': (1, 4)},
+        'register_client': {'route': (2, 2)}
+    })
+
+    assert control.check('register_stream', 'c1') is None
+    wait, jitter = control.check('register_stream', 'c1')
+    assert wait == pytest.approx(1)
+    assert jitter == admission.RETRY_JITTER_MIN
+
+    # Другие клиенты проходят, пока не кончится общая корзина маршрута
+    assert [control.check('register_stream', f'c{number}') for number in range(2, 5)] == [None] * 3
+    wait, jitter = control.check('register_stream', 'c5')
+    assert wait == pytest.approx(1)
+    # Отказ маршрута размазывает повторы на время восстановления всей корзины
+    assert jitter == pytest.approx(4)
+
+
+def test_admission_skips_endpoints_without_rules(clock):
+    control = AdmissionControl({'register_client': {'route': (1, 1)}})
+    assert all(control.check('heartbeat', 'c1') is None for _ in range(10))
+    assert control.check('register_client', None) is None
+    assert control.check('register_client', None) is not None
+
+
+def test_retry_headers_round_up_with_minimum():
+    assert retry_headers(0.2, 1.0) == {'Retry-After': '1', 'X-Retry-Jitter': '1.0'}
+    assert retry_headers(2.1, 7.26) == {'Retry-After': '3', 'X-Retry-Jitter': '7.3'}
@@ -0,0 +1,103 @@
+import io
+import gzip
+import zlib
+
+import pytest
+
+import compression
+from compression import (DecompressionError, PayloadTooLarge, RequestDecompressionMiddleware,
+                         UnsupportedEncoding, choose_encoding, decompress, should_compress)
+
+LIMIT = 64 * 1024
+
+
+def test_identity_body_is_bounded():
+    assert decompress(b'a' * LIMIT, None, LIMIT) == b'a' * LIMIT
+    with pytest.raises(PayloadTooLarge):
+        decompress(b'a' * (LIMIT + 1), 'identity', LIMIT)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'x-gzip', 'deflate'])
+def test_zlib_body_at_limit_is_accepted(encoding):
+    body = b'{"k": 1}' * (LIMIT // 8)
+    packed = zlib.compress(body) if encoding == 'deflate' else gzip.compress(body)
+    assert decompress(packed, encoding, LIMIT) == body
+
+
+def test_gzip_bomb_stops_at_limit():
+    # Мегабайт нулей сжимается в килобайт: распаковка не должна выделить больше limit + 1 байт
+    bomb = gzip.compress(b'\x00' * (1024 * 1024))
+    with pytest.raises(PayloadTooLarge) as error:
+        decompress(bomb, 'gzip', LIMIT)
+    assert error.value.status == 413
+
+
+def test_gzip_one_byte_over_limit_is_rejected():
+    with pytest.raises(PayloadTooLarge):
+        decompress(gzip.compress(b'a' * (LIMIT + 1)), 'gzip', LIMIT)
+
+
+def test_corrupted_and_unknown_encodings():
+    with pytest.raises(DecompressionError) as error:
+        decompress(b'not gzip at all', 'gzip', LIMIT)
+    assert error.value.status == 400
+    with pytest.raises(UnsupportedEncoding) as error:
+        decompress(b'data', 'br', LIMIT)
+    assert error.value.status == 415
+
+
+@pytest.mark.skipif(compression.zstandard is None, reason='zstandard не установлен')
+def test_zstd_bomb_stops_at_limit():
+    bomb = compression.zstandard.ZstdCompressor().compress(b'\x00' * (1024 * 1024))
+    with pytest.raises(PayloadTooLarge):
+        decompress(bomb, 'zstd', LIMIT)
+    body = b'z' * LIMIT
+    assert decompress(compression.compress(body, 'zstd'), 'zstd', LIMIT) == body
+
+
+def test_choose_encoding_respects_quality():
+    preferred = compression.supported_encodings()[0]
+    assert choose_encoding('gzip, zstd') == preferred
+    assert choose_encoding('gzip;q=0, br') is None
+    assert choose_encoding('*;q=0.5') == preferred
+    assert choose_encoding('') is None
+
+
+def test_should_compress_bounds():
+    assert not should_compress('application/json', compression.COMPRESS_MIN_SIZE - 1)
+    assert should_compress('application/json', compression.COMPRESS_MIN_SIZE)
+    assert not should_compress('image/jpeg', 10 * compression.COMPRESS_MIN_SIZE)
+
+
+def call_middleware(body, encoding, limit=LIMIT, length=None):
+    seen = {}
+
+    def app(environ, start_response):
+        seen['body'] = environ['wsgi.input'].read()
+        seen['encoding'] = environ.get('HTTP_CONTENT_ENCODING')
+        start_response('200 OK', [])
+        return [b'ok']
+
+    def start_response(status, headers):
+        seen['status'] = int(status.split(' ', 1)[0])
+
+    environ = {
+        'HTTP_CONTENT_ENCODING': encoding,
+        'CONTENT_LENGTH': str(len(body) if length is None else length),
+        'wsgi.input': io.BytesIO(body),
+        'PATH_INFO': '/api/heartbeat/c1'
+    }
+    RequestDecompressionMiddleware(app, limit)(environ, start_response)
+    return seen
+
+
+def test_middleware_unpacks_request_body():
+    seen = call_middleware(gzip.compress(b'{"cpu": 1}'), 'gzip')
+    assert seen == {'body': b'{"cpu": 1}', 'encoding': None, 'status': 200}
+
+
+def test_middleware_rejects_oversized_bodies():
+    assert call_middleware(gzip.compress(b'\x00' * (LIMIT * 4)), 'gzip')['status'] == 413
+    # Заявленная длина больше лимита: тело даже не читается
+    assert call_middleware(b'', 'gzip', length=LIMIT + 1) == {'status': 413}
+    assert call_middleware(b'data', 'br')['status'] == 415
@@ -0,0 +1,79 @@
+import io
+
+import mpegts
+from ts_fixture import TS_VIDEO_PID, write_ts
+
+
+def read_frames(path):
+    with open(path, 'rb') as stream:
+        return list(mpegts.iter_video_frames(stream))
+
+
+def test_video_frames_and_keyframes(ts_file):
+    frames = read_frames(ts_file(seconds=4, fps=10, gop=20, start_pts=90000))
+
+    assert len(frames) == 40
+    assert frames[0].pts == 90000 and frames[-1].pts == 90000 + 39 * 9000
+    assert [number for number, frame in enumerate(frames) if frame.keyframe] == [0, 20]
+    # Сегмент с ключевого кадра начинается с PAT перед ним
+    assert frames[0].table_offset == 0
+    assert frames[20].table_offset is not None and frames[20].table_offset < frames[20].offset
+    assert frames[1].table_offset is None
+
+
+def test_keyframes_found_by_idr_without_random_access_flag(ts_file):
+    frames = read_frames(ts_file(seconds=2, gop=10, random_access=False))
+    assert [number for number, frame in enumerate(frames) if frame.keyframe] == [0, 10]
+
+
+def test_parse_packet_reads_pcr_and_random_access(ts_file):
+    with open(ts_file(seconds=1), 'rb') as stream:
+        packets = list(mpegts.iter_packets(stream))
+
+    video = [packet for packet in packets if packet.pid == TS_VIDEO_PID and packet.unit_start]
+    assert video[0].random_access and not video[1].random_access
+    assert video[0].pcr == 90000 * 300
+    assert video[1].pcr - video[0].pcr == mpegts.PCR_CLOCK // 10
+
+
+def test_iter_packets_resyncs_after_garbage(tmp_path):
+    with open(write_ts(str(tmp_path / 'a.ts'), seconds=1), 'rb') as stream:
+        data = stream.read()
+    damaged = data[:188 * 3] + b'\x00garbage\x00' + data[188 * 3:]
+
+    packets = list(mpegts.iter_packets(io.BytesIO(damaged), chunk_packets=2))
+    assert len(packets) == len(data) // 188
+    assert packets[3].offset == 188 * 3 + len(b'\x00garbage\x00')
+
+
+def test_stream_stats_summary(ts_file):
+    stats = mpegts.StreamStats()
+    with open(ts_file(seconds=4, fps=10, gop=20), 'rb') as stream:
+        first, last, frames = stats.feed_stream(stream)
+
+    assert frames == 40 and last - first == 39 * 9000
+    summary = stats.summary()
+    assert summary['codec'] == 'h264'
+    assert summary['fps'] == 10.0
+    assert summary['duration'] == 4.0
+    assert summary['gop_frames'] == 20 and summary['gop_seconds'] == 2.0
+    assert summary['keyframes'] == 2
+    assert summary['continuity_errors'] == 0
+    assert summary['pcr_interval_max_ms'] == 100.0
+
+
+def test_stream_stats_counts_continuity_errors(ts_file):
+    with open(ts_file(seconds=1), 'rb') as stream:
+        data = stream.read()
+    # Выпавший пакет видеопотока ломает последовательность continuity counter
+    packets = [data[offset:offset + 188] for offset in range(0, len(data), 188)]
+    dropped = next(number for number, packet in enumerate(packets)
+                   if mpegts.parse_packet(packet).pid == TS_VIDEO_PID and number > 10)
+    stats = mpegts.StreamStats()
+    stats.feed_stream(io.BytesIO(b''.join(packets[:dropped] + packets[dropped + 1:])))
+    assert stats.summary()['continuity_errors'] == 1
+
+
+def test_pts_delta_handles_wraparound():
+    assert mpegts.pts_delta(90000, 180000) == 1.0
+    assert mpegts.pts_delta(mpegts.PTS_WRAP - 45000, 45000) == 1.0
@@ -0,0 +1,107 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import recording
+from ts_fixture import write_ts
+
+SEGMENT_TIME = 4
+START = datetime(2024, 3, 1, 10, 0, 0)
+
+
+def record(record_path, start, start_pts, seconds=4):
+    """Файл записи, начатый в start, с PTS от start_pts."""
+    name = start.strftime(recording.RECORDING_FILE_FORMAT) + recording.RECORDING_EXTENSION
+    return write_ts(os.path.join(record_path, name), seconds=seconds, fps=10, gop=20, start_pts=start_pts)
+
+
+def playlist_lines(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+@pytest.fixture
+def record_path(tmp_path):
+    path = tmp_path / 'client'
+    path.mkdir()
+    return str(path)
+
+
+def test_build_index(record_path):
+    path = record(record_path, START, 90000)
+    index = recording.build_index(path)
+
+    assert index['size'] == os.path.getsize(path)
+    assert index['first_pts'] == 90000 and index['duration'] == pytest.approx(3.9)
+    assert [keyframe[0] for keyframe in index['keyframes']] == [0, 2000]
+    assert index['keyframes'][0][1] == 0
+    # Второй ключевой кадр режется по PAT перед ним: смещение кратно пакету и указывает на PAT
+    offset = index['keyframes'][1][1]
+    with open(path, 'rb') as stream:
+        stream.seek(offset)
+        packet = stream.read(188)
+    assert offset % 188 == 0 and packet[0] == 0x47 and packet[1] & 0x1F == 0 and packet[2] == 0
+
+
+def test_index_saved_only_for_finished_files(record_path):
+    first = record(record_path, START, 90000)
+    last = record(record_path, START + timedelta(seconds=4), 90000 + 4 * 90000)
+
+    recording.recording_spans(record_path, SEGMENT_TIME)
+    assert os.path.exists(first + recording.INDEX_SUFFIX)
+    # Последний файл ещё пишется: индекс строится каждый раз заново
+    assert not os.path.exists(last + recording.INDEX_SUFFIX)
+
+
+def test_outdated_index_is_rebuilt(record_path):
+    path = record(record_path, START, 90000)
+    recording.load_index(path)
+    with open(path + recording.INDEX_SUFFIX, 'w') as f:
+        json.dump({'version': recording.INDEX_VERSION, 'size': 1, 'keyframes': []}, f)
+
+    assert len(recording.load_index(path)['keyframes']) == 2
+
+
+def test_vod_playlist_covers_files_by_keyframe_ranges(record_path):
+    files = [
+        record(record_path, START, 90000),
+        record(record_path, START + timedelta(seconds=4), 90000 + 4 * 90000),
+        # Разрыв PTS в минуту: новый таймлайн
+        record(record_path, START + timedelta(seconds=70), 90000 + 70 * 90000)
+    ]
+    playlist = recording.vod_playlist(record_path, SEGMENT_TIME, '/recordings/c1')
+
+    assert playlist.startswith('#EXTM3U\n') and playlist.endswith('#EXT-X-ENDLIST\n')
+    assert '#EXT-X-TARGETDURATION:2' in playlist
+    assert playlist.count('#EXT-X-DISCONTINUITY') == 1
+    assert len(playlist_lines(playlist, '#EXT-X-PROGRAM-DATE-TIME')) == 3
+    assert playlist_lines(playlist, '#EXTINF') == ['#EXTINF:2.000,', '#EXTINF:1.900,'] * 3
+
+    # Куски каждого файла идут подряд и покрывают его целиком
+    ranges = [line.split(':', 1)[1] for line in playlist_lines(playlist, '#EXT-X-BYTERANGE')]
+    for number, path in enumerate(files):
+        (first_length, first_offset), (second_length, second_offset) = [
+            map(int, item.split('@')) for item in ranges[number * 2:number * 2 + 2]]
+        assert first_offset == 0 and second_offset == first_length
+        assert first_length + second_length == os.path.getsize(path)
+    assert f'/recordings/c1/{os.path.basename(files[2])}' in playlist
+
+
+def test_vod_playlist_window(record_path):
+    record(record_path, START, 90000)
+    record(record_path, START + timedelta(seconds=4), 90000 + 4 * 90000)
+
+    # Начало интервала внутри второго GOP первого файла: воспроизведение с его ключевого кадра
+    playlist = recording.vod_playlist(record_path, SEGMENT_TIME, '/r', start=START + timedelta(seconds=2.5),
+                                      end=START + timedelta(seconds=3))
+    assert playlist_lines(playlist, '#EXTINF') == ['#EXTINF:1.900,']
+    assert '20240301-100004.ts' not in playlist
+    assert f'#EXT-X-PROGRAM-DATE-TIME:{(START + timedelta(seconds=2)).astimezone().isoformat(timespec="milliseconds")}' in playlist
+
+
+def test_vod_playlist_without_recordings(record_path, tmp_path):
+    assert recording.vod_playlist(str(tmp_path / 'missing'), SEGMENT_TIME, '/r') is None
+    record(record_path, START, 90000)
+    assert recording.vod_playlist(record_path, SEGMENT_TIME, '/r', start=START + timedelta(hours=1)) is None
+    assert recording.vod_playlist(record_path, SEGMENT_TIME, '/r', end=START - timedelta(hours=1)) is None
@@ -0,0 +1,197 @@
+from datetime import datetime
+
+import pytest
+
+from state import MemoryStateBackend, merge_client_state
+
+
+def make_client(backend, client_id='c1'):
+    backend.create_client(client_id, {'token': 't', 'last_seen': datetime.now(), 'system_info': {}})
+    return client_id
+
+
+# Версионированное состояние клиента
+
+def test_merge_client_state_applies_keyframe_then_changes():
+    client = {}
+    assert merge_client_state(client, [1, 1], {'system_info': {'cpu': 10, 'ram': 20}}, True) == 'applied'
+    assert merge_client_state(client, [1, 2], {'system_info': {'cpu': 15}}, False) == 'applied'
+    assert client['system_info'] == {'cpu': 15, 'ram': 20}
+    assert client['state_version'] == [1, 2]
+
+
+def test_merge_client_state_rejects_stale_versions():
+    client = {}
+    merge_client_state(client, [1, 5], {'system_info': {'cpu': 10}}, True)
+    assert merge_client_state(client, [1, 5], {'system_info': {'cpu': 99}}, False) == 'stale'
+    assert merge_client_state(client, [1, 3], {'system_info': {'cpu': 99}}, True) == 'stale'
+    assert merge_client_state(client, [0, 9], {'system_info': {'cpu': 99}}, False) == 'stale'
+    assert client['system_info'] == {'cpu': 10}
+    assert client['state_version'] == [1, 5]
+
+
+def test_merge_client_state_requires_keyframe_for_new_epoch():
+    client = {}
+    assert merge_client_state(client, [1, 1], {'system_info': {'cpu': 10}}, False) == 'keyframe_required'
+    merge_client_state(client, [1, 1], {'system_info': {'cpu': 10, 'ram': 20}}, True)
+    # Перезапуск клиента: изменения новой сессии без полного состояния не принимаются
+    assert merge_client_state(client, [2, 1], {'system_info': {'cpu': 30}}, False) == 'keyframe_required'
+    assert merge_client_state(client, [2, 1], {'system_info': {'cpu': 30}}, True) == 'applied'
+    assert client['system_info'] == {'cpu': 30}
+
+
+def test_apply_client_state(backend):
+    client_id = make_client(backend)
+    assert backend.apply_client_state('missing', [1, 1], {}, True) == ('missing', None)
+    assert backend.apply_client_state(client_id, [1, 1], {'system_info': {'cpu': 10, 'ram': 20}}, True) == ('applied', [1, 1])
+    assert backend.apply_client_state(client_id, [1, 1], {'system_info': {'cpu': 50}}) == ('stale', [1, 1])
+    assert backend.apply_client_state(client_id, [2, 1], {'system_info': {'cpu': 50}}) == ('keyframe_required', [1, 1])
+    assert backend.apply_client_state(client_id, [1, 2], {'system_info': {'cpu': 50}}) == ('applied', [1, 2])
+    assert backend.get_client(client_id)['system_info'] == {'cpu': 50, 'ram': 20}
+
+
+# Курсор истории команд
+
+def add_commands(backend, client_id, count, **fields):
+    for number in range(count):
+        backend.add_command(client_id, dict({
+            'id': f'cmd{number}',
+            'command': f'echo {number}',
+            'status': 'pending',
+            'timestamp': f'2024-01-01T00:00:{number:02d}'
+        }, **fields))
+
+
+def test_command_changes_follow_revisions(backend):
+    client_id = make_client(backend)
+    add_commands(backend, client_id, 3)
+
+    changes = backend.list_command_changes(client_id)
+    assert [cmd['id'] for cmd in changes] == ['cmd0', 'cmd1', 'cmd2']
+    cursor = changes[-1]['rev']
+    assert backend.list_command_changes(client_id, since=cursor) == []
+
+    # Изменённая команда снова попадает в историю, уже после курсора
+    backend.update_command(client_id, 'cmd0', status='completed', stdout='done')
+    changes = backend.list_command_changes(client_id, since=cursor)
+    assert [cmd['id'] for cmd in changes] == ['cmd0']
+    assert changes[0]['rev'] > cursor
+    assert changes[0]['status'] == 'completed'
+
+
+def test_command_changes_page_by_limit(backend):
+    client_id = make_client(backend)
+    add_commands(backend, client_id, 5)
+
+    seen = []
+    cursor = 0
+    while True:
+        page = backend.list_command_changes(client_id, since=cursor, limit=2)
+        if not page:
+            break
+        assert len(page) <= 2
+        seen += [cmd['id'] for cmd in page]
+        cursor = page[-1]['rev']
+    assert seen == [f'cmd{number}' for number in range(5)]
+
+
+def test_command_changes_are_per_client(backend):
+    make_client(backend, 'c1')
+    make_client(backend, 'c2')
+    add_commands(backend, 'c1', 2)
+    backend.add_command('c2', {'id': 'other', 'status': 'pending', 'timestamp': '2024-01-01T00:00:00'})
+
+    assert [cmd['id'] for cmd in backend.list_command_changes('c2')] == ['other']
+    assert backend.update_commands_by_status('c1', 'pending', status='cancelled') == 2
+    cursor = backend.list_command_changes('c2')[-1]['rev']
+    assert backend.list_command_changes('c2', since=cursor) == []
+
+
+# Вытеснение истории команд в архив
+
+@pytest.fixture
+def small_memory(tmp_path):
+    return MemoryStateBackend(str(tmp_path / 'archive.db'), command_limit=3, command_bytes=64 * 1024)
+
+
+def finish_commands(backend, client_id, count, stdout='x'):
+    add_commands(backend, client_id, count)
+    for number in range(count):
+        backend.update_command(client_id, f'cmd{number}', status='completed', stdout=f'{stdout}{number}')
+
+
+def in_memory_ids(backend, client_id):
+    return [cmd['id'] for cmd in backend.list_commands(client_id) if 'stdout' in cmd]
+
+
+def test_finished_output_survives_history_growth(backend):
+    client_id = make_client(backend)
+    finish_commands(backend, client_id, 6)
+
+    commands = backend.list_commands(client_id)
+    assert [cmd['id'] for cmd in commands] == [f'cmd{number}' for number in range(6)]
+    assert all(cmd['status'] == 'completed' for cmd in commands)
+    assert backend.get_command(client_id, 'cmd0')['stdout'] == 'x0'
+
+
+def test_retention_spills_least_recently_used(small_memory):
+    client_id = make_client(small_memory)
+    finish_commands(small_memory, client_id, 3)
+    # Обращение к cmd0 делает его самым свежим: вытесняется cmd1
+    small_memory.get_command(client_id, 'cmd0')
+    small_memory.add_command(client_id, {'id': 'new', 'status': 'pending', 'timestamp': '2024-01-01T00:01:00'})
+
+    assert sorted(in_memory_ids(small_memory, client_id)) == ['cmd0', 'cmd2']
+    archived = next(cmd for cmd in small_memory.list_commands(client_id) if cmd['id'] == 'cmd1')
+    assert archived['stdout_size'] == 2
+    assert small_memory.get_command(client_id, 'cmd1')['stdout'] == 'x1'
+
+
+def test_retention_never_spills_active_commands(small_memory):
+    client_id = make_client(small_memory)
+    add_commands(small_memory, client_id, 5)
+
+    assert len(small_memory.list_active_commands(client_id)) == 5
+    assert len(in_memory_ids(small_memory, client_id)) == 0
+    assert all('stdout_size' not in cmd for cmd in small_memory.list_commands(client_id))
+
+
+def test_retention_bounds_output_bytes(tmp_path):
+    backend = MemoryStateBackend(str(tmp_path / 'archive.db'), command_limit=100, command_bytes=4096)
+    client_id = make_client(backend)
+    finish_commands(backend, client_id, 4, stdout='y' * 1500)
+
+    kept = in_memory_ids(backend, client_id)
+    assert kept == ['cmd2', 'cmd3']
+    assert [cmd['stdout_size'] for cmd in backend.list_commands(client_id)[:2]] == [1501, 1501]
+
+
+def test_archived_command_updates_reach_cursor(small_memory):
+    client_id = make_client(small_memory)
+    finish_commands(small_memory, client_id, 4)
+    cursor = small_memory.list_command_changes(client_id)[-1]['rev']
+
+    assert small_memory.update_command(client_id, 'cmd0', only_status='completed', exit_code=0)
+    changes = small_memory.list_command_changes(client_id, since=cursor)
+    assert [cmd['id'] for cmd in changes] == ['cmd0']
+    assert 'stdout' not in changes[0] and changes[0]['exit_code'] == 0
+    assert small_memory.get_command(client_id, 'cmd0')['stdout'] == 'x0'
+    assert not small_memory.update_command(client_id, 'cmd0', only_status='pending', exit_code=1)
+
+
+# Уведомления об изменениях для длинных опросов
+
+def test_memory_backend_reports_changes(small_memory):
+    changes = []
+    small_memory.add_change_listener(lambda kind, client_id: changes.append((kind, client_id)))
+    client_id = make_client(small_memory)
+
+    small_memory.touch_client(client_id)
+    add_commands(small_memory, client_id, 1)
+    small_memory.update_command(client_id, 'cmd0', status='running')
+    small_memory.update_command(client_id, 'missing', status='running')
+    small_memory.update_commands_by_status(client_id, 'pending', status='completed')
+    small_memory.add_notification(client_id, {'id': 'n1', 'message': 'hi', 'timestamp': '2024-01-01T00:00:00'})
+
+    assert changes == [('client', client_id), ('commands', client_id), ('commands', client_id),
+                       ('notifications', client_id)]
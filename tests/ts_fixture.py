@@ -0,0 +1,86 @@
+# Крошечный MPEG-TS для тестов разбора и записи: PAT/PMT перед каждым ключевым кадром,
+# кадры H.264 из заглушек NAL units, PCR в первом пакете кадра
+TS_VIDEO_PID = 0x100
+TS_PMT_PID = 0x1000
+
+
+def mpeg_crc32(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def encode_timestamp(value, marker=0x2):
+    return bytes([
+        (marker << 4) | ((value >> 29) & 0x0E) | 1,
+        (value >> 22) & 0xFF,
+        ((value >> 14) & 0xFE) | 1,
+        (value >> 7) & 0xFF,
+        ((value << 1) & 0xFE) | 1
+    ])
+
+
+class TSWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.continuity = {}
+
+    def packet(self, pid, payload, unit_start=False, random_access=False, pcr=None):
+        """Пишет пакет и возвращает остаток payload, который в него не поместился. pcr — в единицах 27 МГц."""
+        flags = (0x40 if random_access else 0) | (0x10 if pcr is not None else 0)
+        adaptation = bytes([flags]) if flags else b''
+        if pcr is not None:
+            base, extension = divmod(pcr, 300)
+            adaptation += bytes([(base >> 25) & 0xFF, (base >> 17) & 0xFF, (base >> 9) & 0xFF, (base >> 1) & 0xFF,
+                                 ((base & 1) << 7) | 0x7E | (extension >> 8), extension & 0xFF])
+
+        if adaptation or len(payload) < 184:
+            room = 183 - len(adaptation)
+            chunk = payload[:room]
+            # Короткий пакет добивается байтами 0xFF в adaptation field
+            stuffing = room - len(chunk)
+            if stuffing and not adaptation:
+                adaptation, stuffing = b'\x00', stuffing - 1
+            body = bytes([len(adaptation) + stuffing]) + adaptation + b'\xff' * stuffing + chunk
+            control = 0x30
+        else:
+            chunk = body = payload[:184]
+            control = 0x10
+
+        continuity = (self.continuity.get(pid, -1) + 1) & 0x0F
+        self.continuity[pid] = continuity
+        header = bytes([0x47, (0x40 if unit_start else 0) | (pid >> 8), pid & 0xFF, control | continuity])
+        assert len(header + body) == 188
+        self.stream.write(header + body)
+        return payload[len(chunk):]
+
+    def tables(self):
+        pat = bytes([0x00, 0xB0, 13, 0, 1, 0xC1, 0, 0, 0, 1, 0xE0 | (TS_PMT_PID >> 8), TS_PMT_PID & 0xFF])
+        self.packet(0, b'\x00' + pat + mpeg_crc32(pat).to_bytes(4, 'big'), unit_start=True)
+        body = bytes([0, 1, 0xC1, 0, 0, 0xE0 | (TS_VIDEO_PID >> 8), TS_VIDEO_PID & 0xFF, 0xF0, 0,
+                      0x1B, 0xE0 | (TS_VIDEO_PID >> 8), TS_VIDEO_PID & 0xFF, 0xF0, 0])
+        pmt = bytes([0x02, 0xB0, len(body) + 4]) + body
+        self.packet(TS_PMT_PID, b'\x00' + pmt + mpeg_crc32(pmt).to_bytes(4, 'big'), unit_start=True)
+
+    def frame(self, pts, keyframe, size=400, random_access=True):
+        if keyframe:
+            self.tables()
+        nal = b'\x00\x00\x00\x01\x65' if keyframe else b'\x00\x00\x00\x01\x41'
+        pes = b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + encode_timestamp(pts) + nal + b'\x88' * size
+        pes = self.packet(TS_VIDEO_PID, pes, unit_start=True, random_access=keyframe and random_access,
+                          pcr=pts * 300)
+        while pes:
+            pes = self.packet(TS_VIDEO_PID, pes)
+
+
+def write_ts(path, seconds=4, fps=10, gop=20, start_pts=90000, random_access=True):
+    with open(path, 'wb') as stream:
+        writer = TSWriter(stream)
+        for number in range(int(seconds * fps)):
+            writer.frame(start_pts + number * 90000 // fps, number % gop == 0, random_access=random_access)
+    return path
+